@@ -0,0 +1,101 @@
+import os
+import sqlite3
+import types
+
+import pytest
+
+import toolbox.catalog as catalog
+import toolbox.download as download
+
+
+@pytest.fixture
+def IC(tmp_path):
+    os.makedirs(tmp_path / 'downloads')
+    return types.SimpleNamespace(data_folder=str(tmp_path),
+                                 download_path=str(tmp_path / 'downloads'),
+                                 short_name='ATL15 Test')
+
+
+def write(path, content, mtime=None):
+    with open(path, 'wb') as f:
+        f.write(content)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def test_file_rewritten_in_place_is_noticed(IC):
+    folder = IC.download_path
+    write(os.path.join(folder, 'a.nc'), b'0123456789', 1000.)
+    write(os.path.join(folder, 'b.nc'), b'0123456789', 1000.)
+    catalog.add_files(IC, [os.path.join(folder, 'a.nc'),
+                           os.path.join(folder, 'b.nc')])
+    assert catalog.file_sizes(IC) == {'a.nc': 10, 'b.nc': 10}
+
+    # truncate a file without changing the modification time of the folder
+    folder_mtime = os.stat(folder).st_mtime
+    write(os.path.join(folder, 'a.nc'), b'01234', 2000.)
+    os.utime(folder, (folder_mtime, folder_mtime))
+
+    assert catalog.file_sizes(IC, file_names=['a.nc']) == {'a.nc': 5}
+    file_info = {'a.nc': (10, None, None), 'b.nc': (10, None, None)}
+    names, links = download.obtain_download_list(IC, ['a.nc', 'b.nc'],
+                                                 ['https://x/a.nc',
+                                                  'https://x/b.nc'],
+                                                 file_info)
+    assert names == ['a.nc']
+
+
+def test_deleted_file_is_not_trusted(IC):
+    folder = IC.download_path
+    write(os.path.join(folder, 'a.nc'), b'0123456789')
+    catalog.add_files(IC, [os.path.join(folder, 'a.nc')])
+    catalog.file_sizes(IC)
+
+    folder_mtime = os.stat(folder).st_mtime
+    os.remove(os.path.join(folder, 'a.nc'))
+    os.utime(folder, (folder_mtime, folder_mtime))
+
+    assert catalog.file_sizes(IC) == {}
+    assert catalog.list_files(IC) == []
+
+
+def test_catalog_without_file_mtimes_is_upgraded(IC):
+    connection = sqlite3.connect(catalog.catalog_path(IC))
+    connection.execute('''CREATE TABLE granules (
+                              folder TEXT NOT NULL,
+                              file_name TEXT NOT NULL,
+                              collection TEXT,
+                              variable TEXT,
+                              date_start TEXT,
+                              date_end TEXT,
+                              size INTEGER,
+                              checksum TEXT,
+                              geotransform TEXT,
+                              PRIMARY KEY (folder, file_name))''')
+    connection.execute(
+        'INSERT INTO granules VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (os.path.abspath(IC.download_path), 'a.nc', 'ATL15 Test', None, None,
+         None, 10, None, None))
+    connection.commit()
+    connection.close()
+    write(os.path.join(IC.download_path, 'a.nc'), b'0123456789')
+
+    assert catalog.file_sizes(IC) == {'a.nc': 10}
+    connection = catalog.connect(IC)
+    assert connection.execute('SELECT mtime FROM granules').fetchone()[0] == (
+        os.stat(os.path.join(IC.download_path, 'a.nc')).st_mtime)
+    connection.close()
+
+
+@pytest.mark.parametrize('version', ['v05.0', 'v5', 'v05.01'])
+def test_parse_file_name(version):
+    file_name = 'GL_vel_mosaic_Monthly_01Dec14_31Dec14_vx_' + version + '.tif'
+    assert catalog.parse_file_name(file_name) == ('vx', '20141201', '20141231')
+    assert catalog.parse_file_name(file_name.replace('_vx_', '_ey_')) == (
+        'ey', '20141201', '20141231')
+    assert catalog.parse_file_name('GL_vel_mosaic_Monthly_01Dec14_31Dec14_' +
+                                   version + '.tif') == (None, '20141201',
+                                                         '20141231')
+    assert catalog.parse_file_name('ATL15_AA_0314_01km_002_01.nc') == (None,
+                                                                       None,
+                                                                       None)
@@ -0,0 +1,62 @@
+import json
+import time
+
+import pytest
+import requests
+
+import toolbox.cmr as cmr
+
+
+class Response:
+    def __init__(self, status_code, text, headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+    def json(self):
+        try:
+            return json.loads(self.text)
+        except ValueError as e:
+            raise requests.exceptions.JSONDecodeError(str(e), self.text, 0)
+
+
+@pytest.fixture
+def cached_search(tmp_path):
+    params = cmr.build_query('C123')
+    cmr.write_cache(str(tmp_path), params, {
+        'params': params,
+        'fetched': time.time() - 10 * 24 * 3600,
+        'etag': '"abc"',
+        'last_modified': None,
+        'hits': 0,
+        'items': []
+    })
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize('response', [
+    Response(503, '<html>Service Unavailable</html>'),
+    Response(500, '{"errors": ["internal error"]}'),
+])
+def test_server_errors_use_the_cached_search(cached_search, monkeypatch,
+                                             response):
+    monkeypatch.setattr(requests.Session, 'get',
+                        lambda self, url, **kwargs: response)
+    assert cmr.search_granules('C123', cache_folder=cached_search) == []
+
+
+def test_server_errors_are_raised_without_a_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        requests.Session, 'get', lambda self, url, **kwargs: Response(
+            500, '{"errors": ["internal error"]}'))
+    with pytest.raises(requests.exceptions.HTTPError,
+                       match='HTTP 500.*internal error'):
+        cmr.search_granules('C123', cache_folder=str(tmp_path))
+
+
+def test_search_errors_are_raised(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        requests.Session, 'get', lambda self, url, **kwargs: Response(
+            200, '{"errors": ["bad bounding box"]}'))
+    with pytest.raises(ValueError, match='bad bounding box'):
+        cmr.search_granules('C123')
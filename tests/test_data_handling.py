@@ -0,0 +1,57 @@
+import types
+
+import pytest
+
+import toolbox.data_handling as data_handling
+import toolbox.grid_generation as gg
+
+
+@pytest.fixture
+def IC(tmp_path, monkeypatch):
+    monkeypatch.setattr(data_handling.catalog, 'list_files',
+                        lambda IC, suffix=None: [])
+    return types.SimpleNamespace(download_path=str(tmp_path),
+                                 data_folder=str(tmp_path),
+                                 icesheet_name='Greenland',
+                                 short_name='MEaSUREs Test',
+                                 data_type='velocity',
+                                 posting=100.,
+                                 incremental_update=False,
+                                 memory_budget=None,
+                                 grid_dict=gg.GridIndex(0., 0., 1000., 2, 2),
+                                 cells=['r_00_c_00', 'r_00_c_01'],
+                                 region_name='Region',
+                                 extents=[1., 2., 3., 4.])
+
+
+def test_region_is_restored_when_a_cell_fails(IC, monkeypatch):
+    stack = (None, ) * 9
+    monkeypatch.setattr(data_handling.measures, 'create_velocity_stacks',
+                        lambda IC, file_names, cells: {c: stack
+                                                       for c in cells})
+
+    def output_data_stack_measures(IC, *args):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(data_handling.store, 'output_data_stack_measures',
+                        output_data_stack_measures)
+    with pytest.raises(OSError):
+        data_handling.handle_measures_cells(IC)
+    assert IC.region_name == 'Region'
+    assert IC.extents == [1., 2., 3., 4.]
+
+
+def test_region_is_restored_when_a_cell_over_the_budget_fails(
+        IC, monkeypatch):
+    IC.memory_budget = 1
+    monkeypatch.setattr(data_handling.measures, 'measures_date_pairs',
+                        lambda file_names: ['01Dec14-31Dec14'])
+
+    def handle_measures(IC):
+        raise ValueError('bad mosaic')
+
+    monkeypatch.setattr(data_handling, 'handle_measures', handle_measures)
+    with pytest.raises(ValueError):
+        data_handling.handle_measures_cells(IC)
+    assert IC.region_name == 'Region'
+    assert IC.extents == [1., 2., 3., 4.]
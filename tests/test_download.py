@@ -0,0 +1,186 @@
+import json
+import types
+
+import pytest
+import requests
+
+import toolbox.download as download
+
+
+@pytest.fixture
+def IC(tmp_path):
+    return types.SimpleNamespace(download_path=str(tmp_path),
+                                 download_workers=2,
+                                 download_chunk_size=1024,
+                                 output_summary='')
+
+
+@pytest.fixture
+def cataloged(monkeypatch):
+    files = []
+    monkeypatch.setattr(download.catalog, 'add_files',
+                        lambda IC, paths, checksums=None: files.extend(paths))
+    return files
+
+
+def test_failed_files_are_reported_and_the_rest_cataloged(
+        IC, cataloged, monkeypatch, tmp_path):
+    def stream_to_file(session, link, output_file, chunk_size, info=None):
+        if link.endswith('disk'):
+            raise OSError('No space left on device')
+        if link.endswith('checksum'):
+            raise ValueError('bad checksum')
+        return 200, 10
+
+    monkeypatch.setattr(download, 'stream_to_file', stream_to_file)
+    names = ['a.tif', 'b.tif', 'c.tif']
+    links = ['https://x/ok', 'https://x/disk', 'https://x/checksum']
+    failed_names, failed_links = download.download_urls(IC, names, links)
+
+    assert sorted(failed_names) == ['b.tif', 'c.tif']
+    assert sorted(failed_links) == ['https://x/checksum', 'https://x/disk']
+    assert cataloged == [str(tmp_path / 'a.tif')]
+
+
+def test_completed_files_are_cataloged_when_interrupted(
+        IC, cataloged, monkeypatch, tmp_path):
+    IC.download_workers = 1
+
+    def stream_to_file(session, link, output_file, chunk_size, info=None):
+        if link.endswith('stop'):
+            raise KeyboardInterrupt
+        return 200, 10
+
+    monkeypatch.setattr(download, 'stream_to_file', stream_to_file)
+    with pytest.raises(KeyboardInterrupt):
+        download.download_urls(IC, ['a.tif', 'b.tif'],
+                               ['https://x/ok', 'https://x/stop'])
+    assert cataloged == [str(tmp_path / 'a.tif')]
+
+
+class Response:
+    def __init__(self, status_code, content=b'', reason=''):
+        self.status_code = status_code
+        self.reason = reason
+        self.content = content
+        self.headers = {'Content-Length': str(len(content))}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def json(self):
+        return json.loads(self.content)
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+
+class Session:
+    def __init__(self, responses):
+        self.responses = list(responses)
+
+    def get(self, link, **kwargs):
+        return self.responses.pop(0)
+
+
+def test_transient_server_errors_are_retried(tmp_path):
+    output_file = str(tmp_path / 'a.tif')
+    session = Session([
+        Response(503, reason='Service Unavailable'),
+        Response(502, reason='Bad Gateway'),
+        Response(200, b'0123456789')
+    ])
+    status, n_bytes = download.stream_to_file(session, 'https://x/a.tif',
+                                              output_file, 4, retry_wait=0)
+    assert (status, n_bytes) == (200, 10)
+    assert open(output_file, 'rb').read() == b'0123456789'
+
+
+def test_failure_reasons_are_named(tmp_path):
+    output_file = str(tmp_path / 'a.tif')
+    session = Session([Response(503, reason='Service Unavailable')] * 4)
+    status, n_bytes = download.stream_to_file(session, 'https://x/a.tif',
+                                              output_file, 4, retry_wait=0)
+    assert status == 'HTTP 503 Service Unavailable after 3 retries'
+
+    session = Session([Response(404, reason='Not Found')])
+    status, n_bytes = download.stream_to_file(session, 'https://x/a.tif',
+                                              output_file, 4)
+    assert status == 'HTTP 404 Not Found'
+
+    session = Session([Response(200, b'0123456789')])
+    status, n_bytes = download.stream_to_file(session, 'https://x/a.tif',
+                                              output_file, 4,
+                                              (10, 'ABC123', 'MD5'))
+    assert status.startswith('checksum mismatch (MD5 ')
+    assert status.endswith(', expected abc123)')
+    assert not (tmp_path / 'a.tif.part').exists()
+
+
+def test_oversize_part_file_is_downloaded_again(tmp_path):
+    output_file = str(tmp_path / 'a.tif')
+    with open(output_file + '.part', 'wb') as f:
+        f.write(b'01234567890123456789')
+
+    session = Session([Response(200, b'0123456789')])
+    status, n_bytes = download.stream_to_file(session, 'https://x/a.tif',
+                                              output_file, 4,
+                                              (10, None, None))
+    assert (status, n_bytes) == (200, 10)
+    assert open(output_file, 'rb').read() == b'0123456789'
+    assert not (tmp_path / 'a.tif.part').exists()
+
+
+def test_oversize_download_is_not_kept(tmp_path):
+    output_file = str(tmp_path / 'a.tif')
+    session = Session([Response(200, b'0123456789')])
+    status, n_bytes = download.stream_to_file(session, 'https://x/a.tif',
+                                              output_file, 4,
+                                              (8, None, None))
+    assert status == 'size mismatch (10 of 8 bytes)'
+    assert not (tmp_path / 'a.tif.part').exists()
+
+
+def test_failed_searches_are_raised(monkeypatch):
+    responses = [
+        Response(400, b'{"errors": ["Invalid short_name"]}'),
+        Response(503, b'<html>Service Unavailable</html>')
+    ]
+    monkeypatch.setattr(download.requests, 'get',
+                        lambda url, headers=None: responses.pop(0))
+
+    with pytest.raises(requests.exceptions.HTTPError,
+                       match=r"HTTP 400: \['Invalid short_name'\]"):
+        download.get_response('https://cmr/granules.json')
+    with pytest.raises(requests.exceptions.HTTPError,
+                       match='HTTP 503$') as error:
+        download.get_response('https://cmr/granules.json')
+    assert error.value.response.status_code == 503
+
+
+def test_failed_folders_keep_their_shape(IC, cataloged, monkeypatch,
+                                         tmp_path):
+    def stream_to_file(session, link, output_file, chunk_size, info=None):
+        if link.endswith('bad.tif'):
+            return 'HTTP 404 Not Found', 0
+        return 200, 10
+
+    monkeypatch.setattr(download, 'stream_to_file', stream_to_file)
+    urls = [['2014', 'https://x/a.tif', 'https://x/bad.tif', 'https://x/a.xml'],
+            ['2015', 'https://x/c.tif']]
+    bad_folders = download.run_download_files(IC, urls, True)
+
+    assert bad_folders == [['2014', ['https://x/bad.tif']]]
+    with open(tmp_path / 'not_downloaded.txt') as f:
+        assert f.read() == "['2014', ['https://x/bad.tif']]\n"
+    assert sorted(cataloged) == [
+        str(tmp_path / '2014' / 'a.tif'),
+        str(tmp_path / '2015' / 'c.tif')
+    ]
+
+    # the failed folders can be downloaded again
+    assert download.download_nested_files(IC, bad_folders) == bad_folders
@@ -0,0 +1,96 @@
+import netCDF4 as nc
+import numpy as np
+import pytest
+
+import toolbox.store_nc as store
+from toolbox.filtering import filter_stack_by_seasonally_smoothing
+from toolbox.filtering import filter_stack_file
+
+seconds_per_year = 365.25 * 24 * 60 * 60
+
+
+def make_stack(n_y=5, n_x=4):
+    # a seasonal signal with noise, gaps and a few spikes, in decimal years
+    rng = np.random.default_rng(3)
+    time = np.sort(2015 + rng.uniform(0, 4, 40))
+    seasonal = np.sin(2 * np.pi * time)[:, None, None]
+    stack = 100 + 5 * seasonal + rng.normal(scale=0.5, size=(len(time), n_y,
+                                                             n_x))
+    stack[10, 1, 2] += 20
+    stack[25, 3, 0] -= 15
+    stack[rng.uniform(size=stack.shape) < 0.1] = np.nan
+    # a pixel without any values
+    stack[:, 4, 3] = np.nan
+    return time, stack
+
+
+def test_stack_filter_masks_spikes():
+    time, stack = make_stack()
+    mask = filter_stack_by_seasonally_smoothing(time, stack)
+
+    assert mask.shape == stack.shape
+    assert mask[10, 1, 2] and mask[25, 3, 0]
+    # the gaps are never filtered out
+    assert not np.any(mask[np.isnan(stack)])
+    assert not np.any(mask[:, 4, 3])
+
+    # the pixels are filtered independently of the blocks
+    assert np.array_equal(
+        filter_stack_by_seasonally_smoothing(time, stack, pixels_per_block=3),
+        mask)
+    assert np.array_equal(
+        filter_stack_by_seasonally_smoothing(time, stack[:, 1:2, 2:3]),
+        mask[:, 1:2, 2:3])
+
+
+def write_netcdf_stack(path, time, stack):
+    ds = nc.Dataset(path, 'w')
+    ds.createDimension('time', len(time))
+    ds.createDimension('y', stack.shape[1])
+    ds.createDimension('x', stack.shape[2])
+    # the MEaSUREs stacks store the start and end of each epoch
+    ds.createVariable('time_start', 'f8', ('time', ))[:] = (
+        time - 1970 - 0.01) * seconds_per_year
+    ds.createVariable('time_end', 'f8', ('time', ))[:] = (
+        time - 1970 + 0.01) * seconds_per_year
+    ds.createVariable('v', 'f4', ('time', 'y', 'x'),
+                      fill_value=-9999.)[:] = np.ma.masked_invalid(stack)
+    ds.close()
+
+
+def write_zarr_stack(path, time, stack):
+    ds = store.write_zarr_stack(path, {
+        'x': np.arange(stack.shape[2]),
+        'y': np.arange(stack.shape[1])
+    }, {'time': (time - 1970) * seconds_per_year}, {'v': stack}, {},
+                                'timeseries')
+    ds.close()
+
+
+@pytest.mark.parametrize('backend', ['netcdf', 'zarr'])
+def test_filter_stack_file(tmp_path, backend):
+    time, stack = make_stack()
+    path = str(tmp_path / ('stack' + store.storage_backends[backend]))
+    if backend == 'netcdf':
+        write_netcdf_stack(path, time, stack)
+    else:
+        write_zarr_stack(path, time, stack)
+
+    # the blocks of rows do not divide the rows
+    filter_stack_file(path, ['v'], rows_per_block=2)
+
+    ds = store.open_stack(path)
+    mask = np.array(ds.variables['v_mask'][:])
+    dimensions = store.variable_dimensions(ds.variables['v_mask'])
+    ds.close()
+
+    assert mask.dtype == np.uint8
+    assert dimensions == ('time', 'y', 'x')
+    expected = filter_stack_by_seasonally_smoothing(time, stack)
+    assert np.array_equal(mask, expected.astype('u1'))
+
+    # filtering again reuses the mask variable
+    filter_stack_file(path, ['v'])
+    ds = store.open_stack(path)
+    assert np.array_equal(ds.variables['v_mask'][:], mask)
+    ds.close()
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+import toolbox.grid_generation as gg
+
+
+@pytest.fixture
+def grid():
+    return gg.GridIndex(-100., 50., 10., 3, 4)
+
+
+def plain_dict(grid):
+    return {cell_ID: grid[cell_ID] for cell_ID in grid}
+
+
+def test_grid_index_is_a_mapping_of_the_cells(grid):
+    assert len(grid) == 12
+    assert list(grid)[:5] == [
+        'r_00_c_00', 'r_00_c_01', 'r_00_c_02', 'r_00_c_03', 'r_01_c_00'
+    ]
+    assert grid['r_02_c_03'] == [-70., 70., -60., 80.]
+    assert grid.get('r_03_c_00') is None
+    assert dict(grid) == plain_dict(grid)
+
+
+@pytest.mark.parametrize('cell_ID', [
+    'r_3_c_1', 'r_02_c_3', 'r_002_c_03', 'r_-1_c_00', 'r_03_c_00', 'r_aa_c_00',
+    'r_00', 'x_00_c_00', 3
+])
+def test_non_canonical_IDs_are_not_keys(grid, cell_ID):
+    assert cell_ID not in grid
+    assert cell_ID not in plain_dict(grid)
+    with pytest.raises(KeyError):
+        grid[cell_ID]
+
+
+def test_points_to_rows_cols(grid):
+    rows, cols = grid.points_to_rows_cols([-95., -61., -101., -80.],
+                                          [51., 79., 60., 80.])
+    np.testing.assert_array_equal(rows, [0, 2, -1, -1])
+    np.testing.assert_array_equal(cols, [0, 3, -1, -1])
+
+
+def test_shapefile_cells_from_a_grid_index_or_a_dict(grid):
+    cell_IDs, bounds = gg.grid_cells_by_col(grid)
+    assert cell_IDs[:4] == ['r_00_c_00', 'r_01_c_00', 'r_02_c_00', 'r_00_c_01']
+    assert bounds == [grid[cell_ID] for cell_ID in cell_IDs]
+
+    assert gg.grid_cells_by_col(plain_dict(grid)) == (cell_IDs, bounds)
@@ -0,0 +1,68 @@
+import os
+import types
+
+import pytest
+
+import toolbox.catalog as catalog
+import toolbox.memory as memory
+
+
+@pytest.fixture
+def IC(tmp_path):
+    os.makedirs(tmp_path / 'downloads')
+    return types.SimpleNamespace(data_folder=str(tmp_path),
+                                 download_path=str(tmp_path / 'downloads'),
+                                 short_name='MEaSUREs Test',
+                                 data_type='Velocity',
+                                 posting=500.,
+                                 memory_budget=None,
+                                 working_dtype='float32',
+                                 print_sub_outputs=False,
+                                 output_summary='')
+
+
+def add_mosaic(IC, monkeypatch, transform):
+    # catalog a mosaic with the geotransform, as read with GDAL
+    monkeypatch.setattr(catalog, 'read_geotransform',
+                        lambda file_path: ','.join([repr(t) for t in transform]))
+    file_path = os.path.join(IC.download_path,
+                             'GL_vel_mosaic_Monthly_01Dec14_31Dec14_vx_v05.0.tif')
+    with open(file_path, 'wb') as f:
+        f.write(b'0')
+    catalog.add_files(IC, [file_path])
+
+
+def test_velocity_cells_are_counted_at_native_resolution(IC, monkeypatch):
+    extents = [0., 0., 10000., 5000.]
+    # without a cataloged mosaic the cell is counted at the posting
+    assert memory.cell_pixels(IC, extents) == 21 * 11
+
+    # 200 m mosaic with its origin at the top left, as GeoTIFFs are stored
+    add_mosaic(IC, monkeypatch, (-50000., 200., 0., 50000., 0., -200.))
+    assert memory.cell_pixels(IC, extents) == 51 * 26
+    assert memory.estimate_epoch_memory(IC, extents) == 10 * 51 * 26 * 4
+
+    # a cell outside of the mosaic falls back to the posting
+    assert memory.cell_pixels(IC, [-90000., 0., -80000., 5000.]) == 21 * 11
+
+
+def test_elevation_cells_are_counted_at_the_posting(IC, monkeypatch):
+    IC.data_type = 'Elevation'
+    add_mosaic(IC, monkeypatch, (-50000., 200., 0., 50000., 0., -200.))
+    assert memory.cell_pixels(IC, [0., 0., 10000., 5000.]) == 21 * 11
+
+
+def test_preflight(IC, capsys):
+    extents = [0., 0., 10000., 5000.]
+    per_epoch = memory.estimate_epoch_memory(IC, extents)
+
+    IC.memory_budget = 10 * per_epoch
+    assert memory.preflight(IC, extents, 4) == 4
+    assert memory.preflight(IC, extents, 25) == 10
+    IC.memory_budget = per_epoch // 2
+    assert memory.preflight(IC, extents, 4) == 0
+    assert 'Error' in capsys.readouterr().out
+
+    # nothing to do is not an error
+    assert memory.preflight(IC, extents, 0) == 0
+    assert capsys.readouterr().out == ''
@@ -0,0 +1,140 @@
+import os
+import types
+
+import netCDF4 as nc
+import numpy as np
+import pytest
+
+import toolbox.grid_generation as gg
+import toolbox.mosaic as mosaic
+import toolbox.store_nc as store
+
+
+def write_cell_stack(path, x, y, t, values, descending_y=False):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if descending_y:
+        y = y[::-1]
+        values = values[:, ::-1, :]
+    ds = nc.Dataset(path, 'w')
+    ds.createDimension('time', len(t))
+    ds.createDimension('y', len(y))
+    ds.createDimension('x', len(x))
+    ds.createVariable('time', 'f4', ('time', ))[:] = t
+    ds.createVariable('x', 'f8', ('x', ))[:] = x
+    ds.createVariable('y', 'f8', ('y', ))[:] = y
+    ds.createVariable('h', 'f4', ('time', 'y', 'x'))[:] = values
+    ds.close()
+
+
+@pytest.fixture
+def cells(tmp_path):
+    # Two 1 km cells side by side with 250 m pixels. The left one holds the
+    # epochs 1, 2, 3 and the right one, stored from the top row down, holds
+    # the epochs 2, 4. Every value is 100 * epoch + 10 * row + col in the
+    # rows and cols of the mosaic.
+    grid = gg.GridIndex(0., 0., 1000., 1, 2)
+    IC = types.SimpleNamespace(short_name='ATL15 Test',
+                               icesheet_name='Test',
+                               data_type='elevation',
+                               nickname='Test',
+                               data_folder=str(tmp_path),
+                               posting=250.,
+                               grid_dict=grid,
+                               cells=['r_00_c_00', 'r_00_c_01'])
+    rows, cols = np.meshgrid(np.arange(4), np.arange(8), indexing='ij')
+    for cell_ID, t, col, descending_y in [('r_00_c_00', [1., 2., 3.], 0,
+                                           False),
+                                          ('r_00_c_01', [2., 4.], 4, True)]:
+        bounds = grid[cell_ID]
+        x = np.arange(bounds[0], bounds[2], 250.)
+        y = np.arange(bounds[1], bounds[3], 250.)
+        values = np.array([(100 * e + 10 * rows + cols)[:, col:col + 4]
+                           for e in t])
+        write_cell_stack(store.stack_path(IC, cell_ID, 'netcdf'), x, y,
+                         np.array(t), values, descending_y)
+    return IC
+
+
+def expected_block(t):
+    rows, cols = np.meshgrid(np.arange(4), np.arange(8), indexing='ij')
+    block = np.array([100 * e + 10 * rows + cols for e in t], dtype='f8')
+    if 1. in t or 3. in t:
+        block[[i for i, e in enumerate(t) if e in [1., 3.]], :, 4:] = np.nan
+    if 4. in t:
+        block[list(t).index(4.), :, :4] = np.nan
+    return block
+
+
+def test_time_axis_is_the_union_of_the_cells(cells):
+    m = mosaic.build_virtual_mosaic(cells)
+    np.testing.assert_array_equal(m.t, [1., 2., 3., 4.])
+    assert m.shape == (4, 4, 8)
+    np.testing.assert_array_equal(m.read('h'), expected_block(m.t))
+    np.testing.assert_array_equal(m.read('h', slice(1, 4, 2)),
+                                  expected_block([2., 4.]))
+
+
+def test_saved_mosaic_reads_the_same(cells, tmp_path):
+    m = mosaic.save_virtual_mosaic(cells)
+    loaded = mosaic.load_virtual_mosaic(
+        os.path.join(tmp_path, 'Output', 'Test', 'Elevation',
+                     'Test_mosaic.json'))
+    np.testing.assert_array_equal(loaded.t, m.t)
+    np.testing.assert_array_equal(loaded.read('h'), m.read('h'))
+
+
+def test_read_window(cells):
+    m = mosaic.build_virtual_mosaic(cells)
+    x, y, block = m.read_window('h', [500., 250., 1250., 500.])
+    np.testing.assert_array_equal(x, [500., 750., 1000., 1250.])
+    np.testing.assert_array_equal(y, [250., 500.])
+    np.testing.assert_array_equal(block, expected_block(m.t)[:, 1:3, 2:6])
+
+
+def test_read_point(cells):
+    m = mosaic.build_virtual_mosaic(cells)
+    np.testing.assert_array_equal(m.read_point('h', 1260., 560.),
+                                  [np.nan, 225., np.nan, 425.])
+    np.testing.assert_array_equal(m.read_point('h', 10., 10., slice(0, 2)),
+                                  [100., 200.])
+
+
+def test_out_of_bounds_reads_are_no_data(cells):
+    m = mosaic.build_virtual_mosaic(cells, no_data_value=-99.)
+    series = m.read_point('h', 5000., 500.)
+    np.testing.assert_array_equal(series, np.full(4, -99.))
+    series = m.read_point('h', 500., -500.)
+    np.testing.assert_array_equal(series, np.full(4, -99.))
+
+    x, y, block = m.read_window('h', [5000., 5000., 6000., 6000.])
+    assert block.shape == (4, 0, 0)
+    x, y, block = m.read_window('h', [500., 5000., 600., 6000.], slice(0, 2))
+    assert block.shape == (2, 0, 1)
+
+    # the pixels of the mosaic without an epoch of their cell are no data
+    np.testing.assert_array_equal(m.read('h', slice(3, 4), slice(0, 1),
+                                         slice(0, 4)),
+                                  np.full((1, 1, 4), -99.))
+
+
+@pytest.mark.parametrize('t', [slice(None, None, -1), slice(3, 0, -2)])
+def test_reversed_time_steps_are_rejected(cells, t):
+    m = mosaic.build_virtual_mosaic(cells)
+    with pytest.raises(ValueError):
+        m.read('h', t)
+
+
+def test_blocks_are_read_as_the_working_dtype(cells, tmp_path):
+    m = mosaic.build_virtual_mosaic(cells, no_data_value=-99.)
+    assert m.read('h').dtype == np.float32
+    assert m.read_point('h', 5000., 500.).dtype == np.float32
+    assert m.read_window('h', [5000., 5000., 6000., 6000.])[2].dtype == (
+        np.float32)
+
+    cells.working_dtype = 'float64'
+    m = mosaic.save_virtual_mosaic(cells)
+    loaded = mosaic.load_virtual_mosaic(
+        os.path.join(tmp_path, 'Output', 'Test', 'Elevation',
+                     'Test_mosaic.json'))
+    assert loaded.read('h').dtype == np.float64
+    np.testing.assert_array_equal(loaded.read('h'), expected_block(m.t))
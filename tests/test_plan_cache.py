@@ -0,0 +1,60 @@
+import types
+
+import numpy as np
+import pytest
+
+import toolbox.memory as memory
+import toolbox.resample.plan_cache as plan_cache
+
+
+@pytest.fixture(autouse=True)
+def empty_session(monkeypatch):
+    monkeypatch.setattr(plan_cache, 'session_plans',
+                        plan_cache.collections.OrderedDict())
+    monkeypatch.setattr(plan_cache, 'session_bytes', 0)
+
+
+def plan(n):
+    # a plan of 8 * n bytes
+    return {'weights': np.zeros(n)}
+
+
+def test_session_plans_are_limited_by_their_size():
+    for key in ['a', 'b', 'c']:
+        plan_cache.remember_plan(key, plan(100), max_session_bytes=2000)
+    assert list(plan_cache.session_plans) == ['b', 'c']
+    assert plan_cache.session_bytes == 1600
+
+    # a plan which is used again is kept over older ones
+    assert plan_cache.load_plan(None, 'b', 2000) is not None
+    plan_cache.remember_plan('d', plan(100), max_session_bytes=2000)
+    assert list(plan_cache.session_plans) == ['b', 'd']
+
+
+def test_plan_larger_than_the_limit_is_not_kept(tmp_path):
+    built = []
+
+    def build_plan():
+        built.append(1)
+        return plan(1000)
+
+    for i in range(2):
+        p = plan_cache.get_plan(None, 'big', build_plan, max_session_bytes=100)
+        assert p['weights'].shape == (1000, )
+    assert len(built) == 2
+    assert plan_cache.session_bytes == 0
+
+    # it is still read back from the plan folder
+    plan_cache.get_plan(str(tmp_path), 'big', build_plan,
+                        max_session_bytes=100)
+    plan_cache.get_plan(str(tmp_path), 'big', build_plan,
+                        max_session_bytes=100)
+    assert len(built) == 3
+
+
+def test_plan_memory_follows_the_budget():
+    IC = types.SimpleNamespace(plan_cache_size=2 * 1024**3,
+                               memory_budget=1024**3)
+    assert memory.plan_memory(IC) == 1024**3 // 8
+    IC.memory_budget = 64 * 1024**3
+    assert memory.plan_memory(IC) == 2 * 1024**3
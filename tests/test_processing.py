@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+import toolbox.IcesheetCHANGES as ic
+import toolbox.grid_generation as gg
+import toolbox.memory as memory
+import toolbox.processing as processing
+import toolbox.store_nc as store
+
+
+@pytest.fixture
+def velocity_IC(tmp_path):
+    # a Greenland velocity configuration without any downloaded files
+    folder = str(tmp_path)
+    IC = ic.GreenlandCHANGES(folder, folder)
+    IC.collection_info('MEaSUREs Greenland Monthly Velocity')
+    IC.grid_dict = gg.generate_grid_dictionary(*gg.grid_bounds('Greenland'),
+                                               IC.velocity_grid_posting)
+    IC.cells = ['r_10_c_10', 'r_10_c_11']
+    IC.incremental_update = True
+    IC.memory_budget = 2 * 1024**3
+    os.makedirs(IC.download_path, exist_ok=True)
+    return IC
+
+
+def test_cell_errors_are_returned(velocity_IC):
+    IC = velocity_IC
+    # the existing stack of one cell cannot be opened
+    broken_file = store.stack_path(IC, 'r_10_c_11')
+    os.makedirs(os.path.dirname(broken_file), exist_ok=True)
+    with open(broken_file, 'w') as f:
+        f.write('not a netCDF file')
+
+    results = processing.run_cells(IC, n_workers=2)
+
+    assert sorted(results) == IC.cells
+    assert results['r_10_c_11'].error.startswith('OSError')
+    # the other cell is still processed (there are no files to add)
+    assert results['r_10_c_10'].error is None
+    assert results['r_10_c_10'].output_file is None
+
+
+def test_worker_errors_are_returned(velocity_IC):
+    # the workers cannot rebuild the configuration of the jobs
+    IC = velocity_IC
+    IC.icesheet_name = 'Arctic'
+
+    results = processing.run_cells(IC, n_workers=2)
+
+    assert sorted(results) == IC.cells
+    for cell_ID in IC.cells:
+        assert results[cell_ID].error == (
+            'ValueError: Icesheet not recognized: Arctic')
+        assert results[cell_ID].output_file is None
+
+
+def test_pool_size_respects_memory_budget(velocity_IC):
+    IC = velocity_IC
+    IC.cells = ['r_10_c_' + str(c) for c in range(10, 15)]
+    jobs = processing.build_cell_jobs(IC)
+    cell_memory = memory.estimate_cell_memory(IC, jobs[0].extents,
+                                              processing.count_epochs(IC))
+
+    IC.memory_budget = int(2.5 * cell_memory)
+    assert processing.pool_size(IC, jobs, n_workers=8) == 2
+    assert processing.pool_size(IC, jobs, n_workers=1) == 1
+
+    # a cell larger than the budget is still run, in batches of epochs
+    IC.memory_budget = cell_memory // 2
+    assert processing.pool_size(IC, jobs, n_workers=8) == 1
+
+    # the pool is never larger than the number of jobs
+    IC.memory_budget = 100 * cell_memory
+    assert processing.pool_size(IC, jobs, n_workers=8) == len(jobs)
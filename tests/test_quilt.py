@@ -0,0 +1,142 @@
+import os
+import types
+
+import netCDF4 as nc
+import numpy as np
+import pytest
+
+import toolbox.grid_generation as gg
+import toolbox.store_nc as store
+
+
+def write_cell_stack(path, x, y, t, values, descending_y=False):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if descending_y:
+        y = y[::-1]
+        values = values[:, ::-1, :]
+    ds = nc.Dataset(path, 'w')
+    ds.createDimension('time', len(t))
+    ds.createDimension('y', len(y))
+    ds.createDimension('x', len(x))
+    ds.createVariable('time', 'f4', ('time', ))[:] = t
+    ds.createVariable('x', 'f8', ('x', ))[:] = x
+    ds.createVariable('y', 'f8', ('y', ))[:] = y
+    ds.createVariable('h', 'f4', ('time', 'y', 'x'), fill_value=-9999.)[:] = values
+    ds.close()
+
+
+def make_cells(tmp_path, cell_pixel, descending_y=False):
+    # a 2 x 3 grid of 1 km cells, of which 5 are stored
+    grid = gg.GridIndex(0., 0., 1000., 2, 3)
+    IC = types.SimpleNamespace(short_name='ATL15 Test',
+                               icesheet_name='Test',
+                               data_type='elevation',
+                               nickname='Test',
+                               data_folder=str(tmp_path),
+                               elevation_grid_posting=250.,
+                               grid_dict=grid,
+                               cells=[])
+    t = np.array([1., 2., 3.])
+    rng = np.random.default_rng(1)
+    paths = {}
+    for row, col in [(0, 0), (0, 1), (0, 2), (1, 0), (1, 2)]:
+        cell_ID = gg.cell_ID_from_row_col(row, col)
+        bounds = grid[cell_ID]
+        x = np.arange(bounds[0], bounds[2], cell_pixel)
+        y = np.arange(bounds[1], bounds[3], cell_pixel)
+        values = rng.normal(size=(len(t), len(y), len(x)))
+        values[:, 0, 0] = np.nan
+        paths[cell_ID] = store.stack_path(IC, cell_ID, 'netcdf')
+        write_cell_stack(paths[cell_ID], x, y, t, values, descending_y)
+        IC.cells.append(cell_ID)
+    return IC, paths
+
+
+@pytest.mark.parametrize('cell_pixel', [250., 100.])
+@pytest.mark.parametrize('descending_y', [False, True])
+def test_in_memory_and_streamed_quilts_are_equal(tmp_path, cell_pixel,
+                                                 descending_y):
+    # the cell pixels are 250 m or 100 m, the quilt is always at 250 m
+    IC, paths = make_cells(tmp_path, cell_pixel, descending_y)
+
+    t, x, y, main_grid = gg.quilt_grids_by_path(IC, paths, 'h', 250.,
+                                                no_data_value='nan')
+    output_file = gg.stream_quilt_grids_by_path(IC, paths, ['h'], 250.,
+                                                str(tmp_path / 'quilt.nc'),
+                                                no_data_value='nan')
+    ds = nc.Dataset(output_file)
+    streamed = np.ma.filled(ds.variables['h'][:], np.nan)
+    ds.close()
+
+    assert main_grid.shape == streamed.shape == (3, len(y), len(x))
+    np.testing.assert_array_equal(main_grid, streamed.astype(main_grid.dtype))
+
+
+def test_cells_are_placed_by_their_coordinates(tmp_path):
+    IC, paths = make_cells(tmp_path, 250., descending_y=True)
+    t, x, y, main_grid = gg.quilt_grids_by_path(IC, paths, 'h', 250.,
+                                                no_data_value='nan')
+
+    ds = nc.Dataset(paths['r_01_c_02'])
+    cell = np.ma.filled(ds.variables['h'][:], np.nan)[:, ::-1, :]
+    ds.close()
+    np.testing.assert_array_equal(main_grid[:, 4:8, 8:12],
+                                  cell.astype(main_grid.dtype))
+    # the cell which is not stored stays no data
+    assert np.all(np.isnan(main_grid[:, 4:8, 4:8]))
+
+
+def test_quilt_over_the_memory_budget_is_refused(tmp_path):
+    IC, paths = make_cells(tmp_path, 250.)
+    IC.memory_budget = 1000
+
+    assert gg.quilt_grids_and_output(IC, 'h', no_data_value='nan') is None
+    assert not os.path.exists(
+        os.path.join(tmp_path, 'Output', 'Test', 'Elevation'))
+
+    # the caller can opt into streaming the quilt to disk
+    output_file = gg.quilt_grids_and_output(IC, ['h'],
+                                            no_data_value='nan',
+                                            streaming=True)
+    assert output_file.endswith('Test_stack.nc')
+    assert os.path.exists(output_file)
+
+
+@pytest.mark.parametrize('streamed', [False, True])
+def test_cells_with_different_epochs(tmp_path, streamed):
+    # the left cell holds the epochs 1, 2, 3 and the right one 2, 4
+    grid = gg.GridIndex(0., 0., 1000., 1, 2)
+    IC = types.SimpleNamespace(short_name='ATL15 Test',
+                               icesheet_name='Test',
+                               data_type='elevation',
+                               nickname='Test',
+                               data_folder=str(tmp_path),
+                               grid_dict=grid,
+                               cells=['r_00_c_00', 'r_00_c_01'])
+    paths = {}
+    for cell_ID, t in [('r_00_c_00', [1., 2., 3.]), ('r_00_c_01', [2., 4.])]:
+        bounds = grid[cell_ID]
+        x = np.arange(bounds[0], bounds[2], 250.)
+        y = np.arange(bounds[1], bounds[3], 250.)
+        values = np.array([np.full((4, 4), e) for e in t])
+        paths[cell_ID] = store.stack_path(IC, cell_ID, 'netcdf')
+        write_cell_stack(paths[cell_ID], x, y, np.array(t), values)
+
+    assert gg.estimate_quilt_memory(IC, paths, 250.) == (
+        gg.memory.estimate_quilt_memory(IC, 4, 4, 8))
+    if streamed:
+        output_file = gg.stream_quilt_grids_by_path(
+            IC, paths, ['h'], 250., str(tmp_path / 'quilt.nc'),
+            no_data_value='nan', time_chunk=2)
+        ds = nc.Dataset(output_file)
+        t = ds.variables['t'][:]
+        quilt = np.ma.filled(ds.variables['h'][:], np.nan)
+        ds.close()
+    else:
+        t, x, y, quilt = gg.quilt_grids_by_path(IC, paths, 'h', 250.,
+                                                no_data_value='nan')
+
+    np.testing.assert_array_equal(t, [1., 2., 3., 4.])
+    assert quilt.shape == (4, 4, 8)
+    np.testing.assert_array_equal(quilt[:, 0, 0], [1., 2., 3., np.nan])
+    np.testing.assert_array_equal(quilt[:, 0, 4], [np.nan, 2., np.nan, 4.])
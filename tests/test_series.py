@@ -0,0 +1,144 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from toolbox.series import series_to_N_points, sliding_average
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Reference copies of the loop implementations which the vectorized
+# kernels replaced
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def reference_series_to_N_points(series,N):
+    #find the total length of the series
+    totalDistance=0
+    for s in range(len(series[:,0])-1):
+        totalDistance+=((series[s,0]-series[s+1,0])**2+(series[s,1]-series[s+1,1])**2)**0.5
+    intervalDistance=totalDistance/(N-1)
+
+    #make the list of points
+    newSeries=series[0,:]
+    currentS = 0
+    currentPoint1=series[currentS,:]
+    currentPoint2=series[currentS+1,:]
+    for p in range(N-2):
+        distanceAccrued = 0
+        while distanceAccrued<intervalDistance:
+            currentLineDistance=((currentPoint1[0]-currentPoint2[0])**2+(currentPoint1[1]-currentPoint2[1])**2)**0.5
+            if currentLineDistance<intervalDistance-distanceAccrued:
+                distanceAccrued+=currentLineDistance
+                currentS+=1
+                currentPoint1 = series[currentS, :]
+                currentPoint2 = series[currentS + 1, :]
+            else:
+                distance=intervalDistance-distanceAccrued
+                newX=currentPoint1[0]+(distance/currentLineDistance)*(currentPoint2[0]-currentPoint1[0])
+                newY = currentPoint1[1] + (distance / currentLineDistance) * (currentPoint2[1] - currentPoint1[1])
+                distanceAccrued=intervalDistance+1
+                newSeries=np.vstack([newSeries,np.array([newX,newY])])
+                currentPoint1=np.array([newX,newY])
+    newSeries = np.vstack([newSeries, series[-1,:]])
+    return(newSeries)
+
+
+def reference_sliding_average(series,N):
+    if N%2==0:
+        N+=1
+    averagedSeries=np.zeros_like(series)
+    averagedSeries[:,0]=series[:,0]
+    for i in range(len(series)):
+        minIndex=int(np.max([0,i-(N-1)/2]))
+        maxIndex=int(np.min([len(series),i+(N-1)/2]))
+        with warnings.catch_warnings():
+            # windows of N=1 are empty and average to nan
+            warnings.simplefilter('ignore', RuntimeWarning)
+            averagedSeries[i,1]=np.mean(series[minIndex:maxIndex,1])
+    return(averagedSeries)
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# series_to_N_points
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def random_polyline(n_points, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.cumsum(rng.normal(size=(n_points, 2)), axis=0)
+
+
+@pytest.mark.parametrize('n_points', [2, 3, 10, 200])
+@pytest.mark.parametrize('N', [2, 3, 4, 7, 50, 401])
+def test_series_to_N_points_matches_reference(n_points, N):
+    series = random_polyline(n_points)
+    expected = reference_series_to_N_points(series, N)
+    result = series_to_N_points(series, N)
+    assert result.shape == expected.shape
+    np.testing.assert_allclose(result, expected, atol=1e-9)
+
+
+@pytest.mark.parametrize('N', [3, 8, 25])
+def test_series_to_N_points_duplicate_points(N):
+    # repeated points are segments without any length
+    series = random_polyline(12, seed=1)
+    series = np.insert(series, [3, 3, 7], series[[3, 3, 7]], axis=0)
+    expected = reference_series_to_N_points(series, N)
+    result = series_to_N_points(series, N)
+    assert result.shape == expected.shape
+    np.testing.assert_allclose(result, expected, atol=1e-9)
+
+
+def test_series_to_N_points_straight_line():
+    series = np.array([[0., 0.], [10., 0.]])
+    result = series_to_N_points(series, 11)
+    np.testing.assert_allclose(result[:, 0], np.arange(11))
+    np.testing.assert_allclose(result[:, 1], 0)
+
+
+@pytest.mark.parametrize('N', [2, 5, 25])
+def test_series_to_N_points_zero_length(N):
+    # a polyline which does not go anywhere keeps only its end points
+    series = np.array([[1., 2.], [1., 2.], [1., 2.]])
+    expected = reference_series_to_N_points(series, N)
+    result = series_to_N_points(series, N)
+    assert result.shape == expected.shape == (2, 2)
+    np.testing.assert_array_equal(result, expected)
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# sliding_average
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def random_timeseries(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.column_stack([np.arange(n) / 365.25,
+                            rng.normal(size=n) * 100 + 1000])
+
+
+@pytest.mark.parametrize('n', [1, 2, 5, 100, 730])
+@pytest.mark.parametrize('N', [1, 2, 3, 4, 90, 91, 365, 2000])
+def test_sliding_average_matches_reference(n, N):
+    # odd and even windows, and windows longer than the series
+    series = random_timeseries(n)
+    expected = reference_sliding_average(series, N)
+    result = sliding_average(series, N)
+    np.testing.assert_allclose(result, expected, atol=1e-8)
+
+
+@pytest.mark.parametrize('N', [3, 10, 91])
+def test_sliding_average_nan_windows(N):
+    # every window with a nan in it averages to nan
+    series = random_timeseries(300, seed=2)
+    series[[0, 40, 41, 150, 299], 1] = np.nan
+    expected = reference_sliding_average(series, N)
+    result = sliding_average(series, N)
+    np.testing.assert_array_equal(np.isnan(result), np.isnan(expected))
+    np.testing.assert_allclose(result, expected, atol=1e-8)
+
+
+def test_sliding_average_keeps_time():
+    series = random_timeseries(50)
+    np.testing.assert_array_equal(sliding_average(series, 5)[:, 0],
+                                  series[:, 0])
@@ -0,0 +1,70 @@
+import types
+
+import numpy as np
+import pytest
+
+import toolbox.grid_generation as gg
+
+
+@pytest.fixture
+def IC():
+    # a 10 x 10 grid of 1 m cells, so cell (row, col) covers
+    # [col, col + 1] x [row, row + 1]
+    return types.SimpleNamespace(epsg=3031,
+                                 grid_dict=gg.GridIndex(0., 0., 1., 10, 10))
+
+
+def cell_IDs(rows_cols):
+    return sorted([gg.cell_ID_from_row_col(r, c) for r, c in rows_cols])
+
+
+def test_concave_polygon(IC):
+    # a U with its notch over col 3 from row 3 up
+    polygon = np.array([[1.5, 1.5], [6.5, 1.5], [6.5, 6.5], [4.5, 6.5],
+                        [4.5, 2.5], [2.5, 2.5], [2.5, 6.5], [1.5, 6.5]])
+    expected = [(r, c) for r in range(1, 7) for c in range(1, 7)
+                if not (c == 3 and r >= 3)]
+    assert gg.cells_for_polygon(IC, polygon) == cell_IDs(expected)
+
+
+def test_multi_part_polygon_with_a_hole(IC):
+    outer = [[0.5, 0.5], [5.5, 0.5], [5.5, 5.5], [0.5, 5.5], [0.5, 0.5]]
+    hole = [[1.5, 1.5], [1.5, 4.5], [4.5, 4.5], [4.5, 1.5], [1.5, 1.5]]
+    island = [[7.2, 7.2], [8.8, 7.2], [8.8, 8.8], [7.2, 8.8]]
+    expected = [(r, c) for r in range(6) for c in range(6)
+                if not (r in [2, 3] and c in [2, 3])]
+    expected += [(7, 7), (7, 8), (8, 7), (8, 8)]
+    assert gg.cells_for_polygon(IC, [outer, hole, island]) == cell_IDs(
+        expected)
+
+
+def test_polygon_crossing_cell_corners(IC):
+    # the long edge runs through the corners (1, 4), (2, 3), (3, 2), (4, 1),
+    # so the cells which only touch it at a corner are left out
+    polygon = np.array([[0.5, 0.5], [4.5, 0.5], [0.5, 4.5]])
+    expected = [(r, c) for r in range(5) for c in range(5) if r + c <= 4]
+    assert gg.cells_for_polygon(IC, polygon) == cell_IDs(expected)
+
+
+def test_polygon_within_one_cell(IC):
+    polygon = np.array([[2.2, 3.2], [2.8, 3.2], [2.5, 3.8]])
+    assert gg.cells_for_polygon(IC, polygon) == ['r_03_c_02']
+
+
+def test_points_in_rings_in_chunks():
+    ring = np.array([[0., 0.], [4., 0.], [4., 4.], [2., 1.], [0., 4.],
+                     [0., 0.]])
+    x, y = np.meshgrid(np.linspace(-1, 5, 61), np.linspace(-1, 5, 61))
+    inside = gg.points_in_rings(x, y, [ring])
+    np.testing.assert_array_equal(
+        gg.points_in_rings(x, y, [ring], chunk_size=7), inside)
+    assert inside[np.argmin(np.abs(x.ravel() - 1) + np.abs(y.ravel() - 0.5))]
+    assert not inside[np.argmin(
+        np.abs(x.ravel() - 2) + np.abs(y.ravel() - 3))]
+
+
+def test_cells_for_points(IC):
+    assert gg.cells_for_points(IC, [0.5, 9.5, 11., 0.7],
+                               [0.5, 2.5, 1., 0.2]) == [
+                                   'r_00_c_00', 'r_02_c_09'
+                               ]
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+import toolbox.store_nc as store
+
+
+def write_stack(tmp_path, profile, grid_chunks=None):
+    path = str(tmp_path / 'stack.zarr')
+    x = np.arange(0., 5000., 100.)
+    y = np.arange(0., 4000., 100.)
+    t = np.array([10., 20., 30.])
+    v = np.random.default_rng(0).normal(size=(len(t), len(y), len(x)))
+    ds = store.write_zarr_stack(path, {
+        'x': x,
+        'y': y
+    }, {'time': t}, {
+        'v': v,
+        'v_err': (len(t), len(y), len(x))
+    }, {'title': 'Test stack'},
+                                profile,
+                                no_data_value=-9999.,
+                                grid_chunks=grid_chunks)
+    ds.close()
+    return path, x, y, t, v
+
+
+@pytest.mark.parametrize('profile', ['timeseries', 'maps', 'uncompressed'])
+def test_write_zarr_stack(tmp_path, profile):
+    path, x, y, t, v = write_stack(tmp_path, profile)
+
+    assert store.is_zarr(path)
+    ds = store.open_stack(path)
+    assert ds.title == 'Test stack'
+    assert ds.output_profile == profile
+    assert np.array_equal(ds.variables['x'][:], x)
+    assert np.array_equal(ds.variables['y'][:], y)
+    assert np.array_equal(ds.variables['time'][:], t)
+    assert store.variable_dimensions(ds.variables['time']) == ('time', )
+    assert store.variable_dimensions(ds.variables['v']) == ('time', 'y', 'x')
+
+    dtype = store.output_profiles[profile]['dtype']
+    assert ds.variables['v'].dtype == dtype
+    assert np.allclose(ds.variables['v'][:], v.astype(dtype))
+    # the grids given as a shape are empty
+    assert ds.variables['v_err'].shape == v.shape
+    assert np.all(ds.variables['v_err'][:] == -9999.)
+
+    chunks = store.profile_chunks(profile, v.shape)
+    if chunks is None:
+        chunks = v.shape
+    assert ds.variables['v'].chunks == chunks
+    ds.close()
+
+
+def test_write_zarr_stack_chunks(tmp_path):
+    path, x, y, t, v = write_stack(tmp_path, 'timeseries', (1, 16, 16))
+
+    ds = store.open_stack(path, 'a')
+    assert ds.variables['v'].chunks == (1, 16, 16)
+    assert np.allclose(ds.variables['v'][:], v)
+
+    # the stack grows along the time dimension
+    store.write_records(ds.variables['v'], 3, v[:1] + 1)
+    assert ds.variables['v'].shape == (4, len(y), len(x))
+    assert np.allclose(ds.variables['v'][3], v[0] + 1)
+
+    mask = store.add_mask_variable(ds, 'v_mask', 'v', 'timeseries')
+    assert mask.dtype == np.uint8
+    assert mask.shape == (4, len(y), len(x))
+    assert store.variable_dimensions(mask) == ('time', 'y', 'x')
+    ds.close()
+
+
+def test_write_zarr_stack_replaces_the_stack(tmp_path):
+    write_stack(tmp_path, 'maps')
+    path = str(tmp_path / 'stack.zarr')
+    ds = store.write_zarr_stack(path, {'x': [0.], 'y': [0.]}, {'time': [1.]},
+                                {'h': np.ones((1, 1, 1))}, {}, 'maps')
+    assert sorted(ds.variables) == ['h', 'time', 'x', 'y']
+    ds.close()
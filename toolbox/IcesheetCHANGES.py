@@ -29,10 +29,42 @@ class IcesheetCHANGES:
 
         self.cells = []
 
+        self.granules = []
+
         self.output_summary = ""
 
         self.print_sub_outputs = True
 
+        # download engine settings (see toolbox.download.download_urls)
+        self.download_workers = 8
+        self.download_chunk_size = 1024 * 1024  # in bytes
+
+        # CMR search cache settings (see toolbox.cmr.search_granules)
+        self.cmr_cache_ttl = 24 * 3600  # in seconds
+        self.offline = False
+
+        # per-cell processing settings (see toolbox.processing.run_cells)
+        self.processing_workers = None  # defaults to the number of cores
+        self.memory_budget = None  # in bytes, defaults to half of the memory
+
+        # total size of the resampling plans kept in the data folder (see
+        # toolbox.resample.plan_cache)
+        self.plan_cache_size = 2 * 1024**3  # in bytes
+
+        # dtype of the stacks, interpolated slices and quilts in memory (see
+        # toolbox.memory)
+        self.working_dtype = 'float32'
+
+        # chunking and compression of the output files (see
+        # toolbox.store_nc.output_profiles)
+        self.output_profile = 'timeseries'
+        # 'netcdf' or 'zarr' (see toolbox.store_nc.storage_backends)
+        self.storage_backend = 'netcdf'
+
+        # add only the new epochs to existing stacks instead of skipping or
+        # rewriting them
+        self.incremental_update = False
+
     def print_attributes(self):
         print("Metadata path:\t", self.metadata_path)
         return
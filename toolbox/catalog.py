@@ -0,0 +1,274 @@
+import os
+import sqlite3
+import toolbox.measures as measures
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Local catalog of downloaded granules
+#
+# The catalog is a SQLite database stored in the data folder. Each row is
+# one downloaded file, keyed by its folder and file name, together with the
+# collection, the variable (vx, vy, ex, ey), the date pair, the size, the
+# checksum, the geotransform and the modification time of the file. Rows
+# are added as downloads complete, and a folder is only rescanned when its
+# modification time changes, so later stages query the catalog instead of
+# listing folders. Files which are about to be skipped as downloaded are
+# still checked against their cataloged size and modification time, since
+# rewriting a file in place does not change the time of its folder.
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# files in the download folders which are not granules
+ignored_suffixes = ['.part', '.txt', '.csv', '.sqlite']
+
+
+def catalog_path(IC):
+    return os.path.join(IC.data_folder, 'catalog.sqlite')
+
+
+def connect(IC):
+    if not os.path.exists(IC.data_folder):
+        os.makedirs(IC.data_folder)
+
+    connection = sqlite3.connect(catalog_path(IC))
+    connection.execute('''CREATE TABLE IF NOT EXISTS granules (
+                              folder TEXT NOT NULL,
+                              file_name TEXT NOT NULL,
+                              collection TEXT,
+                              variable TEXT,
+                              date_start TEXT,
+                              date_end TEXT,
+                              size INTEGER,
+                              checksum TEXT,
+                              geotransform TEXT,
+                              mtime REAL,
+                              PRIMARY KEY (folder, file_name))''')
+    # catalogs made before the mtime of the files was kept
+    columns = [
+        row[1] for row in connection.execute('PRAGMA table_info(granules)')
+    ]
+    if 'mtime' not in columns:
+        connection.execute('ALTER TABLE granules ADD COLUMN mtime REAL')
+    connection.execute('''CREATE INDEX IF NOT EXISTS granules_by_date
+                          ON granules (collection, date_start, date_end, variable)'''
+                       )
+    connection.execute('''CREATE TABLE IF NOT EXISTS folders (
+                              folder TEXT PRIMARY KEY,
+                              mtime REAL)''')
+    return connection
+
+
+def parse_file_name(file_name):
+    # Get the variable and date pair of a file from its name. MEaSUREs file
+    # names look like GL_vel_mosaic_Monthly_01Dec14_31Dec14_vx_v05.0.tif
+    variable = None
+    date_start = None
+    date_end = None
+    if file_name.endswith('.tif'):
+        variable = measures.measures_file_component(file_name)
+        # the file ID is the name up to the variable, whatever the length of
+        # the version suffix
+        file_ID = '_'.join(file_name.split('_')[:6])
+        try:
+            date_pair = measures.measures_fileID_to_date_pair(file_ID)
+            date_start, date_end = date_pair.split('-')
+        except (IndexError, KeyError, ValueError):
+            pass
+    return variable, date_start, date_end
+
+
+def read_geotransform(file_path):
+    # Read the geotransform from the header of a GeoTIFF (if GDAL is available)
+    if not file_path.endswith('.tif'):
+        return None
+    try:
+        from osgeo import gdal
+    except ImportError:
+        return None
+    ds = gdal.Open(file_path)
+    if ds is None:
+        return None
+    transform = ds.GetGeoTransform()
+    ds = None
+    return ','.join([repr(t) for t in transform])
+
+
+def add_file(connection, IC, file_path, checksum=None):
+    # Add (or update) a single file which has just been downloaded
+    folder, file_name = os.path.split(os.path.abspath(file_path))
+    variable, date_start, date_end = parse_file_name(file_name)
+    stat = os.stat(file_path)
+    connection.execute(
+        '''INSERT OR REPLACE INTO granules (folder, file_name, collection,
+           variable, date_start, date_end, size, checksum, geotransform, mtime)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+        (folder, file_name, IC.short_name, variable, date_start, date_end,
+         stat.st_size, checksum, read_geotransform(file_path), stat.st_mtime))
+
+
+def sync_folder(connection, IC, folder):
+    # Bring the catalog of a folder up to date with one scan of the folder,
+    # but only if the folder has changed since it was last scanned
+    folder = os.path.abspath(folder)
+    if not os.path.exists(folder):
+        return
+
+    mtime = os.stat(folder).st_mtime
+    row = connection.execute('SELECT mtime FROM folders WHERE folder = ?',
+                             (folder, )).fetchone()
+    if row is not None and row[0] == mtime:
+        return
+
+    cataloged = {}
+    for file_name, size, file_mtime in connection.execute(
+            'SELECT file_name, size, mtime FROM granules WHERE folder = ?',
+        (folder, )):
+        cataloged[file_name] = (size, file_mtime)
+
+    on_disk = set()
+    for entry in os.scandir(folder):
+        if not entry.is_file():
+            continue
+        if any([entry.name.endswith(s) for s in ignored_suffixes]):
+            continue
+        on_disk.add(entry.name)
+        stat = entry.stat()
+        if cataloged.get(entry.name) != (stat.st_size, stat.st_mtime):
+            add_file(connection, IC, entry.path)
+
+    # remove the files which were deleted from the folder
+    removed = [(folder, f) for f in cataloged if f not in on_disk]
+    connection.executemany(
+        'DELETE FROM granules WHERE folder = ? AND file_name = ?', removed)
+
+    connection.execute('INSERT OR REPLACE INTO folders VALUES (?, ?)',
+                       (folder, mtime))
+    connection.commit()
+
+
+def add_files(IC, file_paths, checksums=None):
+    # Add a batch of downloaded files to the catalog
+    if checksums is None:
+        checksums = [None] * len(file_paths)
+    connection = connect(IC)
+    for i in range(len(file_paths)):
+        add_file(connection, IC, file_paths[i], checksums[i])
+    connection.commit()
+    connection.close()
+
+
+def list_files(IC, folder=None, suffix=None, contains=None):
+    # List the cataloged file names in a folder (defaults to
+    # IC.download_path), optionally ending with suffix and containing every
+    # string in contains
+    if folder is None:
+        folder = IC.download_path
+    folder = os.path.abspath(folder)
+
+    connection = connect(IC)
+    sync_folder(connection, IC, folder)
+
+    query = 'SELECT file_name FROM granules WHERE folder = ?'
+    args = [folder]
+    if suffix is not None:
+        query += ' AND file_name LIKE ?'
+        args.append('%' + suffix)
+    if contains is not None:
+        for c in contains:
+            query += ' AND instr(file_name, ?) > 0'
+            args.append(c)
+    query += ' ORDER BY file_name'
+
+    file_names = [row[0] for row in connection.execute(query, args)]
+    connection.close()
+
+    return file_names
+
+
+def verify_files(connection, IC, folder, file_names=None):
+    # Check cataloged files (all of the files in the folder, or only
+    # file_names) against the size and modification time of the file on
+    # disk. Changed files are cataloged again and missing files are removed.
+    # Returns {file_name: size} of the verified files.
+    rows = connection.execute(
+        'SELECT file_name, size, mtime FROM granules WHERE folder = ?',
+        (folder, ))
+    if file_names is not None:
+        file_names = set(file_names)
+        rows = [row for row in rows if row[0] in file_names]
+
+    sizes = {}
+    for file_name, size, file_mtime in list(rows):
+        file_path = os.path.join(folder, file_name)
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            connection.execute(
+                'DELETE FROM granules WHERE folder = ? AND file_name = ?',
+                (folder, file_name))
+            continue
+        if (stat.st_size, stat.st_mtime) != (size, file_mtime):
+            add_file(connection, IC, file_path)
+        sizes[file_name] = stat.st_size
+    connection.commit()
+
+    return sizes
+
+
+def file_sizes(IC, folder=None, file_names=None):
+    # Get {file_name: size} for every cataloged file in a folder (or only
+    # for file_names). The files are checked against the disk, since they
+    # are skipped as already downloaded on the strength of these sizes.
+    if folder is None:
+        folder = IC.download_path
+    folder = os.path.abspath(folder)
+
+    connection = connect(IC)
+    sync_folder(connection, IC, folder)
+    sizes = verify_files(connection, IC, folder, file_names)
+    connection.close()
+
+    return sizes
+
+
+def measures_file_sets(IC, folder=None, date_pairs=None):
+    # Get {date_pair: {variable: file_name}} for the MEaSUREs files in a
+    # folder, optionally restricted to a list of date pairs
+    if folder is None:
+        folder = IC.download_path
+    folder = os.path.abspath(folder)
+
+    connection = connect(IC)
+    sync_folder(connection, IC, folder)
+
+    rows = connection.execute(
+        '''SELECT date_start, date_end, variable, file_name FROM granules
+           WHERE folder = ? AND variable IS NOT NULL AND date_start IS NOT NULL
+           ORDER BY date_start, date_end, file_name''', (folder, ))
+
+    file_sets = {}
+    for date_start, date_end, variable, file_name in rows:
+        date_pair = date_start + '-' + date_end
+        if date_pairs is not None and date_pair not in date_pairs:
+            continue
+        if date_pair not in file_sets:
+            file_sets[date_pair] = {}
+        file_sets[date_pair][variable] = file_name
+    connection.close()
+
+    return file_sets
+
+
+def get_geotransform(IC, file_name, folder=None):
+    # Get the cataloged geotransform of a file as a tuple (or None)
+    if folder is None:
+        folder = IC.download_path
+    folder = os.path.abspath(folder)
+
+    connection = connect(IC)
+    row = connection.execute(
+        'SELECT geotransform FROM granules WHERE folder = ? AND file_name = ?',
+        (folder, file_name)).fetchone()
+    connection.close()
+
+    if row is None or row[0] is None:
+        return None
+    return tuple([float(t) for t in row[0].split(',')])
@@ -0,0 +1,422 @@
+import os
+import json
+import math
+import time
+import hashlib
+import requests
+import datetime as dt
+import numpy as np
+import toolbox.reprojection as reprojection
+from concurrent.futures import ThreadPoolExecutor
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Functions for searching the CMR granule catalog
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+cmr_granule_url = 'https://cmr.earthdata.nasa.gov/search/granules.umm_json'
+page_size = 2000
+
+# CMR refuses page_num paging past this many results, after which the
+# search-after header has to be followed page by page
+max_page_num_results = 1000000
+
+
+class Granule:
+    # One granule returned by a CMR search. urls holds the downloadable data
+    # files and file_info maps each file name to its (size, checksum,
+    # algorithm) as used by toolbox.download.download_urls
+    def __init__(self, granule_id, concept_id, time_start, time_end,
+                 bounding_box, urls, file_info):
+        self.granule_id = granule_id
+        self.concept_id = concept_id
+        self.time_start = time_start
+        self.time_end = time_end
+        self.bounding_box = bounding_box  # west, south, east, north
+        self.urls = urls
+        self.file_info = file_info
+
+    def file_names(self):
+        return [url.split('/')[-1] for url in self.urls]
+
+    def __repr__(self):
+        return 'Granule(' + self.granule_id + ', ' + str(
+            self.time_start) + ' - ' + str(self.time_end) + ')'
+
+
+def parse_cmr_time(time_string):
+    if time_string is None:
+        return None
+    return dt.datetime.strptime(time_string[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+def granule_from_umm(item):
+    umm = item['umm']
+
+    temporal = umm.get('TemporalExtent', {})
+    if 'RangeDateTime' in temporal:
+        time_start = parse_cmr_time(
+            temporal['RangeDateTime'].get('BeginningDateTime'))
+        time_end = parse_cmr_time(
+            temporal['RangeDateTime'].get('EndingDateTime'))
+    else:
+        time_start = parse_cmr_time(temporal.get('SingleDateTime'))
+        time_end = time_start
+
+    # collect the lon/lat of every rectangle and polygon point of the granule
+    geometry = umm.get('SpatialExtent', {}).get('HorizontalSpatialDomain',
+                                                {}).get('Geometry', {})
+    lons = []
+    lats = []
+    for rectangle in geometry.get('BoundingRectangles', []):
+        lons += [
+            rectangle['WestBoundingCoordinate'],
+            rectangle['EastBoundingCoordinate']
+        ]
+        lats += [
+            rectangle['SouthBoundingCoordinate'],
+            rectangle['NorthBoundingCoordinate']
+        ]
+    for polygon in geometry.get('GPolygons', []):
+        for point in polygon['Boundary']['Points']:
+            lons.append(point['Longitude'])
+            lats.append(point['Latitude'])
+    if len(lons) > 0:
+        bounding_box = [min(lons), min(lats), max(lons), max(lats)]
+    else:
+        bounding_box = None
+
+    urls = []
+    unique_filenames = set()
+    for link in umm.get('RelatedUrls', []):
+        # Only keep direct http links to the data files (this excludes
+        # OPeNDAP, S3 and metadata links)
+        if link.get('Type') != 'GET DATA':
+            continue
+        filename = link['URL'].split('/')[-1]
+        if filename in unique_filenames:
+            # Exclude links with duplicate filenames (they would overwrite)
+            continue
+        unique_filenames.add(filename)
+        urls.append(link['URL'])
+
+    file_info = {}
+    data_granule = umm.get('DataGranule', {})
+    for archive_info in data_granule.get('ArchiveAndDistributionInformation',
+                                         []):
+        if 'Name' not in archive_info:
+            continue
+        checksum = archive_info.get('Checksum', {})
+        file_info[archive_info['Name']] = (archive_info.get('SizeInBytes'),
+                                           checksum.get('Value'),
+                                           checksum.get('Algorithm'))
+
+    return Granule(umm.get('GranuleUR', item['meta']['concept-id']),
+                   item['meta']['concept-id'], time_start, time_end,
+                   bounding_box, urls, file_info)
+
+
+def cells_to_bounding_box(IC, cells=None, n_points=25):
+    # Get the lon/lat bounding box [west, south, east, north] around the
+    # extents of the given cells (defaults to IC.cells)
+    if cells is None:
+        cells = IC.cells
+    extents = np.array([IC.grid_dict[cell] for cell in cells])
+    min_x, min_y = np.min(extents[:, 0]), np.min(extents[:, 1])
+    max_x, max_y = np.max(extents[:, 2]), np.max(extents[:, 3])
+
+    # spell out the edges so the curvature of the projection is captured
+    edge = np.linspace(0, 1, n_points)
+    x = np.concatenate([
+        min_x + edge * (max_x - min_x),
+        np.full(n_points, max_x), max_x - edge * (max_x - min_x),
+        np.full(n_points, min_x)
+    ])
+    y = np.concatenate([
+        np.full(n_points, min_y), min_y + edge * (max_y - min_y),
+        np.full(n_points, max_y), max_y - edge * (max_y - min_y)
+    ])
+
+    lon, lat = reprojection.transform_points(x, y, IC.epsg, 4326)
+    bounding_box = [np.min(lon), np.min(lat), np.max(lon), np.max(lat)]
+
+    # the polar stereographic grids are centered on the pole, so a region
+    # which contains the origin covers every longitude
+    if min_x <= 0 <= max_x and min_y <= 0 <= max_y:
+        if np.mean(lat) > 0:
+            bounding_box = [-180, np.min(lat), 180, 90]
+        else:
+            bounding_box = [-180, -90, 180, np.max(lat)]
+    elif bounding_box[2] - bounding_box[0] > 180:
+        # the region crosses the antimeridian
+        bounding_box[0] = -180
+        bounding_box[2] = 180
+
+    return [float(b) for b in bounding_box]
+
+
+def format_temporal(temporal):
+    # temporal is a [start, end] pair of datetimes or 'YYYY-MM-DD' strings
+    # (an end date given as a string includes the whole day)
+    start, end = temporal
+    if isinstance(start, str):
+        start = dt.datetime.strptime(start, '%Y-%m-%d')
+    if isinstance(end, str):
+        end = dt.datetime.strptime(end, '%Y-%m-%d') + dt.timedelta(
+            hours=23, minutes=59, seconds=59)
+    return start.strftime('%Y-%m-%dT%H:%M:%SZ') + ',' + end.strftime(
+        '%Y-%m-%dT%H:%M:%SZ')
+
+
+def build_query(collection_id, bounding_box=None, temporal=None):
+    params = {
+        'collection_concept_id': collection_id,
+        'page_size': page_size,
+        'sort_key': 'start_date'
+    }
+    if bounding_box is not None:
+        params['bounding_box'] = ','.join(
+            ['{:.6f}'.format(b) for b in bounding_box])
+    if temporal is not None:
+        params['temporal'] = format_temporal(temporal)
+    return params
+
+
+def get_page(session, params, page_num=None, search_after=None,
+             headers=None):
+    params = dict(params)
+    if headers is None:
+        headers = {}
+    if page_num is not None:
+        params['page_num'] = page_num
+    if search_after is not None:
+        headers['CMR-Search-After'] = search_after
+
+    response = session.get(cmr_granule_url,
+                           params=params,
+                           headers=headers,
+                           timeout=60)
+    if response.status_code == 304:
+        return None, response.headers
+    if response.status_code != 200:
+        # the body of an error is often not JSON, so raise the status as a
+        # request error (and the cached search can be used instead)
+        message = 'CMR search failed with HTTP {}'.format(
+            response.status_code)
+        try:
+            message += ': ' + str(response.json()['errors'])
+        except (ValueError, KeyError, TypeError):
+            pass
+        raise requests.exceptions.HTTPError(message, response=response)
+    search_page = response.json()
+
+    # If JSON contains an error message, raise it with the message at the key, 'errors'
+    if 'errors' in search_page:
+        raise ValueError('CMR search failed: ' + str(search_page['errors']))
+
+    return search_page, response.headers
+
+
+def fetch_items(session, params, n_workers):
+    # Get the UMM items of every page of a search. The first page gives the
+    # number of hits, after which the remaining pages are requested
+    # concurrently.
+    search_page, headers = get_page(session, params)
+    items = search_page.get('items', [])
+    hits = int(headers.get('CMR-Hits', search_page.get('hits', len(items))))
+    n_pages = int(math.ceil(hits / page_size))
+
+    if n_pages > 1 and hits <= max_page_num_results:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            pages = executor.map(
+                lambda page_num: get_page(session, params, page_num)[0],
+                range(2, n_pages + 1))
+            for page in pages:
+                items += page.get('items', [])
+    else:
+        # follow the search-after header until all pages are read
+        search_after = headers.get('CMR-Search-After')
+        while len(items) < hits and search_after is not None:
+            search_page, page_headers = get_page(session,
+                                                 params,
+                                                 search_after=search_after)
+            if len(search_page.get('items', [])) == 0:
+                break
+            items += search_page['items']
+            search_after = page_headers.get('CMR-Search-After')
+
+    # remove any granules which were returned on more than one page
+    unique_items = []
+    concept_ids = set()
+    for item in items:
+        if item['meta']['concept-id'] in concept_ids:
+            continue
+        concept_ids.add(item['meta']['concept-id'])
+        unique_items.append(item)
+
+    return unique_items, hits, headers
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# On-disk cache of search results
+#
+# Each search is stored as <cache_folder>/<hash of the query>.json with the
+# UMM items, the time it was fetched and the ETag/Last-Modified headers.
+# A cached search younger than the TTL is served without a request. An
+# older one is revalidated with a conditional request, which is answered
+# from the number of hits and the granules updated since it was fetched.
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def cache_file(cache_folder, params):
+    key = hashlib.sha256(
+        json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+    return os.path.join(cache_folder, key + '.json')
+
+
+def read_cache(cache_folder, params):
+    if cache_folder is None:
+        return None
+    file_path = cache_file(cache_folder, params)
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path) as f:
+        return json.load(f)
+
+
+def write_cache(cache_folder, params, cached):
+    if cache_folder is None:
+        return
+    if not os.path.exists(cache_folder):
+        os.makedirs(cache_folder)
+
+    # write to a temporary file first so a crash cannot corrupt the cache
+    file_path = cache_file(cache_folder, params)
+    with open(file_path + '.part', 'w') as f:
+        json.dump(cached, f)
+    os.replace(file_path + '.part', file_path)
+
+
+def cache_is_current(session, params, cached):
+    # Revalidate a cached search with a conditional request for zero items
+    headers = {}
+    if cached.get('etag') is not None:
+        headers['If-None-Match'] = cached['etag']
+    if cached.get('last_modified') is not None:
+        headers['If-Modified-Since'] = cached['last_modified']
+
+    count_params = dict(params)
+    count_params['page_size'] = 0
+    search_page, response_headers = get_page(session,
+                                             count_params,
+                                             headers=headers)
+    if search_page is None:  # 304 Not Modified
+        return True
+
+    # a deleted granule changes the number of hits, and an added or
+    # revised one is found by searching for updates since the last fetch
+    if int(response_headers.get('CMR-Hits', -1)) != cached['hits']:
+        return False
+    count_params['updated_since'] = dt.datetime.fromtimestamp(
+        cached['fetched'], dt.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    search_page, response_headers = get_page(session, count_params)
+    return int(response_headers.get('CMR-Hits', -1)) == 0
+
+
+def search_granules(collection_id,
+                    bounding_box=None,
+                    temporal=None,
+                    n_workers=8,
+                    cache_folder=None,
+                    ttl=24 * 3600,
+                    offline=False):
+    """Search CMR for every granule of a collection.
+
+    bounding_box ([west, south, east, north] in degrees) and temporal
+    ([start, end]) are passed to the server so only intersecting granules
+    are returned. If a cache_folder is given the results are cached there:
+    a cached search younger than ttl seconds is served directly, an older
+    one is revalidated before it is used, and with offline=True (or when
+    CMR cannot be reached) the cached search is served as it is. Returns a
+    list of Granule.
+    """
+    params = build_query(collection_id, bounding_box, temporal)
+    cached = read_cache(cache_folder, params)
+
+    if cached is not None and (offline
+                               or time.time() - cached['fetched'] < ttl):
+        print('Using cached CMR search from ' +
+              time.ctime(cached['fetched']))
+        return [granule_from_umm(item) for item in cached['items']]
+    if offline:
+        raise ValueError('No cached CMR search is available in offline mode')
+
+    session = requests.Session()
+    try:
+        if cached is not None and cache_is_current(session, params, cached):
+            print('Cached CMR search is still current')
+            cached['fetched'] = time.time()
+            write_cache(cache_folder, params, cached)
+            items = cached['items']
+            hits = cached['hits']
+        else:
+            items, hits, headers = fetch_items(session, params, n_workers)
+            write_cache(
+                cache_folder, params, {
+                    'params': params,
+                    'fetched': time.time(),
+                    'etag': headers.get('ETag'),
+                    'last_modified': headers.get('Last-Modified'),
+                    'hits': hits,
+                    'items': items
+                })
+    except requests.exceptions.RequestException as e:
+        if cached is None:
+            raise
+        print('WARNING: could not reach CMR (' + str(e) + ')')
+        print('Using cached CMR search from ' +
+              time.ctime(cached['fetched']))
+        items = cached['items']
+        hits = cached['hits']
+    finally:
+        session.close()
+
+    granules = [granule_from_umm(item) for item in items]
+
+    print("Successfully obtained {} of {} granules.".format(
+        len(granules), hits))
+
+    return granules
+
+
+def search_granules_for_cells(IC, cells=None, temporal=None):
+    # Search for the granules of the IC collection which intersect the cells
+    # (defaults to IC.cells, or the whole ice sheet if no cells are stored),
+    # using the CMR cache settings of the IC object
+    if cells is None:
+        cells = IC.cells
+    bounding_box = None
+    if len(cells) > 0:
+        bounding_box = cells_to_bounding_box(IC, cells)
+        print('Searching within bounding box: ', bounding_box)
+    return search_granules(IC.collection_id, bounding_box, temporal,
+                           IC.download_workers,
+                           os.path.join(IC.metadata_path, 'cmr_cache'),
+                           IC.cmr_cache_ttl, IC.offline)
+
+
+def granule_file_links(granules):
+    # Flatten a granule list into the file names and links to download
+    file_names = []
+    file_links = []
+    for granule in granules:
+        for url in granule.urls:
+            file_names.append(url.split('/')[-1])
+            file_links.append(url)
+    return file_names, file_links
+
+
+def granule_file_info(granules):
+    file_info = {}
+    for granule in granules:
+        file_info.update(granule.file_info)
+    return file_info
@@ -1,11 +1,48 @@
+import os
 import numpy as np
 import netCDF4 as nc
 import datetime as dt
 from scipy.interpolate import griddata
+import toolbox.memory as memory
+import toolbox.resample.plan_cache as plan_cache
+
+# datasets which are kept open between cells (see open_dataset)
+open_datasets = {}
+
+# number of source pixels kept around the grid on each side of a crop
+crop_padding = 10
+
+
+def open_dataset(file):
+    # Open a file once and reuse it for every cell
+    if file not in open_datasets or not open_datasets[file].isopen():
+        open_datasets[file] = nc.Dataset(file, 'r')
+    return open_datasets[file]
+
+
+def close_datasets():
+    for file in list(open_datasets):
+        if open_datasets[file].isopen():
+            open_datasets[file].close()
+        del open_datasets[file]
+
+
+def axis_crop(axis, low, high, padding=crop_padding):
+    # get the slice of a sorted (ascending or descending) coordinate vector
+    # which covers [low, high], with padding pixels on each side
+    axis = np.asarray(axis)
+    if len(axis) > 1 and axis[0] > axis[-1]:
+        i_min, i_max = axis_crop(axis[::-1], low, high, padding)
+        return len(axis) - i_max, len(axis) - i_min
+
+    i_min = np.searchsorted(axis, low, side='left') - padding
+    i_max = np.searchsorted(axis, high, side='right') + padding
+    return int(max(i_min, 0)), int(min(i_max, len(axis)))
+
 
 def get_crop_indicies(IC_object, x, y):
-    # get the index closest to the bounds of the grid (or extents)
-    # add/subtract indicies to make sure the grid is larger than the extents
+    # get the indicies of the bounds of the grid (or extents) in the source
+    # coordinates, padded to make sure the crop is larger than the extents
 
     if IC_object.data_type.lower() == 'velocity':
         xgrid = IC_object.velocity_grid_x
@@ -17,32 +54,45 @@ def get_crop_indicies(IC_object, x, y):
         print('Error: data type not recognized. Exiting...')
         return
 
-    x_index_min = np.argmin(np.abs(x - xgrid[0])) 
-    if x_index_min <= 10: x_index_min = 0
-    else: x_index_min = x_index_min - 10
-
-    x_index_max = np.argmin(np.abs(x - xgrid[-1])) + 10
-    if x_index_max >= len(x): x_index_max = len(x)
-    else: x_index_max = x_index_max + 10
-
-    y_index_min = np.argmin(np.abs(y - ygrid[0]))  - 10
-    if y_index_min <= 10: y_index_min = 0
-    else: y_index_min = y_index_min - 10
-
-    y_index_max = np.argmin(np.abs(y - ygrid[-1])) + 10
-    if y_index_max >= len(y): y_index_max = len(y)
-    else: y_index_max = y_index_max + 10
+    x_index_min, x_index_max = axis_crop(x, np.min(xgrid), np.max(xgrid))
+    y_index_min, y_index_max = axis_crop(y, np.min(ygrid), np.max(ygrid))
 
     return x_index_min, x_index_max, y_index_min, y_index_max
 
-def crop_data(IC_object, file):
-    ds = nc.Dataset(file, 'r')
+def atl15_timestamps(time):
+    # ATL15 times are in days since 2018-01-01
+    return np.array([dt.datetime.timestamp(dt.datetime(2018,1,1) + dt.timedelta(days=float(t))) for t in time])
+
+def atl15_time_indices(file):
+    # indices of all of the ATL15 time slices
+    return np.arange(open_dataset(file).groups['delta_h'].variables['time'].shape[0])
+
+def new_atl15_time_indices(file, stored_timestamps):
+    # indices of the ATL15 time slices which are not in a stack yet (the
+    # stored times are f4, so they are matched to within half a day)
+    time = open_dataset(file).groups['delta_h'].variables['time'][:]
+    timestamps = atl15_timestamps(time)
+    stored_timestamps = np.asarray(stored_timestamps)
+    indices = []
+    for i in range(len(timestamps)):
+        if len(stored_timestamps) == 0 or np.min(np.abs(stored_timestamps - timestamps[i])) > 12 * 3600:
+            indices.append(i)
+    return np.array(indices, dtype=int)
+
+def crop_data(IC_object, file, time_indices=None):
+    # only the coordinate vectors are read in full; the data variables are
+    # read as the hyperslab of the cell (and of time_indices for ATL15)
+    ds = open_dataset(file)
 
     if IC_object.short_name == 'ATL15 Antarctic Elevation':
-        x = ds.groups['delta_h'].variables['x'][:]
-        y = ds.groups['delta_h'].variables['y'][:]
-        time = ds.groups['delta_h'].variables['time'][:]  
-        delta_h = ds.groups['delta_h'].variables['delta_h'][:]
+        group = ds.groups['delta_h']
+        x = group.variables['x'][:]
+        y = group.variables['y'][:]
+        time = group.variables['time'][:]
+        if time_indices is None:
+            time_indices = slice(None)
+        else:
+            time = time[time_indices]
 
         # get the index closest to the bounds of the grid (or extents)
         x_index_min, x_index_max, y_index_min, y_index_max = get_crop_indicies(IC_object, x, y)
@@ -50,13 +100,11 @@ def crop_data(IC_object, file):
         # crop the data
         x = x[x_index_min:x_index_max]
         y = y[y_index_min:y_index_max]
-        delta_h = delta_h[:, y_index_min:y_index_max, x_index_min:x_index_max]
+        delta_h = group.variables['delta_h'][time_indices, y_index_min:y_index_max, x_index_min:x_index_max]
 
         # set masked values of delta_h to nan (scipy.interpolate.griddata does not work with masked arrays)
         delta_h_um = np.ma.filled(delta_h, np.nan)
 
-        ds.close()
-
         return x, y, time, delta_h_um
     
     if IC_object.short_name == 'MEaSUREs Greenland Monthly Velocity':
@@ -64,27 +112,18 @@ def crop_data(IC_object, file):
         y = ds.variables['y'][:]
         dates = ds.variables['dates'][:]
 
-        v = ds.variables['V'][:]
-        e = ds.variables['E'][:]
-        vx = ds.variables['VX'][:]
-        vy = ds.variables['VY'][:]
-        ex = ds.variables['EX'][:]
-        ey = ds.variables['EY'][:]
-
         # get the index closest to the bounds of the grid (or extents)
         x_index_min, x_index_max, y_index_min, y_index_max = get_crop_indicies(IC_object, x, y)
 
         # crop the data
         x = x[x_index_min:x_index_max]
         y = y[y_index_min:y_index_max]
-        e = e[y_index_min:y_index_max, x_index_min:x_index_max]
-        v = v[y_index_min:y_index_max, x_index_min:x_index_max]
-        vx = vx[y_index_min:y_index_max, x_index_min:x_index_max]
-        vy = vy[y_index_min:y_index_max, x_index_min:x_index_max]
-        ex = ex[y_index_min:y_index_max, x_index_min:x_index_max]
-        ey = ey[y_index_min:y_index_max, x_index_min:x_index_max]
-
-        ds.close()
+        e = ds.variables['E'][y_index_min:y_index_max, x_index_min:x_index_max]
+        v = ds.variables['V'][y_index_min:y_index_max, x_index_min:x_index_max]
+        vx = ds.variables['VX'][y_index_min:y_index_max, x_index_min:x_index_max]
+        vy = ds.variables['VY'][y_index_min:y_index_max, x_index_min:x_index_max]
+        ex = ds.variables['EX'][y_index_min:y_index_max, x_index_min:x_index_max]
+        ey = ds.variables['EY'][y_index_min:y_index_max, x_index_min:x_index_max]
 
         return x, y, dates, v, e, vx, vy, ex, ey
 
@@ -92,17 +131,13 @@ def crop_data(IC_object, file):
     if IC_object.short_name == 'ATL14 Antarctic Elevation':
         x = ds.variables['x'][:]
         y = ds.variables['y'][:]
-        h = ds.variables['h'][:]
-        h_sigma = ds.variables['h_sigma'][:]
 
         x_index_min, x_index_max, y_index_min, y_index_max = get_crop_indicies(IC_object, x, y)
 
         x = x[x_index_min:x_index_max]
         y = y[y_index_min:y_index_max]
-        h = h[y_index_min:y_index_max, x_index_min:x_index_max]
-        h_sigma = h_sigma[y_index_min:y_index_max, x_index_min:x_index_max]
-
-        ds.close()
+        h = ds.variables['h'][y_index_min:y_index_max, x_index_min:x_index_max]
+        h_sigma = ds.variables['h_sigma'][y_index_min:y_index_max, x_index_min:x_index_max]
 
         return x, y, h, h_sigma
 
@@ -114,8 +149,55 @@ def crop_data(IC_object, file):
 def interpolate_measures(IC_object, x, y, time, vx, vy, ex, ey):
     return
 
+def bilinear_plan(x, y, grid_x, grid_y):
+    # Indices of the four neighbouring source points of every target point
+    # (flattened over y, x) and their bilinear weights. Target points outside
+    # of the source grid get no neighbours and are left as nan.
+    XC, YC = np.meshgrid(grid_x, grid_y)
+    plan = plan_cache.bilinear_point_plan(x, y, XC, YC)
+    plan['shape'] = np.array([len(grid_y), len(grid_x)])
+    return plan
+
+
+def plan_folder(IC_object):
+    return os.path.join(IC_object.data_folder, 'Interpolation Plans')
+
+
+def get_interpolation_plan(IC_object, x, y):
+    # Get the plan from this session, from the plan folder of a previous
+    # run, or compute (and store) it
+    grid_x = IC_object.elevation_grid_x
+    grid_y = IC_object.elevation_grid_y
+    key = plan_cache.plan_key(x, y, grid_x, grid_y, IC_object.epsg,
+                              IC_object.epsg, 'linear')
+    return plan_cache.get_plan(plan_folder(IC_object), key,
+                               lambda: bilinear_plan(x, y, grid_x, grid_y),
+                               IC_object.plan_cache_size,
+                               memory.plan_memory(IC_object))
+
+
+def apply_interpolation_plan(plan, values, dtype='float64'):
+    # Interpolate all time slices of values (time, y, x) at once. A nan at any
+    # of the four neighbours gives a nan.
+    return plan_cache.apply_plan(plan, values, np.nan, dtype)
+
+
 def interpolate_atl15(IC_object, x, y, time, delta_h_um):
 
+    time_stack = []
+    for t in range(len(time)):
+        time_stack.append(dt.datetime(2018,1,1) + dt.timedelta(days=float(time[t])))
+
+    # ATL15 is on a regular grid, so the neighbours and weights of the
+    # bilinear interpolation are computed once and used for every time slice
+    plan = get_interpolation_plan(IC_object, x, y)
+    delta_h_stack = list(apply_interpolation_plan(plan, delta_h_um, memory.working_dtype(IC_object)))
+
+    return time_stack, delta_h_stack
+
+
+def interpolate_atl15_griddata(IC_object, x, y, time, delta_h_um):
+
     time_stack = []
     delta_h_stack = []
 
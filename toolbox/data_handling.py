@@ -1,17 +1,28 @@
 import os
 import netCDF4 as nc
-import os
+import toolbox.catalog as catalog
 import toolbox.compile_interp as compile_interp
+import toolbox.memory as memory
 import toolbox.store_nc as store
 import toolbox.measures as measures
 
 
+def stack_file(IC_object, cell_ID=None):
+    return store.stack_path(IC_object, cell_ID)
+
+
+def new_measures_file_names(file_names, stored_date_pairs):
+    # the mosaics of the date pairs which are not in a stack yet
+    stored_date_pairs = set(stored_date_pairs)
+    return [
+        f for f in file_names
+        if measures.measures_fileID_to_date_pair(f) not in stored_date_pairs
+    ]
+
+
 def handle_measures(IC_object):
     if os.path.exists(IC_object.download_path):
-        file_names = [
-            file for file in os.listdir(IC_object.download_path)
-            if file.endswith('.tif')
-        ]
+        file_names = catalog.list_files(IC_object, suffix='.tif')
     else:
         print(
             "Error: download path does not exist. Please check that the data has been downloaded and is in the correct folder."
@@ -20,32 +31,177 @@ def handle_measures(IC_object):
         print("Exiting...")
         return
 
-    x, y, vx_grids, vy_grids, v_grids, ex_grids, ey_grids, e_grids, output_date_pairs = measures.create_velocity_stack(
-        IC_object, file_names)
-    store.output_data_stack_measures(IC_object, x, y, vx_grids, vy_grids,
-                                     v_grids, ex_grids, ey_grids, e_grids,
-                                     output_date_pairs)
+    # only process the epochs which are not in the stack yet
+    output_file = stack_file(IC_object)
+    if IC_object.incremental_update and store.stack_can_be_appended(
+            output_file):
+        file_names = new_measures_file_names(
+            file_names, store.stack_date_pairs(output_file))
+        if len(file_names) == 0:
+            print("        No new epochs for existing file...")
+            return
+
+    # check the memory the stack needs, and build it in batches of epochs
+    # (each added to the stack of the previous one) if it does not fit
+    date_pairs = measures.measures_date_pairs(file_names)
+    batch = memory.preflight(IC_object, IC_object.extents, len(date_pairs),
+                             IC_object.region_name)
+    if batch == 0:
+        return
+
+    append = None
+    for i in range(0, len(date_pairs), batch):
+        batch_date_pairs = set(date_pairs[i:i + batch])
+        batch_file_names = [
+            f for f in file_names
+            if measures.measures_fileID_to_date_pair(f) in batch_date_pairs
+        ]
+
+        stack = measures.create_velocity_stack(IC_object, batch_file_names)
+        if stack is None:
+            continue
+        x, y, vx_grids, vy_grids, v_grids, ex_grids, ey_grids, e_grids, output_date_pairs = stack
+        store.output_data_stack_measures(IC_object,
+                                         x,
+                                         y,
+                                         vx_grids,
+                                         vy_grids,
+                                         v_grids,
+                                         ex_grids,
+                                         ey_grids,
+                                         e_grids,
+                                         output_date_pairs,
+                                         append=append)
+        append = True
 
     return
     #output_folder =  os.path.join(IC_object.data_folder, 'Quilted Grids', IC_object.icesheet_name, IC_object.region_name)
     #file = os.path.join(output_folder, IC_object.short_name + "_stack.nc")
 
 
+def handle_measures_cells(IC_object, cell_IDs=None, cells_per_pass=None):
+    # Build the stacks of many cells with one pass over the mosaics, instead
+    # of reading every mosaic again for each cell. cells_per_pass limits how
+    # many cells are held in memory at once (all of them by default).
+    if os.path.exists(IC_object.download_path):
+        file_names = catalog.list_files(IC_object, suffix='.tif')
+    else:
+        print(
+            "Error: download path does not exist. Please check that the data has been downloaded and is in the correct folder."
+        )
+        print(IC_object.download_path)
+        print("Exiting...")
+        return
+
+    if cell_IDs is None:
+        cell_IDs = IC_object.cells
+
+    # skip the cells which already have a stack, or with incremental updates
+    # find the epochs which each stack is missing
+    remaining_cells = []
+    stored_date_pairs = {}
+    for cell_ID in cell_IDs:
+        output_file = stack_file(IC_object, cell_ID)
+        if IC_object.incremental_update and store.stack_can_be_appended(
+                output_file):
+            stored_date_pairs[cell_ID] = set(
+                store.stack_date_pairs(output_file))
+            if len(new_measures_file_names(file_names,
+                                           stored_date_pairs[cell_ID])) == 0:
+                print("        No new epochs for " + cell_ID + "...")
+                continue
+        elif os.path.exists(output_file):
+            print("        Skipping existing file for " + cell_ID + "...")
+            continue
+        remaining_cells.append(cell_ID)
+
+    if cells_per_pass is None:
+        cells_per_pass = max(len(remaining_cells), 1)
+
+    # the region and extents are set to each cell in turn, and restored
+    # even if a cell fails
+    region_name = IC_object.region_name
+    extents = IC_object.extents
+    try:
+        # hold only as many cells at once as fit in the memory budget; cells
+        # which do not fit on their own are built in batches of epochs
+        budget = memory.memory_budget(IC_object)
+        if budget is not None and len(remaining_cells) > 0:
+            n_epochs = len(measures.measures_date_pairs(file_names))
+            per_cell = memory.estimate_cell_memory(
+                IC_object, IC_object.grid_dict[remaining_cells[0]], n_epochs)
+            print('Estimated peak memory per cell: ' +
+                  memory.format_bytes(per_cell) + ' (budget ' +
+                  memory.format_bytes(budget) + ')')
+            if per_cell > budget:
+                for cell_ID in remaining_cells:
+                    IC_object.region_name = cell_ID
+                    IC_object.extents = IC_object.grid_dict[cell_ID]
+                    handle_measures(IC_object)
+                return
+            cells_per_pass = int(min(cells_per_pass, budget // max(per_cell, 1)))
+
+        for i in range(0, len(remaining_cells), cells_per_pass):
+            pass_cells = remaining_cells[i:i + cells_per_pass]
+            print('Working on ' + str(len(pass_cells)) + ' cells (' +
+                  str(i + len(pass_cells)) + ' of ' + str(len(remaining_cells)) +
+                  ')')
+
+            # the epochs which are missing from at least one of the cells
+            pass_file_names = file_names
+            if all([c in stored_date_pairs for c in pass_cells]):
+                stored_by_all = set.intersection(
+                    *[stored_date_pairs[c] for c in pass_cells])
+                pass_file_names = new_measures_file_names(file_names,
+                                                          stored_by_all)
+
+            stacks = measures.create_velocity_stacks(IC_object, pass_file_names,
+                                                     pass_cells)
+
+            for cell_ID in pass_cells:
+                if cell_ID not in stacks:
+                    continue
+                IC_object.region_name = cell_ID
+                IC_object.extents = IC_object.grid_dict[cell_ID]
+                x, y, vx_grids, vy_grids, v_grids, ex_grids, ey_grids, e_grids, output_date_pairs = stacks[
+                    cell_ID]
+                if cell_ID in stored_date_pairs:
+                    new = [
+                        d not in stored_date_pairs[cell_ID]
+                        for d in output_date_pairs
+                    ]
+                    x, y, vx_grids, vy_grids, v_grids, ex_grids, ey_grids, e_grids = [
+                        x, y, vx_grids[new], vy_grids[new], v_grids[new],
+                        ex_grids[new], ey_grids[new], e_grids[new]
+                    ]
+                    output_date_pairs = [
+                        d for d in output_date_pairs
+                        if d not in stored_date_pairs[cell_ID]
+                    ]
+                store.output_data_stack_measures(IC_object, x, y, vx_grids,
+                                                 vy_grids, v_grids, ex_grids,
+                                                 ey_grids, e_grids,
+                                                 output_date_pairs)
+    finally:
+        IC_object.region_name = region_name
+        IC_object.extents = extents
+
+    return
+
+
 def handle_atl(IC_object):
     # check if IC_object.download_path exists
     if os.path.exists(IC_object.download_path):
         if IC_object.icesheet_name == 'Greenland':
             download_path = IC_object.download_path
-            files = [
-                file for file in os.listdir(IC_object.download_path)
-                if file.endswith('.nc') and '_01km_' in file and 'GL' in file
-            ]
+            files = catalog.list_files(IC_object,
+                                       IC_object.download_path, '.nc',
+                                       ['_01km_', 'GL'])
         elif IC_object.icesheet_name == 'Antarctic':
             download_path = IC_object.download_path
-            files = [
-                file for file in os.listdir(IC_object.download_path)
-                if file.endswith('.nc') and '_01km_' in file and 'AA' in file
-            ]
+            files = catalog.list_files(IC_object,
+                                       IC_object.download_path, '.nc',
+                                       ['_01km_', 'AA'])
         else:
             print('Error: icesheet not recognized')
             return
@@ -61,19 +217,15 @@ def handle_atl(IC_object):
                                          IC_object.data_type.title(),
                                          IC_object.short_name, 'Data')
             if os.path.exists(download_path):
-                files = [
-                    file for file in os.listdir(download_path) if
-                    file.endswith('.nc') and '_01km_' in file and 'GL' in file
-                ]
+                files = catalog.list_files(IC_object, download_path, '.nc',
+                                           ['_01km_', 'GL'])
         elif IC_object.icesheet_name == 'Antarctic':
             download_path = os.path.join(IC_object.data_folder, 'Greenland',
                                          IC_object.data_type.title(),
                                          IC_object.short_name, 'Data')
             if os.path.exists(download_path):
-                files = [
-                    file for file in os.listdir(download_path) if
-                    file.endswith('.nc') and '_01km_' in file and 'GL' in file
-                ]
+                files = catalog.list_files(IC_object, download_path, '.nc',
+                                           ['_01km_', 'GL'])
         else:
             print('Error: icesheet not recognized')
             return
@@ -91,17 +243,47 @@ def handle_atl(IC_object):
     # There is only one file per icesheet for 1km resolution
     file = os.path.join(download_path, files[0])
 
-    # crop the data
-    x, y, time, delta_h_um = compile_interp.crop_data(IC_object, file)
+    # only process the epochs which are not in the stack yet
+    time_indices = None
+    output_file = stack_file(IC_object)
+    if IC_object.incremental_update and store.stack_can_be_appended(
+            output_file):
+        time_indices = compile_interp.new_atl15_time_indices(
+            file, store.stack_times(output_file))
+        if len(time_indices) == 0:
+            print("        No new epochs for existing file...")
+            return
+    elif os.path.exists(output_file):
+        print("        Skipping existing file...")
+        return
+
+    # check the memory the stack needs, and build it in batches of epochs
+    # (each added to the stack of the previous one) if it does not fit
+    if time_indices is None:
+        time_indices = compile_interp.atl15_time_indices(file)
+    batch = memory.preflight(IC_object, IC_object.extents, len(time_indices),
+                             IC_object.region_name)
+    if batch == 0:
+        return
+
+    append = None
+    for i in range(0, len(time_indices), batch):
+        # crop the data
+        x, y, time, delta_h_um = compile_interp.crop_data(
+            IC_object, file, time_indices[i:i + batch])
 
-    time_stack, delta_h_stack = compile_interp.interpolate_atl15(
-        IC_object, x, y, time, delta_h_um)
+        time_stack, delta_h_stack = compile_interp.interpolate_atl15(
+            IC_object, x, y, time, delta_h_um)
 
-    #x_14, y_14, h_14, h_sigma_14 = get_atl14_data(IC_object)
-    #IC_object.collection_info('ATL15 Antarctic Elevation')
+        #x_14, y_14, h_14, h_sigma_14 = get_atl14_data(IC_object)
+        #IC_object.collection_info('ATL15 Antarctic Elevation')
 
-    #store.output_data_stack_atl(IC_object, IC_object, time_stack, delta_h_stack) #, x_14, y_14, h_14, h_sigma_14)
-    store.output_data_stack_atl_timedim(IC_object, time_stack, delta_h_stack)
+        #store.output_data_stack_atl(IC_object, IC_object, time_stack, delta_h_stack) #, x_14, y_14, h_14, h_sigma_14)
+        store.output_data_stack_atl_timedim(IC_object,
+                                            time_stack,
+                                            delta_h_stack,
+                                            append=append)
+        append = True
 
 
 def get_atl14_data(IC_object):
@@ -113,15 +295,13 @@ def get_atl14_data(IC_object):
     # check if IC_object.download_path exists
     if os.path.exists(IC_object.download_path):
         if IC_object.icesheet_name == 'Greenland':
-            files = [
-                file for file in os.listdir(IC_object.download_path)
-                if file.endswith('.nc') and 'ATL14' in file and 'GL' in file
-            ]
+            files = catalog.list_files(IC_object,
+                                       IC_object.download_path, '.nc',
+                                       ['ATL14', 'GL'])
         elif IC_object.icesheet_name == 'Antarctic':
-            files = [
-                file for file in os.listdir(IC_object.download_path)
-                if file.endswith('.nc') and 'ATL14' in file and 'AA' in file
-            ]
+            files = catalog.list_files(IC_object,
+                                       IC_object.download_path, '.nc',
+                                       ['ATL14', 'AA'])
         else:
             print('Error: icesheet not recognized')
             return
@@ -137,19 +317,15 @@ def get_atl14_data(IC_object):
                                          IC_object.data_type.title(),
                                          IC_object.short_name, 'Data')
             if os.path.exists(download_path):
-                files = [
-                    file for file in os.listdir(download_path)
-                    if file.endswith('.nc') and 'GL' in file
-                ]
+                files = catalog.list_files(IC_object, download_path, '.nc',
+                                           ['GL'])
         elif IC_object.icesheet_name == 'Antarctic':
             download_path = os.path.join(IC_object.data_folder, 'Greenland',
                                          IC_object.data_type.title(),
                                          IC_object.short_name, 'Data')
             if os.path.exists(download_path):
-                files = [
-                    file for file in os.listdir(download_path)
-                    if file.endswith('.nc') and 'GL' in file
-                ]
+                files = catalog.list_files(IC_object, download_path, '.nc',
+                                           ['GL'])
         else:
             print('Error: icesheet not recognized')
             return
@@ -1,6 +1,12 @@
+import hashlib
 import itertools
 import requests
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+import toolbox.cmr as cmr
+import toolbox.catalog as catalog
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # TODO: Functions for downloading data
@@ -82,19 +88,37 @@ def cmr_filter_nested_urls(search_results):
 
 
 def get_response(url):
-    response = requests.get(url)
-    # print error code based on response or return search page
-    if response.status_code != 200:
-        print('ERROR: {}'.format(response.status_code))
-    search_page = response.json()
-
-    # If JSON contains an error message, print the message at the key, 'error'
-    if 'errors' in search_page:
-        print(search_page['errors'])
-        urls = []
-    else:
-        urls = cmr_filter_urls(search_page)
-        print("Successfully obtained {} URLs.".format(len(urls)))
+    # Call a CMR granules.json search URL, following the CMR-Search-After
+    # header so results past the first page are not dropped
+    urls = []
+    headers = {}
+    while True:
+        response = requests.get(url, headers=headers)
+        if response.status_code != 200:
+            # the body of an error is often not JSON, so raise the status as a
+            # request error
+            message = 'CMR search failed with HTTP {}'.format(
+                response.status_code)
+            try:
+                message += ': ' + str(response.json()['errors'])
+            except (ValueError, KeyError, TypeError):
+                pass
+            raise requests.exceptions.HTTPError(message, response=response)
+        search_page = response.json()
+
+        # If JSON contains an error message, print the message at the key, 'error'
+        if 'errors' in search_page:
+            print(search_page['errors'])
+            break
+
+        page_urls = cmr_filter_urls(search_page)
+        urls += page_urls
+        search_after = response.headers.get('CMR-Search-After')
+        if len(page_urls) == 0 or search_after is None:
+            break
+        headers['CMR-Search-After'] = search_after
+
+    print("Successfully obtained {} URLs.".format(len(urls)))
 
     return urls
 
@@ -117,91 +141,327 @@ def write_to_csv(IC, availible_file_names, availible_file_links):
     return
 
 
-def cmr_api_url(IC):
-    # Build and call the CMR API URL
-    cmr_query_url = 'https://cmr.earthdata.nasa.gov/search/granules.json?echo_collection_id=' + IC.collection_id + '&page_size=2000'
-    response = requests.get(cmr_query_url)
+def cmr_api_url(IC, temporal=None, cells=None):
+    # Search CMR for the granules which intersect the cells of interest
+    # (defaults to IC.cells) within the temporal range [start, end]. The
+    # granules are stored as IC.granules for use with cmr_file_info.
+    IC.granules = cmr.search_granules_for_cells(IC, cells, temporal)
+    file_names, file_links = cmr.granule_file_links(IC.granules)
 
-    # print error code based on response
-    if response.status_code != 200:
-        print('ERROR: {}'.format(response.status_code))
-    search_page = response.json()
-
-    # If JSON contains an error message, print the message at the key, 'error'
-    if 'errors' in search_page:
-        print(search_page['errors'])
-    else:
-        urls = cmr_filter_urls(search_page)
-        print("Successfully obtained {} URLs.".format(len(urls)))
-
-        # Store the file names in a seperate list
-        availible_file_links = []
-        availible_file_names = []
-        for url in urls:
-            if not 'xml' in url:
-                availible_file_links.append(url)
-                url_parts = url.split('/')
-                file_name = url_parts[-1]
-                availible_file_names.append(file_name)
-        write_to_csv(IC, availible_file_names, availible_file_links)
+    # Store the file names in a seperate list
+    availible_file_links = []
+    availible_file_names = []
+    for ea in range(len(file_links)):
+        if not 'xml' in file_links[ea]:
+            availible_file_links.append(file_links[ea])
+            availible_file_names.append(file_names[ea])
+    write_to_csv(IC, availible_file_names, availible_file_links)
 
     return availible_file_names, availible_file_links
 
 
+def cmr_file_info(IC):
+    # Get the size and checksum CMR reports for every file, as
+    # {file_name: (size, checksum, algorithm)}, reusing the granules of the
+    # last cmr_api_url search if there was one
+    if len(IC.granules) == 0:
+        IC.granules = cmr.search_granules_for_cells(IC, cells=[])
+    file_info = cmr.granule_file_info(IC.granules)
+
+    print("Obtained size and checksum for {} files.".format(len(file_info)))
+
+    return file_info
+
+
 # check for existing files, get a list of files not on disk
-def obtain_download_list(IC, file_names, file_links):
+def obtain_download_list(IC, file_names, file_links, file_info=None):
 
     output_folder = os.path.join(IC.download_path)
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
+    if file_info is None:
+        file_info = {}
+
+    # look the existing files up in the catalog of the download folder
+    # instead of listing the folder for every file
+    existing_sizes = catalog.file_sizes(IC, output_folder, file_names)
 
     download_list_names = []
     download_list_links = []
-    for file in file_names:
+    for i in range(len(file_names)):
+        file = file_names[i]
         download_file = True
-        if file not in os.listdir(os.path.join(output_folder)):
-            for existing_file in os.listdir(os.path.join(output_folder)):
-                if file == existing_file:  # this allows for older versions to be kept
-                    download_file = False
-        else:
-            download_file = False
+        if file in existing_sizes:  # this allows for older versions to be kept
+            download_file = not size_matches(file, existing_sizes, file_info)
 
         if download_file:
             download_list_names.append(file)
-            download_list_links.append(file_links[file_names.index(file)])
+            download_list_links.append(file_links[i])
 
     return (download_list_names, download_list_links)
 
 
-def download_nc_direct(IC, file_names, file_links):
-
-    print('Downloading ' + str(len(file_names)) + ' file(s)...')
+def create_session(n_workers):
+    # A single pooled session shared by every download worker, so connections
+    # (and the Earthdata login redirect) are reused between files
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=n_workers, pool_maxsize=n_workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def checksum_of_file(file_path, algorithm, chunk_size):
+    # hash a file on disk with the algorithm named by CMR (e.g. 'MD5', 'SHA-256')
+    algorithm = algorithm.replace('-', '').lower()
+    if algorithm not in hashlib.algorithms_available:
+        return None
+
+    h = hashlib.new(algorithm)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_is_complete(file_path, info=None):
+    # a file counts as downloaded if it exists and, when CMR reported a size
+    # for it, has that size (older downloads may have been truncated)
+    if not os.path.exists(file_path):
+        return False
+    if info is not None and info[0] is not None:
+        return os.path.getsize(file_path) == info[0]
+    return True
+
+
+def size_matches(file_name, existing_sizes, file_info):
+    # a cataloged file counts as downloaded unless CMR reported a different
+    # size for it (files interrupted before the .part download scheme was
+    # used are truncated and need to be fetched again)
+    info = file_info.get(file_name)
+    if info is None or info[0] is None:
+        return True
+    return info[0] == existing_sizes[file_name]
+
+
+# HTTP errors which are worth retrying (the server is busy or restarting)
+transient_status_codes = [429, 500, 502, 503, 504]
+
+
+def stream_to_file(session, link, output_file, chunk_size, info=None,
+                   max_resumes=3, retry_wait=2):
+    # Stream the response to a temporary .part file in fixed size chunks.
+    # If a .part file is already on disk (or the connection drops, or the
+    # server answers with a transient error), the download is resumed from
+    # the last byte received with a Range request. The .part file is only
+    # renamed into place once its size (and checksum, when CMR reported one)
+    # has been verified. Returns 200 and the number of bytes received, or
+    # the reason of the failure and the number of bytes received.
+    part_file = output_file + '.part'
+    expected_size = None
+    if info is not None:
+        expected_size = info[0]
+
+    n_bytes = 0
+    resumes = 0
+    while True:
+        offset = 0
+        if os.path.exists(part_file):
+            offset = os.path.getsize(part_file)
+        if expected_size is not None and offset > expected_size:
+            # the partial file is longer than the file, so it is corrupt and
+            # the download starts over
+            os.remove(part_file)
+            offset = 0
+
+        headers = {}
+        if offset > 0:
+            if expected_size is not None and offset == expected_size:
+                break
+            headers['Range'] = 'bytes=' + str(offset) + '-'
+
+        try:
+            with session.get(link, allow_redirects=True, stream=True,
+                             headers=headers, timeout=60) as r:
+                if r.status_code == 416:
+                    # the requested range starts past the end of the file,
+                    # so the partial file cannot be resumed
+                    os.remove(part_file)
+                    resumes += 1
+                    if resumes > max_resumes:
+                        return ('HTTP 416, the partial file could not be '
+                                'resumed'), n_bytes
+                    continue
+                if r.status_code in transient_status_codes:
+                    resumes += 1
+                    if resumes > max_resumes:
+                        reason = 'HTTP ' + str(r.status_code) + ' ' + str(
+                            r.reason)
+                        return reason + ' after ' + str(
+                            max_resumes) + ' retries', n_bytes
+                    print('Server error ' + str(r.status_code) +
+                          ', retrying ' + os.path.basename(output_file) +
+                          ' (attempt ' + str(resumes) + ')')
+                    time.sleep(retry_wait * resumes)
+                    continue
+                if r.status_code not in [200, 206]:
+                    return 'HTTP ' + str(r.status_code) + ' ' + str(
+                        r.reason), n_bytes
+
+                if r.status_code == 206:
+                    mode = 'ab'
+                    content_range = r.headers.get('Content-Range', '')
+                    total = content_range.split('/')[-1]
+                else:
+                    # the server ignored the Range header, start over
+                    mode = 'wb'
+                    total = r.headers.get('Content-Length', '')
+                if expected_size is None and total.isdigit():
+                    expected_size = int(total)
+
+                with open(part_file, mode) as f:
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+                        n_bytes += len(chunk)
+            break
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout) as e:
+            resumes += 1
+            if resumes > max_resumes:
+                return type(e).__name__ + ' after ' + str(
+                    max_resumes) + ' resumes: ' + str(e), n_bytes
+            print('Connection dropped, resuming ' + os.path.basename(
+                output_file) + ' (attempt ' + str(resumes) + ')')
+
+    # check the size and checksum of the partial file before moving it
+    size = os.path.getsize(part_file)
+    if expected_size is not None and size != expected_size:
+        if size > expected_size:
+            # a longer partial file cannot be resumed either
+            os.remove(part_file)
+        return 'size mismatch (' + str(size) + ' of ' + str(
+            expected_size) + ' bytes)', n_bytes
+
+    if info is not None and info[1] is not None:
+        checksum = checksum_of_file(part_file, info[2], chunk_size)
+        if checksum is not None and checksum != info[1].lower():
+            # the partial file is corrupt, so it cannot be resumed either
+            os.remove(part_file)
+            return ('checksum mismatch (' + info[2] + ' ' + checksum +
+                    ', expected ' + info[1].lower() + ')'), n_bytes
+
+    os.replace(part_file, output_file)
+
+    return 200, n_bytes
+
+
+def download_urls(IC, file_names, file_links, output_folders=None,
+                  file_info=None):
+    """Download a list of files with a bounded pool of workers.
+
+    Every worker shares one pooled requests.Session and streams its file to
+    disk in chunks of IC.download_chunk_size bytes. output_folders optionally
+    gives the destination folder of each file (defaults to IC.download_path).
+    file_info optionally maps file names to the (size, checksum, algorithm)
+    reported by CMR (see cmr_file_info), which are checked before a file is
+    moved into place. Returns the names and links of the files that could
+    not be downloaded.
+    """
+    if output_folders is None:
+        output_folders = [IC.download_path] * len(file_names)
+    if file_info is None:
+        file_info = {}
 
     not_downloaded_names = []
     not_downloaded_links = []
+    if len(file_names) == 0:
+        return (not_downloaded_names, not_downloaded_links)
+
+    print('Downloading ' + str(len(file_names)) + ' file(s) with ' +
+          str(IC.download_workers) + ' worker(s)...')
+
+    for folder in set(output_folders):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    session = create_session(IC.download_workers)
+    downloaded_files = []
+    downloaded_checksums = []
+    total_bytes = 0
+    n_done = 0
+    start_time = time.time()
+
+    try:
+        with ThreadPoolExecutor(max_workers=IC.download_workers) as executor:
+            futures = {}
+            for i in range(len(file_names)):
+                output_file = os.path.join(output_folders[i], file_names[i])
+                future = executor.submit(stream_to_file, session,
+                                         file_links[i], output_file,
+                                         IC.download_chunk_size,
+                                         file_info.get(file_names[i]))
+                futures[future] = i
+
+            for future in as_completed(futures):
+                i = futures[future]
+                n_done += 1
+                try:
+                    status_code, n_bytes = future.result()
+                except Exception as e:
+                    # a failed file (a network or disk error) is reported
+                    # and the other files carry on
+                    status_code, n_bytes = type(e).__name__ + ': ' + str(
+                        e), 0
+
+                if status_code != 200:
+                    print('ERROR: ' + str(status_code) + '\n')
+                    print('Could not download ' + file_links[i] + '\n')
+                    not_downloaded_names.append(file_names[i])
+                    not_downloaded_links.append(file_links[i])
+                    continue
+
+                total_bytes += n_bytes
+                downloaded_files.append(
+                    os.path.join(output_folders[i], file_names[i]))
+                info = file_info.get(file_names[i])
+                downloaded_checksums.append(None if info is None else info[1])
+                elapsed = max(time.time() - start_time, 1e-6)
+                print('Downloaded ' + str(n_done) + '/' +
+                      str(len(file_names)) + ': ' + file_names[i] +
+                      ' ({:.2f} MB/s)'.format(total_bytes / 1e6 / elapsed),
+                      end='\r')
+    finally:
+        session.close()
+
+        # record the new files in the catalog of downloaded granules, also
+        # when the downloads were interrupted
+        catalog.add_files(IC, downloaded_files, downloaded_checksums)
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    message = 'Downloaded {:.1f} MB in {:.1f} s ({:.2f} MB/s)'.format(
+        total_bytes / 1e6, elapsed, total_bytes / 1e6 / elapsed)
+    IC.output_summary += '\n' + message
+    print('\n' + message)
 
-    for i in range(len(file_names)):
-        print('Downloading ' + str(i + 1) + '/' + str(len(file_names)) + ': ' +
-              file_names[i],
-              end='\r')
-
-        # get request (download file)
-        r = requests.get(file_links[i], allow_redirects=True)
-        if r.status_code != 200:  # 200 is the standard response for successful HTTP requests
-            print('ERROR: ' + str(r.status_code) + '\n')
-            not_downloaded_names.append(file_names[i])
-            not_downloaded_links.append(file_links[i])
-
-        # write content to file
-        open(os.path.join(IC.download_path, file_names[i]),
-             'wb').write(r.content)
     return (not_downloaded_names, not_downloaded_links)
 
 
-def run_download_nc_direct(IC, dl_list_names, dl_list_links):
-    # Download the files
-    not_downloaded_names, not_downloaded_links = download_nc_direct(
-        IC, dl_list_names, dl_list_links)
+def run_download(IC,
+                 file_names,
+                 file_links,
+                 output_folders=None,
+                 file_info=None,
+                 group=None):
+    # Download the files, retry the failures once and list any remaining
+    # failures in not_downloaded.txt. group maps the links which were not
+    # downloaded to the lines of not_downloaded.txt (the links by default).
+    if output_folders is None:
+        output_folders = [IC.download_path] * len(file_names)
+    folder_of = dict(zip(file_links, output_folders))
+
+    not_downloaded_names, not_downloaded_links = download_urls(
+        IC, file_names, file_links, output_folders, file_info)
 
     # Attempt to download any files that were not downloaded the first time
     if len(not_downloaded_names) > 0:
@@ -210,250 +470,182 @@ def run_download_nc_direct(IC, dl_list_names, dl_list_links):
             print(not_downloaded_names[i] + ': ' + not_downloaded_links[i])
 
         print('Attempting to download these files once more...')
-        not_downloaded_names, not_downloaded_links = download_nc_direct(
-            IC, not_downloaded_names, not_downloaded_links)
-        if len(not_downloaded_names) > 0:
-            print(
-                'Please download these files manually and place them in the following folder:'
-            )
-            print(IC.download_path)
-
-
-def download_measures_monthly_files(IC, urls):
-    not_downloaded = []
-    bad_files = 0
-    downloaded = 0
-
-    print("Processing " + str(len(urls)) + " folders")
+        not_downloaded_names, not_downloaded_links = download_urls(
+            IC, not_downloaded_names, not_downloaded_links,
+            [folder_of[link] for link in not_downloaded_links], file_info)
 
-    #for folder in urls:
-    for i in range(len(urls)):
-
-        #    not_downloaded.append(folder_name)
-
-        file_name = urls[i].split('/')[-1]
-
-        # if the file exists already, skip it
-        if os.path.exists(os.path.join(IC.download_path, file_name)):
-            #print('    ' + file_name + ' already exists. Skipping...', end='\n')
-            continue
-
-        # only download the tif files
-        if file_name.endswith('.tif'):
-            print('    Downloading ' + file_name, end='\n')
-
-            r = requests.get(urls[i], allow_redirects=True)
-            if r.status_code != 200:  # 200 is the standard response for successful HTTP requests
-                print('    ERROR: ' + str(r.status_code) + '\n')
-                print('    Could not download ' + urls[i] + '\n')
-
-                # Add the link to the list of files that were not downloaded
-                not_downloaded.append(urls[i])
-                bad_files += 1
-                continue
-
-            # write content to file
-            #open(os.path.join(GC.data_folder, GC.region_name, 'Velocity', 'MEaSUREs', GC.collection_key, 'Data', folder_name, file_name), 'wb').write(r.content)
-            open(os.path.join(IC.download_path, file_name),
-                 'wb').write(r.content)
-            downloaded += 1
-
-    if (len(not_downloaded) > 0):
-        print('WARNING: ' + str(bad_files) + ' file(s) were not downloaded.')
-    else:
-        print(str(downloaded) + ' files downloaded successfully.')
-
-    return not_downloaded
-
-
-def run_download_measures_monthly_files(IC, urls):
-
-    not_downloaded = download_measures_monthly_files(IC, urls)
-
-    # Attempt to download any files that were not downloaded the first time
-    if len(not_downloaded) > 0:
-        print('Attempting to download these files once more...')
-        not_downloaded = download_measures_monthly_files(IC, not_downloaded)
-        if len(not_downloaded) > 0:
+        if len(not_downloaded_names) > 0:
             print('WARNING: some files were not downloaded.')
             print(
                 'Please download the files manually and place in the corresponding folder:'
             )
+            print(IC.download_path)
             print('See file: ' +
                   os.path.join(IC.download_path, 'not_downloaded.txt'))
             print('\n')
 
             # store the list of files that were not downloaded in a text file
+            if group is None:
+                items = not_downloaded_links
+            else:
+                items = group(not_downloaded_links)
             with open(os.path.join(IC.download_path, 'not_downloaded.txt'),
                       'w') as f:
-                for item in not_downloaded:
+                for item in items:
                     f.write("%s\n" % item)
 
-    elif len(not_downloaded) == 0:
+    if len(not_downloaded_names) == 0:
         print('All files downloaded successfully.')
 
-    return not_downloaded
-
+    return (not_downloaded_names, not_downloaded_links)
 
-### REVIEW THE FOLLOWING THREE FUNCTIONS FOR REVISION OR REMOVAL
-def download_files(IC, urls):
-    bad_folders = []
-    bad_files = 0
-    downloaded = 0
 
-    print("Processing " + str(len(urls)) + " folders")
+def download_nc_direct(IC, file_names, file_links, file_info=None):
+    return download_urls(IC, file_names, file_links, file_info=file_info)
 
-    #for folder in urls:
-    for i in range(len(urls)):
-        folder = urls[i]
-        folder_name = folder[0]
 
-        # if verbose or verbose_light:
-        #     print("Processing folder " + str(i + 1) + "/" + str(len(urls)) +
-        #           ": " + folder_name)
+def run_download_nc_direct(IC, dl_list_names, dl_list_links, file_info=None):
+    return run_download(IC, dl_list_names, dl_list_links, file_info=file_info)
 
-        not_downloaded = []
-        not_downloaded.append(folder_name)
 
-        for link in folder[1:]:
-            file_name = link.split('/')[-1]
+def measures_monthly_download_list(IC, urls, file_info=None):
+    # only download the tif files which do not exist yet
+    file_names = []
+    file_links = []
+    if file_info is None:
+        file_info = {}
+    existing_sizes = catalog.file_sizes(IC,
+                                        file_names=[
+                                            url.split('/')[-1] for url in urls
+                                        ])
+    for url in urls:
+        file_name = url.split('/')[-1]
 
-            # if the file exists already, skip it
-            if os.path.exists(os.path.join(IC.download_path, file_name)):
-                #print('    ' + file_name + ' already exists. Skipping...', end='\n')
-                continue
+        # if the file exists already, skip it
+        if file_name in existing_sizes and size_matches(
+                file_name, existing_sizes, file_info):
+            continue
 
-            # only download the tif files
-            if file_name.endswith('.tif'):
-                print('    Downloading ' + file_name, end='\n')
+        if file_name.endswith('.tif'):
+            file_names.append(file_name)
+            file_links.append(url)
 
-                r = requests.get(link, allow_redirects=True)
-                if r.status_code != 200:  # 200 is the standard response for successful HTTP requests
-                    print('    ERROR: ' + str(r.status_code) + '\n')
-                    print('    Could not download ' + link + '\n')
+    return (file_names, file_links)
 
-                    # Add the link to the list of files that were not downloaded
-                    not_downloaded.append([link])
-                    bad_files += 1
-                    continue
 
-                # write content to file
-                #open(os.path.join(GC.data_folder, GC.region_name, 'Velocity', 'MEaSUREs', GC.collection_key, 'Data', folder_name, file_name), 'wb').write(r.content)
-                open(os.path.join(IC.download_path, file_name),
-                     'wb').write(r.content)
-                downloaded += 1
+def download_measures_monthly_files(IC, urls, file_info=None):
+    print("Processing " + str(len(urls)) + " files")
 
-        if (len(not_downloaded)) > 1:
-            bad_folders.append(not_downloaded)
+    file_names, file_links = measures_monthly_download_list(
+        IC, urls, file_info)
+    not_downloaded_names, not_downloaded = download_urls(
+        IC, file_names, file_links, file_info=file_info)
 
-    if (len(bad_folders) > 0):
-        print('WARNING: ' + str(bad_files) + ' file(s) were not downloaded.')
+    if (len(not_downloaded) > 0):
+        print('WARNING: ' + str(len(not_downloaded)) +
+              ' file(s) were not downloaded.')
     else:
-        print(str(downloaded) + ' files downloaded successfully.')
+        print(str(len(file_names)) + ' files downloaded successfully.')
 
-    return bad_folders
+    return not_downloaded
 
 
-def download_nested_files(IC, urls):
-    bad_folders = []
-    bad_files = 0
-    downloaded = 0
+def run_download_measures_monthly_files(IC, urls, file_info=None):
+    print("Processing " + str(len(urls)) + " files")
 
-    print("Processing " + str(len(urls)) + " folders")
+    file_names, file_links = measures_monthly_download_list(
+        IC, urls, file_info)
+    not_downloaded_names, not_downloaded = run_download(
+        IC, file_names, file_links, file_info=file_info)
 
-    #for folder in urls:
-    for i in range(len(urls)):
-        folder = urls[i]
-        folder_name = folder[0]
+    return not_downloaded
 
-        # if verbose or verbose_light:
-        #     print("Processing folder " + str(i + 1) + "/" + str(len(urls)) +
-        #           ": " + folder_name)
 
-        not_downloaded = []
-        not_downloaded.append(folder_name)
+### REVIEW THE FOLLOWING THREE FUNCTIONS FOR REVISION OR REMOVAL
+def folder_download_list(IC, urls, nested, file_info=None):
+    # flatten [folder_name, link, link, ...] lists into the tif files which
+    # do not exist yet and the folder each one is stored in. The links can
+    # also be [link] lists, as returned for the files which failed.
+    file_names = []
+    file_links = []
+    output_folders = []
+    if file_info is None:
+        file_info = {}
+    for folder in urls:
+        folder_name = folder[0]
+        if nested:
+            output_folder = os.path.join(IC.download_path, folder_name)
+        else:
+            output_folder = IC.download_path
 
         for link in folder[1:]:
+            if isinstance(link, list):
+                link = link[0]
             file_name = link.split('/')[-1]
 
             # if the file exists already, skip it
-            if os.path.exists(
-                    os.path.join(IC.download_path, folder_name, file_name)):
-                # if verbose:
-                #     print('    ' + file_name + ' already exists. Skipping...',
-                #           end='\n')
-                continue
-            if not file_name.endswith('.tif'):
-                # if verbose:
-                #     print('    ' + file_name + ' is not a tif. Skipping...',
-                #           end='\n')
+            if file_is_complete(os.path.join(output_folder, file_name),
+                                file_info.get(file_name)):
                 continue
 
             # only download the tif files
             if file_name.endswith('.tif'):
-                if not os.path.exists(
-                        os.path.join(IC.download_path, folder_name)):
-                    os.makedirs(os.path.join(IC.download_path, folder_name))
+                file_names.append(file_name)
+                file_links.append(link)
+                output_folders.append(output_folder)
 
-                #if verbose or verbose_light:
-                print('    Downloading ' + file_name, end='\n')
+    return (file_names, file_links, output_folders)
 
-                r = requests.get(link, allow_redirects=True)
-                if r.status_code != 200:  # 200 is the standard response for successful HTTP requests
-                    print('    ERROR: ' + str(r.status_code) + '\n')
-                    print('    Could not download ' + link + '\n')
 
-                    # Add the link to the list of files that were not downloaded
-                    not_downloaded.append([link])
-                    bad_files += 1
-                    continue
+def group_by_folder(urls, links):
+    # rebuild the [folder_name, [link], [link], ...] lists of the folders
+    # with the given links
+    bad_folders = []
+    for folder in urls:
+        bad_links = []
+        for link in folder[1:]:
+            if isinstance(link, list):
+                link = link[0]
+            if link in links:
+                bad_links.append([link])
+        if len(bad_links) > 0:
+            bad_folders.append([folder[0]] + bad_links)
+    return bad_folders
 
-                # write content to file
-                #open(os.path.join(GC.data_folder, GC.region_name, 'Velocity', 'MEaSUREs', GC.collection_key, 'Data', folder_name, file_name), 'wb').write(r.content)
-                open(os.path.join(IC.download_path, folder_name, file_name),
-                     'wb').write(r.content)
-                downloaded += 1
 
-        if (len(not_downloaded)) > 1:
-            bad_folders.append(not_downloaded)
+def download_folders(IC, urls, nested, file_info=None):
+    print("Processing " + str(len(urls)) + " folders")
+
+    file_names, file_links, output_folders = folder_download_list(
+        IC, urls, nested, file_info)
+    not_downloaded_names, not_downloaded_links = download_urls(
+        IC, file_names, file_links, output_folders, file_info)
+    bad_folders = group_by_folder(urls, set(not_downloaded_links))
 
     if (len(bad_folders) > 0):
-        print('WARNING: ' + str(bad_files) + ' file(s) were not downloaded.')
+        print('WARNING: ' + str(len(not_downloaded_links)) +
+              ' file(s) were not downloaded.')
     else:
-        print(str(downloaded) + ' files downloaded successfully.')
+        print(str(len(file_names)) + ' files downloaded successfully.')
 
     return bad_folders
 
 
-def run_download_files(IC, urls, nested):
-    # Download the files
-    if nested:
-        not_downloaded = download_nested_files(IC, urls)
-    else:
-        not_downloaded = download_files(IC, urls)
+def download_files(IC, urls, file_info=None):
+    return download_folders(IC, urls, False, file_info)
 
-    # Attempt to download any files that were not downloaded the first time
-    if len(not_downloaded) > 0:
-        print('Attempting to download these files once more...')
-        if nested:
-            not_downloaded = download_nested_files(IC, not_downloaded)
-        else:
-            not_downloaded = download_files(IC, not_downloaded)
-        if len(not_downloaded) > 0:
-            print('WARNING: some files were not downloaded.')
-            print(
-                'Please download the files manually and place in the corresponding folder:'
-            )
-            print('See file: ' +
-                  os.path.join(IC.download_path, 'not_downloaded.txt'))
-            print('\n')
 
-            # store the list of files that were not downloaded in a text file
-            with open(os.path.join(IC.download_path, 'not_downloaded.txt'),
-                      'w') as f:
-                for item in not_downloaded:
-                    f.write("%s\n" % item)
+def download_nested_files(IC, urls, file_info=None):
+    return download_folders(IC, urls, True, file_info)
 
-    if len(not_downloaded) == 0:
-        print('All files downloaded successfully.')
-    return not_downloaded
\ No newline at end of file
+
+def run_download_files(IC, urls, nested, file_info=None):
+    print("Processing " + str(len(urls)) + " folders")
+
+    file_names, file_links, output_folders = folder_download_list(
+        IC, urls, nested, file_info)
+    not_downloaded_names, not_downloaded_links = run_download(
+        IC, file_names, file_links, output_folders, file_info,
+        lambda links: group_by_folder(urls, set(links)))
+
+    return group_by_folder(urls, set(not_downloaded_links))
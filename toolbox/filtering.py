@@ -1,8 +1,10 @@
 
 import numpy as np
 import os
+import warnings
 from toolbox.file_io import read_timeseries_nc
 from toolbox.series import smooth_timeseries_seasonally
+from toolbox.series import smooth_stack_seasonally, interpolate_stack
 from scipy.interpolate import interp1d
 from toolbox.file_io import write_timeseries_nc
 
@@ -34,6 +36,58 @@ def filter_by_seasonally_smoothing(timeseries,sources,n_sigma=2):
     return(filtered_timeseries,filtered_sources)
 
 
+def filter_stack_by_seasonally_smoothing(time,stack,n_sigma=2,pixels_per_block=1024):
+    # filter_by_seasonally_smoothing for every pixel of a (time, y, x) stack
+    # (or a chunk of one) at once. time is in decimal years and the stack can
+    # have nan gaps. Returns a boolean mask of the stack which is True where a
+    # value is more than n_sigma standard deviations of its pixel's residuals
+    # from the smoothed series. The pixels are smoothed in blocks of
+    # pixels_per_block to limit the size of the daily grids.
+    time = np.asarray(time,dtype=float)
+    values = np.reshape(np.asarray(stack,dtype=float),(len(time),-1))
+    mask = np.zeros(np.shape(values),dtype=bool)
+
+    for p in range(0,np.shape(values)[1],pixels_per_block):
+        block = values[:,p:p+pixels_per_block]
+        dense_time, smooth_block = smooth_stack_seasonally(time,block)
+        differences = np.abs(block-interpolate_stack(dense_time,smooth_block,time))
+
+        valid = np.isfinite(differences)
+        with warnings.catch_warnings():
+            # pixels without any values have a nan stdev
+            warnings.simplefilter('ignore',RuntimeWarning)
+            stdev = np.nanstd(differences,axis=0)
+        with np.errstate(invalid='ignore'):
+            mask[:,p:p+pixels_per_block] = valid & (differences > n_sigma*stdev)
+
+    return(np.reshape(mask,np.shape(stack)))
+
+
+def filter_stack_file(output_file,variables,n_sigma=2,rows_per_block=32,profile=None):
+    # Filter the (time, y, x) variables of a per-cell stack and store the
+    # masks next to them as <variable>_mask (1 where a value was filtered
+    # out). The stack is read in blocks of rows.
+    import toolbox.store_nc as store
+
+    ds = store.open_stack(output_file,'a')
+    if 'time_start' in ds.variables:
+        time = (np.array(ds.variables['time_start'][:],dtype=float)+np.array(ds.variables['time_end'][:],dtype=float))/2
+    else:
+        time = np.array(ds.variables['time'][:],dtype=float)
+    # the times are stored as timestamps
+    time = time/(365.25*24*60*60)+1970
+
+    n_rows = ds.variables[variables[0]].shape[1]
+    for variable in variables:
+        mask_variable = store.add_mask_variable(ds,variable+'_mask',variable,profile)
+        for r in range(0,n_rows,rows_per_block):
+            block = np.ma.filled(ds.variables[variable][:,r:r+rows_per_block,:].astype(float),np.nan)
+            mask_variable[:,r:r+rows_per_block,:] = filter_stack_by_seasonally_smoothing(time,block,n_sigma).astype('u1')
+    ds.close()
+
+    print('Saved the filter masks of '+', '.join(variables)+' to '+output_file)
+
+
 
 
 
@@ -1,8 +1,8 @@
 import shapefile
-from osgeo import osr
 import os
-import xarray as xr
+import collections.abc
 import numpy as np
+import toolbox.memory as memory
 
 
 # Function to generate a grid bound dictionary for a given region (greenland or antarctic)
@@ -15,21 +15,133 @@ def grid_bounds(region):
     return grid_dict[region.title()]
 
 
+def cell_ID_from_row_col(row, col):
+    return 'r_' + '{:02d}'.format(row) + '_c_' + '{:02d}'.format(col)
+
+
+def cell_ID_to_row_col(cell_ID):
+    # (row, col) of a cell ID like 'r_03_c_12'
+    parts = cell_ID.split('_')
+    if len(parts) != 4 or parts[0] != 'r' or parts[2] != 'c':
+        raise KeyError(cell_ID)
+    return int(parts[1]), int(parts[3])
+
+
+def cell_IDs_to_rows_cols(cell_IDs):
+    # arrays of the rows and cols of a list of cell IDs
+    rows_cols = np.array([cell_ID_to_row_col(c) for c in cell_IDs],
+                         dtype=int).reshape(-1, 2)
+    return rows_cols[:, 0], rows_cols[:, 1]
+
+
+class GridIndex(collections.abc.Mapping):
+    # A regular grid of cells, stored as its origin (the lower left corner),
+    # the size of a cell (in m) and its number of rows and cols. The bounds
+    # of a cell and the cell of a point are computed instead of looked up,
+    # for one cell or for arrays of them. It is also a read-only mapping of
+    # 'r_XX_c_YY' cell IDs to [min_x, min_y, max_x, max_y], in the row by
+    # row order of the old grid dictionaries, so it can be used as the
+    # IC.grid_dict.
+    def __init__(self, min_x, min_y, step, n_rows, n_cols):
+        self.min_x = min_x
+        self.min_y = min_y
+        self.step = step
+        self.n_rows = int(n_rows)
+        self.n_cols = int(n_cols)
+
+    def __repr__(self):
+        return ('GridIndex(' + str(self.n_rows) + ' rows, ' +
+                str(self.n_cols) + ' cols, ' + str(self.step) + ' m cells)')
+
+    @property
+    def shape(self):
+        return (self.n_rows, self.n_cols)
+
+    def contains_row_col(self, rows, cols):
+        return ((np.asarray(rows) >= 0) & (np.asarray(rows) < self.n_rows) &
+                (np.asarray(cols) >= 0) & (np.asarray(cols) < self.n_cols))
+
+    def bounds(self, rows, cols):
+        # [min_x, min_y, max_x, max_y] of each (row, col), as an (..., 4)
+        # array
+        rows = np.asarray(rows)
+        cols = np.asarray(cols)
+        return np.stack([
+            self.min_x + cols * self.step, self.min_y + rows * self.step,
+            self.min_x + (cols + 1) * self.step,
+            self.min_y + (rows + 1) * self.step
+        ],
+                        axis=-1)
+
+    def points_to_rows_cols(self, x, y):
+        # (row, col) of the cell of each point; points outside of the grid
+        # get a row and col of -1
+        rows = np.floor(
+            (np.asarray(y, dtype=float) - self.min_y) / self.step).astype(int)
+        cols = np.floor(
+            (np.asarray(x, dtype=float) - self.min_x) / self.step).astype(int)
+        outside = ~self.contains_row_col(rows, cols)
+        return np.where(outside, -1, rows), np.where(outside, -1, cols)
+
+    def points_to_cell_IDs(self, x, y):
+        # the cell ID of each point, or None for points outside of the grid
+        rows, cols = self.points_to_rows_cols(np.ravel(x), np.ravel(y))
+        return [
+            cell_ID_from_row_col(r, c) if r >= 0 else None
+            for r, c in zip(rows, cols)
+        ]
+
+    def __getitem__(self, cell_ID):
+        # only the canonical IDs of the cells are keys, as in a dict of them
+        if not isinstance(cell_ID, str):
+            raise KeyError(cell_ID)
+        try:
+            row, col = cell_ID_to_row_col(cell_ID)
+        except ValueError:
+            raise KeyError(cell_ID)
+        if cell_ID != cell_ID_from_row_col(
+                row, col) or not self.contains_row_col(row, col):
+            raise KeyError(cell_ID)
+        return [
+            self.min_x + (col * self.step), self.min_y + (row * self.step),
+            self.min_x + ((col + 1) * self.step),
+            self.min_y + ((row + 1) * self.step)
+        ]
+
+    def __iter__(self):
+        for row in range(self.n_rows):
+            for col in range(self.n_cols):
+                yield cell_ID_from_row_col(row, col)
+
+    def __len__(self):
+        return self.n_rows * self.n_cols
+
+
 def generate_grid_dictionary(min_x, min_y, max_x, max_y, resolution_km):
 
     step = resolution_km * 1000  # Convert to meters
 
-    grid_dict = {}
-    for row in range(0, int((max_y - min_y) / step) + 1):
-        y_1 = min_y + (row * step)
-        y_2 = min_y + ((row + 1) * step)
-        for col in range(0, int((max_x - min_x) / step) + 1):
-            x_1 = min_x + (col * step)
-            x_2 = min_x + ((col + 1) * step)
-            grid_dict['r_' + str(row).zfill(2) + '_c_' +
-                      str(col).zfill(2)] = [x_1, y_1, x_2, y_2]
+    n_rows = int((max_y - min_y) / step) + 1
+    n_cols = int((max_x - min_x) / step) + 1
+    return GridIndex(min_x, min_y, step, n_rows, n_cols)
+
 
-    return grid_dict
+def grid_cells_by_col(grid_dict):
+    # every cell ID of a grid and its bounds, col by col. The bounds of a
+    # GridIndex are computed at once; a plain grid dictionary is looked up.
+    if isinstance(grid_dict, GridIndex):
+        cols, rows = np.meshgrid(np.arange(grid_dict.n_cols),
+                                 np.arange(grid_dict.n_rows),
+                                 indexing='ij')
+        rows = rows.ravel()
+        cols = cols.ravel()
+        cell_IDs = [cell_ID_from_row_col(r, c) for r, c in zip(rows, cols)]
+        return cell_IDs, grid_dict.bounds(rows, cols).tolist()
+
+    rows, cols = cell_IDs_to_rows_cols(list(grid_dict))
+    order = np.lexsort((rows, cols))
+    cell_IDs = [cell_ID_from_row_col(rows[i], cols[i]) for i in order]
+    return cell_IDs, [list(grid_dict[cell_ID]) for cell_ID in cell_IDs]
 
 
 def create_shapefile(IC):
@@ -46,6 +158,7 @@ def create_shapefile(IC):
         )
         return
 
+    from osgeo import osr
     osr.UseExceptions()
     output_path = os.path.join(IC.project_folder, "Metadata", IC.icesheet_name,
                                IC.data_type.title(),
@@ -56,18 +169,13 @@ def create_shapefile(IC):
     records = []
     polygons = []
 
-    col_range = int(list(IC.grid_dict.keys())[-1].split('_')[-1]) + 1
-    row_range = int(list(IC.grid_dict.keys())[-1].split('_')[1]) + 1
-
-    for col in range(col_range):
-        for row in range(row_range):
-            cell_ID = 'r_' + '{:02d}'.format(row) + '_c_' + '{:02d}'.format(
-                col)
-            bounds = IC.grid_dict[cell_ID]
-            polygon = [[bounds[0], bounds[1]], [bounds[2], bounds[1]],
-                       [bounds[2], bounds[3]], [bounds[0], bounds[3]]]
-            records.append(cell_ID)
-            polygons.append(polygon)
+    cell_IDs, all_bounds = grid_cells_by_col(IC.grid_dict)
+    for cc in range(len(cell_IDs)):
+        bounds = all_bounds[cc]
+        polygon = [[bounds[0], bounds[1]], [bounds[2], bounds[1]],
+                   [bounds[2], bounds[3]], [bounds[0], bounds[3]]]
+        records.append(cell_IDs[cc])
+        polygons.append(polygon)
 
     w = shapefile.Writer(output_path)
 
@@ -118,51 +226,234 @@ def create_grid(IC):
 
 # Store the cells of interest as IC object attribute (IC.cells)
 def store_cells(IC, grid):
-    IC.cells = []
-    for row in range(grid[0], grid[2] + 1):
-        for col in range(grid[1], grid[3] + 1):
-            cell_ID = 'r_' + '{:02d}'.format(row) + '_c_' + '{:02d}'.format(
-                col)
-            if cell_ID not in IC.cells:
-                IC.cells.append(cell_ID)
-    IC.cells = sorted(IC.cells)
+    # grid is [min_row, min_col, max_row, max_col]; each cell is listed once
+    IC.cells = sorted([
+        cell_ID_from_row_col(row, col)
+        for row in range(grid[0], grid[2] + 1)
+        for col in range(grid[1], grid[3] + 1)
+    ])
+    print("Cells: ", IC.cells)
+    return
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Spatial queries of the cells
+#
+# Find the cells which cover a list of points or the outline of an area,
+# so only those cells are downloaded and processed. Points and polygons can
+# be given in another projection (e.g. lon/lat in EPSG:4326), in which case
+# they are reprojected to the projection of the grid first. A polygon covers
+# the cells its outline passes through and the cells whose centers are
+# inside it.
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def grid_index(IC):
+    if not isinstance(IC.grid_dict, GridIndex):
+        raise ValueError(
+            'The spatial queries need the grid from create_grid (a GridIndex)')
+    return IC.grid_dict
+
+
+def to_grid_projection(IC, x, y, epsg=None):
+    import toolbox.reprojection as reprojection
+
+    x = np.ravel(np.asarray(x, dtype=float))
+    y = np.ravel(np.asarray(y, dtype=float))
+    if epsg is None or int(epsg) == int(IC.epsg):
+        return x, y
+    return reprojection.transform_points(x, y, epsg, IC.epsg)
+
+
+def cell_IDs_from_rows_cols(rows, cols):
+    # sorted unique cell IDs of the (row, col) pairs inside of the grid
+    inside = (rows >= 0) & (cols >= 0)
+    pairs = np.unique(np.column_stack([rows[inside], cols[inside]]), axis=0)
+    return sorted([cell_ID_from_row_col(r, c) for r, c in pairs])
+
+
+def cells_for_points(IC, x, y, epsg=None):
+    # The cells which contain the points x, y (lon, lat for EPSG:4326).
+    # Points outside of the grid are ignored.
+    x, y = to_grid_projection(IC, x, y, epsg)
+    rows, cols = grid_index(IC).points_to_rows_cols(x, y)
+    return cell_IDs_from_rows_cols(rows, cols)
+
+
+def densify_ring(ring, points_per_edge=32):
+    # add points along the edges of a closed ring, so it keeps its shape
+    # when it is reprojected
+    ring = np.asarray(ring, dtype=float)
+    if not np.array_equal(ring[0], ring[-1]):
+        ring = np.vstack([ring, ring[:1]])
+    fractions = np.arange(points_per_edge) / points_per_edge
+    starts = ring[:-1, np.newaxis, :]
+    ends = ring[1:, np.newaxis, :]
+    dense = starts + fractions[np.newaxis, :, np.newaxis] * (ends - starts)
+    return np.vstack([np.reshape(dense, (-1, 2)), ring[:1]])
+
+
+def ring_edges(rings):
+    # the starts and ends of the edges of closed rings, as (N, 2) arrays
+    starts = np.vstack([ring[:-1] for ring in rings])
+    ends = np.vstack([ring[1:] for ring in rings])
+    return starts, ends
+
+
+def points_in_rings(x, y, rings, chunk_size=2**20):
+    # Even-odd test of which points are inside of the closed rings of a
+    # polygon, so the points in a hole are outside. Every edge is tested
+    # against a chunk of the points at once, with about chunk_size pairs of
+    # points and edges in a chunk.
+    x = np.ravel(np.asarray(x, dtype=float))
+    y = np.ravel(np.asarray(y, dtype=float))
+    starts, ends = ring_edges(rings)
+    # horizontal edges are never crossed
+    sloped = starts[:, 1] != ends[:, 1]
+    x1, y1 = starts[sloped, 0], starts[sloped, 1]
+    x2, y2 = ends[sloped, 0], ends[sloped, 1]
+
+    inside = np.zeros(len(x), dtype=bool)
+    n_points = max(1, chunk_size // max(1, len(x1)))
+    for p0 in range(0, len(x), n_points):
+        px = x[p0:p0 + n_points, np.newaxis]
+        py = y[p0:p0 + n_points, np.newaxis]
+        crosses = (y1 > py) != (y2 > py)
+        x_cross = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+        crossings = np.count_nonzero(crosses & (px < x_cross), axis=1)
+        inside[p0:p0 + n_points] = crossings % 2 == 1
+    return inside
+
+
+def line_crossings(starts, ends, origin, step):
+    # The edge and the fraction along the edge of every crossing of the
+    # edges with the grid lines origin + k * step of one axis
+    low = np.minimum(starts, ends)
+    high = np.maximum(starts, ends)
+    first = np.ceil((low - origin) / step).astype(int)
+    counts = np.floor((high - origin) / step).astype(int) - first + 1
+    counts[starts == ends] = 0
+    counts = np.maximum(counts, 0)
+
+    edges = np.repeat(np.arange(len(starts)), counts)
+    k = first[edges] + np.arange(len(edges)) - np.repeat(
+        np.cumsum(counts) - counts, counts)
+    lines = origin + step * k
+    return edges, (lines - starts[edges]) / (ends[edges] - starts[edges])
+
+
+def ring_rows_cols(grid, rings):
+    # (row, col) of every cell which the edges of the rings pass through.
+    # Each edge is split where it crosses the grid lines, and the middle of
+    # every piece is in one of the cells it passes through. All of the edges
+    # are split at once.
+    starts, ends = ring_edges(rings)
+    edges = [np.arange(len(starts)), np.arange(len(starts))]
+    fractions = [np.zeros(len(starts)), np.ones(len(starts))]
+    for axis, origin in [(0, grid.min_x), (1, grid.min_y)]:
+        e, f = line_crossings(starts[:, axis], ends[:, axis], origin,
+                              grid.step)
+        edges.append(e)
+        fractions.append(f)
+    edges = np.concatenate(edges)
+    fractions = np.clip(np.concatenate(fractions), 0, 1)
+
+    # the pieces between consecutive (distinct) crossings of an edge
+    order = np.lexsort((fractions, edges))
+    edges = edges[order]
+    fractions = fractions[order]
+    # (every edge has at least the piece from 0 to 1)
+    piece = (edges[:-1] == edges[1:]) & (fractions[:-1] < fractions[1:])
+    piece_edges = edges[:-1][piece]
+    middles = (fractions[:-1][piece] + fractions[1:][piece]) / 2
+    points = starts[piece_edges] + middles[:, np.newaxis] * (
+        ends[piece_edges] - starts[piece_edges])
+    return grid.points_to_rows_cols(points[:, 0], points[:, 1])
+
+
+def cells_for_polygon(IC, polygon, epsg=None):
+    # The cells which intersect a polygon, given as an (N, 2) array of the
+    # x, y (lon, lat for EPSG:4326) of its outline, or a list of them for a
+    # polygon with several parts or holes (a cell is inside by the even-odd
+    # rule over all of the rings)
+    grid = grid_index(IC)
+    if np.ndim(polygon[0]) == 1:
+        polygon = [polygon]
+
+    rings = []
+    for ring in polygon:
+        ring = np.asarray(ring, dtype=float)
+        if epsg is not None and int(epsg) != int(IC.epsg):
+            ring = densify_ring(ring)
+        x, y = to_grid_projection(IC, ring[:, 0], ring[:, 1], epsg)
+        ring = np.column_stack([x, y])
+        if not np.array_equal(ring[0], ring[-1]):
+            ring = np.vstack([ring, ring[:1]])
+        rings.append(ring)
+
+    # the cells the outlines pass through
+    rows, cols = ring_rows_cols(grid, rings)
+
+    # the cells inside of the polygon, tested by their centers, so the cells
+    # inside of a hole are left out
+    x = np.concatenate([ring[:, 0] for ring in rings])
+    y = np.concatenate([ring[:, 1] for ring in rings])
+    (min_row, min_col), (max_row, max_col) = [
+        grid.points_to_rows_cols(
+            np.clip(xy[0], grid.min_x,
+                    grid.min_x + grid.n_cols * grid.step - grid.step / 2),
+            np.clip(xy[1], grid.min_y,
+                    grid.min_y + grid.n_rows * grid.step - grid.step / 2))
+        for xy in [(np.min(x), np.min(y)), (np.max(x), np.max(y))]
+    ]
+    box_cols, box_rows = np.meshgrid(np.arange(min_col, max_col + 1),
+                                     np.arange(min_row, max_row + 1))
+    box_rows = box_rows.ravel()
+    box_cols = box_cols.ravel()
+    centers = grid.bounds(box_rows, box_cols)
+    inside = points_in_rings((centers[:, 0] + centers[:, 2]) / 2,
+                             (centers[:, 1] + centers[:, 3]) / 2, rings)
+
+    return cell_IDs_from_rows_cols(
+        np.concatenate([rows, box_rows[inside]]),
+        np.concatenate([cols, box_cols[inside]]))
+
+
+# Store the cells which cover points or a polygon as IC.cells
+def store_cells_from_points(IC, x, y, epsg=None):
+    IC.cells = cells_for_points(IC, x, y, epsg)
+    print("Cells: ", IC.cells)
+    return
+
+
+def store_cells_from_polygon(IC, polygon, epsg=None):
+    IC.cells = cells_for_polygon(IC, polygon, epsg)
     print("Cells: ", IC.cells)
     return
 
 
 def organize_quilt_grid_input(cell_IDs):
-    lowest_row = 1e10
-    highest_row = -1e10
-    lowest_col = 1e10
-    highest_col = -1e10
-    for cell_ID in cell_IDs:
-        row = int(cell_ID.split('_')[1])
-        col = int(cell_ID.split('_')[3])
-        if row < lowest_row:
-            lowest_row = row
-        if row > highest_row:
-            highest_row = row
-        if col < lowest_col:
-            lowest_col = col
-        if col > highest_col:
-            highest_col = col
+    rows, cols = cell_IDs_to_rows_cols(cell_IDs)
+    lowest_row = int(np.min(rows))
+    highest_row = int(np.max(rows))
+    lowest_col = int(np.min(cols))
+    highest_col = int(np.max(cols))
     row_col_extents = [lowest_row, highest_row, lowest_col, highest_col]
 
-    ordered_cell_ID_grid = []
-    for row in range(lowest_row, highest_row + 1):
-        row_cells = []
-        for col in range(lowest_col, highest_col + 1):
-            cell_test = 'r_' + '{:02d}'.format(row) + '_c_' + '{:02d}'.format(
-                col)
-            if cell_test in cell_IDs:
-                row_cells.append(cell_test)
-            else:
-                row_cells.append('')
-        ordered_cell_ID_grid.append(row_cells)
-    return (ordered_cell_ID_grid, row_col_extents)
+    # place each cell in the rows and cols it spans ('' where there is none)
+    ordered_cell_ID_grid = np.full(
+        (highest_row - lowest_row + 1, highest_col - lowest_col + 1),
+        '',
+        dtype=object)
+    ordered_cell_ID_grid[rows - lowest_row, cols - lowest_col] = [
+        cell_ID_from_row_col(r, c) for r, c in zip(rows, cols)
+    ]
+    return (ordered_cell_ID_grid.tolist(), row_col_extents)
 
 
 def create_input_file_path_dict(IC):
+    import toolbox.store_nc as store
+
     output_path = os.path.join(
         IC.data_folder, 'Output',
         IC.icesheet_name)  # + IC.glacier_name + "_stack.nc")
@@ -170,8 +461,7 @@ def create_input_file_path_dict(IC):
     input_file_path_dict = {}
 
     for cell in IC.cells:
-        output_file = os.path.join(output_path, cell,
-                                   IC.short_name + "_stack.nc")
+        output_file = store.stack_path(IC, cell)
         output_files.append(output_file)
 
         #check if file exists
@@ -190,34 +480,20 @@ def quilt_grids_by_path(IC_object,
                         grid_variable_label,
                         resolution,
                         no_data_value=0):
-    lowest_row = 1e10
-    highest_row = -1e10
-    lowest_col = 1e10
-    highest_col = 1e10
     cell_IDs, grid_dict = IC_object.cells, IC_object.grid_dict
 
-    for cell_ID in cell_IDs:
-        row = int(cell_ID.split('_')[1])
-        col = int(cell_ID.split('_')[3])
-        if row < lowest_row:
-            lowest_row = row
-        if row >= highest_row:  # >= to make sure the highest row/col is included if there is only 1 row/col
-            highest_row = row
-        if col < lowest_col:
-            lowest_col = col
-        if col >= lowest_col:
-            highest_col = col
+    ordered_cell_ID_grid, row_col_extents = organize_quilt_grid_input(
+        cell_IDs)
+    lowest_row, highest_row, lowest_col, highest_col = row_col_extents
 
     print("Lowest row: ", lowest_row)
     print("Highest row: ", highest_row)
     print("Lowest col: ", lowest_col)
     print("Highest col: ", highest_col)
 
-    UR_cell = 'r_' + '{:02d}'.format(highest_row) + '_c_' + '{:02d}'.format(
-        highest_col)
+    UR_cell = cell_ID_from_row_col(highest_row, highest_col)
     UR_bounds = grid_cell_ID_to_cell_bounds(UR_cell, grid_dict)
-    LL_cell = 'r_' + '{:02d}'.format(lowest_row) + '_c_' + '{:02d}'.format(
-        lowest_col)
+    LL_cell = cell_ID_from_row_col(lowest_row, lowest_col)
     LL_bounds = grid_cell_ID_to_cell_bounds(LL_cell, grid_dict)
 
     print("Resolution in function: ", resolution)
@@ -226,54 +502,281 @@ def quilt_grids_by_path(IC_object,
     print("LL bounds: ", LL_bounds)
     print("UR bounds: ", UR_bounds)
 
-    file_path = input_file_paths[cell_IDs[0]]
-    ds = xr.open_dataset(file_path)
-    grid = np.array(ds.data_vars[grid_variable_label])
-
-    print("Grid shape: ", np.shape(grid))
-    print("Grid[0] shape: ", np.shape(grid[0]))
-    time_len = np.shape(grid)[0]
-
-    if IC_object.short_name == 'MEaSUREs Greenland Monthly Velocity':
-        t = ds.variables['time_start'][:]
-    else:
-        t = ds.variables['time'][:]
+    # the epochs of all of the cells, which may not all hold the same ones
+    t = quilt_times(input_file_paths)
+    time_len = len(t)
+    print("Epochs: ", time_len)
 
+    dtype = memory.working_dtype(IC_object)
     if no_data_value != 'nan':
-        main_grid = no_data_value * np.ones((time_len, len(y), len(x)))
+        main_grid = np.full((time_len, len(y), len(x)),
+                            no_data_value,
+                            dtype=dtype)
     else:
-        main_grid = np.zeros((time_len, len(y), len(x)))
-        main_grid[::] = np.nan
+        main_grid = np.full((time_len, len(y), len(x)), np.nan, dtype=dtype)
+
+    # the cells are placed the same way as in stream_quilt_grids_by_path
+    quilt = InMemoryQuilt({grid_variable_label: main_grid, 't': t})
+    cell_shape = cell_grid_shape(IC_object, x, y)
 
     for cell in input_file_paths:
         print("Loading cell ", cell)
         file_path = input_file_paths[cell]
-        cell_ID = cell
         print("File path: ", file_path)
 
-        ds = xr.open_dataset(file_path)
-        grid = np.array(ds.data_vars[grid_variable_label])
-        ds = None
+        copy_cell_into_quilt(quilt, x, y, file_path, [grid_variable_label],
+                             time_len, cell_shape)
+
+    #main_grid[np.isnan(main_grid)] = 0
 
-        row = int(cell_ID.split('_')[1])
-        col = int(cell_ID.split('_')[3])
+    return (t, x, y, main_grid)
 
-        jG = (row - lowest_row) * np.shape(grid)[2]
-        iG = (col - lowest_col) * np.shape(grid)[1]
 
-        main_grid[:, jG:jG + np.shape(grid)[1],
-                  iG:iG + np.shape(grid)[2]] = grid
+def quilt_grid_axes(IC_object, resolution):
+    # get the x, y of the quilt of all of the cells
+    ordered_cell_ID_grid, row_col_extents = organize_quilt_grid_input(
+        IC_object.cells)
+    lowest_row, highest_row, lowest_col, highest_col = row_col_extents
 
-    #main_grid[np.isnan(main_grid)] = 0
+    UR_cell = cell_ID_from_row_col(highest_row, highest_col)
+    UR_bounds = grid_cell_ID_to_cell_bounds(UR_cell, IC_object.grid_dict)
+    LL_cell = cell_ID_from_row_col(lowest_row, lowest_col)
+    LL_bounds = grid_cell_ID_to_cell_bounds(LL_cell, IC_object.grid_dict)
+
+    x = np.arange(LL_bounds[0], UR_bounds[2], resolution)
+    y = np.arange(LL_bounds[1], UR_bounds[3], resolution)
+
+    return x, y
+
+
+def stack_times(ds):
+    # the epochs of an open stack (the start dates of a MEaSUREs stack)
+    if 'time_start' in ds.variables:
+        return np.array(ds.variables['time_start'][:], dtype='f8')
+    return np.array(ds.variables['time'][:], dtype='f8')
 
-    return (t, x, y, main_grid)
 
+def quilt_times(input_file_paths):
+    # the time axis of a quilt: the union of the epochs of all of the cells,
+    # since incremental updates can leave cells with different epochs
+    import toolbox.store_nc as store
 
-def quilt_grids_and_output(IC, grid_variable_label, no_data_value=0):
+    times = []
+    for cell in input_file_paths:
+        ds = store.open_stack(input_file_paths[cell])
+        times.append(stack_times(ds))
+        ds.close()
+    return np.unique(np.concatenate(times))
+
+
+def quilt_epochs(quilt_t, cell_t):
+    # the index of each epoch of a cell in the time axis of the quilt
+    epochs = np.searchsorted(quilt_t, cell_t)
+    if np.any(epochs >= len(quilt_t)) or np.any(
+            quilt_t[np.minimum(epochs, len(quilt_t) - 1)] != cell_t):
+        raise ValueError('The epochs of the cell are not in the quilt')
+    return epochs
+
+
+def axis_offset(axis, cell_axis):
+    # index of the first value of a cell axis in the quilt axis
+    return int(np.argmin(np.abs(axis - cell_axis[0])))
+
+
+def cell_grid_shape(IC_object, x, y):
+    # number of rows and columns of a cell in the quilt
+    bounds = grid_cell_ID_to_cell_bounds(IC_object.cells[0],
+                                         IC_object.grid_dict)
+    n_cols = int(np.count_nonzero((x >= bounds[0]) & (x < bounds[2])))
+    n_rows = int(np.count_nonzero((y >= bounds[1]) & (y < bounds[3])))
+    return n_rows, n_cols
+
+
+def copy_cell_into_quilt(output,
+                         x,
+                         y,
+                         cell_file,
+                         grid_variable_labels,
+                         time_chunk=1,
+                         cell_shape=None):
+    # Copy a cell stack into its window of an open quilt, time_chunk epochs
+    # at a time. The cell is placed by its own coordinates, and cells which
+    # are stored from the top row down are flipped. Each epoch of the cell
+    # is written at its time in the t axis of the quilt. With the cell_shape
+    # the copy is clipped to the cell's own window, so it never touches the
+    # chunks of the neighbouring cells.
+    import toolbox.store_nc as store
+
+    ds = store.open_stack(cell_file)
+
+    cell_x = np.array(ds.variables['x'][:])
+    cell_y = np.array(ds.variables['y'][:])
+    flip_y = len(cell_y) > 1 and cell_y[0] > cell_y[-1]
+    if flip_y:
+        cell_y = cell_y[::-1]
+    iG = axis_offset(x, cell_x)
+    jG = axis_offset(y, cell_y)
+    n_x = min(len(cell_x), len(x) - iG)
+    n_y = min(len(cell_y), len(y) - jG)
+    if cell_shape is not None:
+        n_y = min(n_y, cell_shape[0])
+        n_x = min(n_x, cell_shape[1])
+    epochs = quilt_epochs(np.asarray(output.variables['t'][:], dtype='f8'),
+                          stack_times(ds))
+
+    for label in grid_variable_labels:
+        variable = ds.variables[label]
+        for t0 in range(0, variable.shape[0], time_chunk):
+            t1 = min(t0 + time_chunk, variable.shape[0])
+            slab = np.ma.filled(variable[t0:t1], np.nan)
+            if flip_y:
+                slab = slab[:, ::-1, :]
+            slab = slab[:, :n_y, :n_x]
+            if epochs[t1 - 1] - epochs[t0] == t1 - 1 - t0:
+                # consecutive epochs of the quilt are written at once
+                output.variables[label][epochs[t0]:epochs[t1 - 1] + 1,
+                                        jG:jG + n_y, iG:iG + n_x] = slab
+                continue
+            for k in range(t1 - t0):
+                output.variables[label][epochs[t0 + k], jG:jG + n_y,
+                                        iG:iG + n_x] = slab[k]
+    ds.close()
+
+    return
+
+
+class InMemoryQuilt:
+    # A quilt held in memory, with the variables of an open quilt file, so
+    # the cells can be copied into it with copy_cell_into_quilt
+
+    def __init__(self, variables):
+        self.variables = variables
+
+
+def quilt_time_chunk(variable):
+    # time chunk of a netCDF4 variable or a Zarr array
+    if hasattr(variable, 'chunking'):
+        chunking = variable.chunking()
+        if chunking == 'contiguous':
+            return 1
+        return chunking[0]
+    return variable.chunks[0]
+
+
+def create_quilt(IC_object, input_file_paths, grid_variable_labels,
+                 resolution, output_file, no_data_value=0):
+    # Create the empty quilt of the cells (a NetCDF file, or a Zarr store
+    # with chunks aligned to the cells when output_file ends in .zarr)
+    import toolbox.store_nc as store
+
+    x, y = quilt_grid_axes(IC_object, resolution)
+
+    t = quilt_times(input_file_paths)
+
+    output = store.create_quilt_file(IC_object,
+                                     output_file,
+                                     t,
+                                     x,
+                                     y,
+                                     grid_variable_labels,
+                                     no_data_value,
+                                     cell_shape=cell_grid_shape(
+                                         IC_object, x, y))
+    return output, x, y
+
+
+def stream_quilt_grids_by_path(IC_object,
+                               input_file_paths,
+                               grid_variable_labels,
+                               resolution,
+                               output_file,
+                               no_data_value=0,
+                               time_chunk=None):
+    # Quilt the cells straight into the output file. The file is created up
+    # front and each cell is copied into its window time_chunk epochs at a
+    # time, so only one chunk of one cell is held in memory. Several
+    # variables are quilted in the same pass over the cells. By default
+    # time_chunk follows the time chunks of the output profile, so every
+    # compressed chunk is written once.
+    import toolbox.store_nc as store
+
+    if isinstance(grid_variable_labels, str):
+        grid_variable_labels = [grid_variable_labels]
+
+    output, x, y = create_quilt(IC_object, input_file_paths,
+                                grid_variable_labels, resolution, output_file,
+                                no_data_value)
+    if time_chunk is None:
+        time_chunk = quilt_time_chunk(
+            output.variables[grid_variable_labels[0]])
+    cell_shape = cell_grid_shape(IC_object, x, y)
+
+    for cell in input_file_paths:
+        print("Streaming cell ", cell)
+        copy_cell_into_quilt(output, x, y, input_file_paths[cell],
+                             grid_variable_labels, time_chunk, cell_shape)
+
+    output.close()
+
+    if IC_object.short_name == 'ATL15 Antarctic Elevation' and not store.is_zarr(
+            output_file):
+        store.add_atl14_to_nc(IC_object, output_file)
+
+    return output_file
+
+
+def estimate_quilt_memory(IC_object, input_file_paths, resolution):
+    # peak bytes of quilting the cells in memory, from the quilt axes and
+    # the epochs of all of the stacks
+    x, y = quilt_grid_axes(IC_object, resolution)
+    n_epochs = len(quilt_times(input_file_paths))
+
+    return memory.estimate_quilt_memory(IC_object, n_epochs, len(y), len(x))
+
+
+def quilt_grids_and_output(IC,
+                           grid_variable_label,
+                           no_data_value=0,
+                           streaming=False,
+                           time_chunk=None):
+    # Without streaming the quilt is built in memory and returned, and
+    # nothing is done if it does not fit in the memory budget. With
+    # streaming=True the quilt is written to disk cell by cell instead,
+    # grid_variable_label may be a list of variables, and the path of the
+    # output file is returned.
     import toolbox.store_nc as store
 
     input_file_paths, output_path = create_input_file_path_dict(IC)
+    if IC.data_type.lower() == 'velocity':
+        resolution = IC.velocity_grid_posting
+    elif IC.data_type.lower() == 'elevation':
+        resolution = IC.elevation_grid_posting
+    else:
+        print(
+            'Warning: Grid not created. \nSet the object data type to either "velocity" or "elevation"'
+        )
+        return
+
+    # refuse to quilt in memory if it does not fit in the memory budget; the
+    # caller can stream the quilt to disk instead
+    if not streaming and len(input_file_paths) > 0:
+        needed = estimate_quilt_memory(IC, input_file_paths, resolution)
+        budget = memory.memory_budget(IC)
+        print("Estimated peak memory of the quilt: " +
+              memory.format_bytes(needed))
+        if budget is not None and needed > budget:
+            print("Error: the quilt needs " + memory.format_bytes(needed) +
+                  ", which is more than the memory budget (" +
+                  memory.format_bytes(budget) + ").")
+            print(
+                "Call quilt_grids_and_output with streaming=True to write it to disk cell by cell, or raise IC.memory_budget."
+            )
+            return
+
     file_name = IC.nickname + "_stack.nc"
+    if streaming:
+        file_name = IC.nickname + "_stack" + store.storage_backends[
+            store.get_backend(IC)]
 
     if os.path.exists(os.path.join(output_path, file_name)):
         print("WARNING: file already exists: ",
@@ -284,17 +787,14 @@ def quilt_grids_and_output(IC, grid_variable_label, no_data_value=0):
         return
 
     output_file = os.path.join(output_path, file_name)
-    if IC.data_type.lower() == 'velocity':
-        resolution = IC.velocity_grid_posting
-    elif IC.data_type.lower() == 'elevation':
-        resolution = IC.elevation_grid_posting
-    else:
-        print(
-            'Warning: Grid not created. \nSet the object data type to either "velocity" or "elevation"'
-        )
-        return
 
     print("Resolution in quilt_grids_and_output: ", resolution)
+    if streaming:
+        return stream_quilt_grids_by_path(IC, input_file_paths,
+                                          grid_variable_label, resolution,
+                                          output_file, no_data_value,
+                                          time_chunk)
+
     #if IC.short_name == 'ATL15 Antarctic Elevation':
     t, x, y, main_grid = quilt_grids_by_path(IC, input_file_paths,
                                              grid_variable_label, resolution,
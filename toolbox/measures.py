@@ -1,3 +1,9 @@
+import os
+import functools
+import numpy as np
+import toolbox.memory as memory
+
+
 def monthStringToInt(month_as_string):
     months = {
         'Jan': 1,
@@ -16,6 +22,9 @@ def monthStringToInt(month_as_string):
     return (months[month_as_string])
 
 
+# file names are parsed many times over (by the catalog, the incremental
+# updates and the file sets), so the date pair of each name is cached
+@functools.lru_cache(maxsize=None)
 def measures_fileID_to_date_pair(fileID):
     #print(fileID)
     date1 = fileID.split('_')[4]
@@ -36,109 +45,188 @@ def measures_fileID_to_date_pair(fileID):
     return (datePair)
 
 
-#import toolbox.measures as measures
-def create_velocity_stack(IC_object, measures_mosaic_file_names):
-    from osgeo import gdal
-    import os
-    import numpy as np
-    import toolbox.compile_interp as interp
-    import toolbox.store_nc as store
+def window_from_geotransform(transform, n_cols, n_rows, extents):
+    # Get the x, y of the pixels of a mosaic which fall within the extents
+    # [min_x, min_y, max_x, max_y] and the pixel window (xoff, yoff, xsize,
+    # ysize) which they span
+    x = transform[0] + np.arange(n_cols) * transform[1]
+    y = transform[3] + np.arange(n_rows) * transform[5]
 
-    print("test")
+    x_indices = np.where(np.logical_and(x >= extents[0],
+                                        x <= extents[2]))[0]
+    y_indices = np.where(np.logical_and(y >= extents[1],
+                                        y <= extents[3]))[0]
+    if len(x_indices) == 0 or len(y_indices) == 0:
+        return x[x_indices], y[y_indices], None
 
-    # get the x, y to create the empty np arrays
-    def get_x_y(file):
-        print("Getting x and y")
-        vx_file = os.path.join(IC_object.download_path, file)
-        ds = gdal.Open(vx_file)
-        vx_array = np.array(ds.GetRasterBand(1).ReadAsArray())
+    window = (int(x_indices[0]), int(y_indices[0]), len(x_indices),
+              len(y_indices))
+    return x[x_indices], y[y_indices], window
 
-        transform = ds.GetGeoTransform()
-        ds = None
 
-        x = np.arange(transform[0],
-                      transform[0] + np.shape(vx_array)[1] * transform[1],
-                      transform[1])
-        y = np.arange(transform[3],
-                      transform[3] + np.shape(vx_array)[0] * transform[5],
-                      transform[5])
-        print("transform[1], x resolution: ", transform[1])
-        print("transform[5], y resolution: ", transform[5])
+def get_mosaic_grid(file_path):
+    # Read only the header of a mosaic to get its geotransform and size
+    from osgeo import gdal
+
+    ds = gdal.Open(file_path)
+    transform = ds.GetGeoTransform()
+    n_cols = ds.RasterXSize
+    n_rows = ds.RasterYSize
+    ds = None
+
+    return transform, n_cols, n_rows
 
-        xIndices = np.logical_and(x >= IC_object.extents[0],
-                                  x <= IC_object.extents[2])
-        yIndices = np.logical_and(y >= IC_object.extents[1],
-                                  y <= IC_object.extents[3])
 
-        x = x[xIndices]
-        y = y[yIndices]
+def get_mosaic_window(file_path, extents):
+    # Read only the header of a mosaic to find the window of the extents
+    transform, n_cols, n_rows = get_mosaic_grid(file_path)
+    x, y, window = window_from_geotransform(transform, n_cols, n_rows,
+                                            extents)
+    return x, y, window, transform
 
-        return x, y, xIndices, yIndices
 
-    measures_mosaic_folder = IC_object.download_path
+def read_mosaic_windows(file_path, extents_list, windows, transform):
+    # Decode the windows of several cells from a mosaic which is opened
+    # once. When the windows are close together, the window around all of
+    # them is decoded in one read and split up, otherwise each window is
+    # read from the open file in turn. If the mosaic is on a different grid
+    # than the first one its own windows are used, and None is returned for
+    # any window which then has a different shape.
+    from osgeo import gdal
 
-    # get all the date pairs (in the form: "20141201-20141231")
-    date_pairs = []
+    ds = gdal.Open(file_path)
+    if ds.GetGeoTransform() != transform:
+        print('Warning: ' + os.path.basename(file_path) +
+              ' is on a different grid than the first mosaic')
+        file_windows = []
+        for ee in range(len(extents_list)):
+            x, y, file_window = window_from_geotransform(
+                ds.GetGeoTransform(), ds.RasterXSize, ds.RasterYSize,
+                extents_list[ee])
+            if windows[ee] is None or file_window is None or file_window[
+                    2:] != windows[ee][2:]:
+                file_window = None
+            file_windows.append(file_window)
+        windows = file_windows
+
+    arrays = [None] * len(windows)
+    valid_windows = [w for w in windows if w is not None]
+    if len(valid_windows) == 0:
+        ds = None
+        return arrays
+
+    x_min = min([w[0] for w in valid_windows])
+    y_min = min([w[1] for w in valid_windows])
+    x_max = max([w[0] + w[2] for w in valid_windows])
+    y_max = max([w[1] + w[3] for w in valid_windows])
+    union_size = (x_max - x_min) * (y_max - y_min)
+    cells_size = sum([w[2] * w[3] for w in valid_windows])
+
+    band = ds.GetRasterBand(1)
+    if union_size <= 2 * cells_size:
+        union = np.array(
+            band.ReadAsArray(x_min, y_min, x_max - x_min, y_max - y_min))
+        for ww in range(len(windows)):
+            w = windows[ww]
+            if w is not None:
+                arrays[ww] = union[w[1] - y_min:w[1] - y_min + w[3],
+                                   w[0] - x_min:w[0] - x_min + w[2]]
+    else:
+        for ww in range(len(windows)):
+            if windows[ww] is not None:
+                arrays[ww] = np.array(band.ReadAsArray(*windows[ww]))
+    ds = None
+
+    return arrays
+
+
+def read_mosaic_window(file_path, extents, window, transform):
+    # Decode only the pixels of the window from a mosaic
+    return read_mosaic_windows(file_path, [extents], [window], transform)[0]
+
+
+def measures_file_component(file_name):
+    # vx, vy, ex or ey from a name like
+    # GL_vel_mosaic_Monthly_01Dec14_31Dec14_vx_v05.0.tif (or None)
+    parts = os.path.basename(file_name).split('_')
+    if len(parts) > 6 and parts[6] in ['vx', 'vy', 'ex', 'ey']:
+        return parts[6]
+    return None
+
+
+def index_measures_files(measures_mosaic_file_names):
+    # Group the MEaSUREs files by date pair and component in a single pass.
+    # Returns {date_pair: {component: file_name}}; names which cannot be
+    # parsed are skipped.
+    file_index = {}
     for file_name in measures_mosaic_file_names:
-        date_pair = measures_fileID_to_date_pair(file_name)
-        if date_pair not in date_pairs:
-            date_pairs.append(date_pair)
+        component = measures_file_component(file_name)
+        if component is None:
+            continue
+        try:
+            date_pair = measures_fileID_to_date_pair(
+                os.path.basename(file_name))
+        except (IndexError, KeyError, ValueError):
+            continue
+        file_index.setdefault(date_pair, {})[component] = file_name
+
+    return file_index
 
-    # find list of file IDs which contain all necessary files (vx, vy, ex, ey)
+
+def measures_date_pairs(measures_mosaic_file_names):
+    # the sorted date pairs (in the form: "20141201-20141231") of the files
+    return sorted(index_measures_files(measures_mosaic_file_names))
+
+
+def get_measures_file_sets(IC_object, measures_mosaic_file_names):
+    # Get the date pairs which have all necessary files (vx, vy, ex, ey),
+    # sorted by start and then end date, and the [vx, vy, ex, ey] file names
+    # of each. The date pairs sort as strings since they are YYYYMMDD.
+    file_index = index_measures_files(measures_mosaic_file_names)
+
+    variables = ['vx', 'vy', 'ex', 'ey']
     file_sets = []
-    fileIDs = []
-    for date_pair in date_pairs:
-        for file_name in measures_mosaic_file_names:
-
-            fileID = file_name[:-13]
-            fileID = fileID.split('/')[-1]
-            date = measures_fileID_to_date_pair(fileID)
-            if date_pair == date:
-                if fileID not in fileIDs:
-                    vx_found = False
-                    vy_found = False
-                    ex_found = False
-                    ey_found = False
-                    for file_name_check in os.listdir(
-                            os.path.join(measures_mosaic_folder)):
-                        if fileID + '_vx' in file_name_check:
-                            vx_file = file_name_check
-                            vx_found = True
-                        if fileID + '_vy' in file_name_check:
-                            vy_file = file_name_check
-                            vy_found = True
-                        if fileID + '_ex' in file_name_check:
-                            ex_file = file_name_check
-                            ex_found = True
-                        if fileID + '_ey' in file_name_check:
-                            ey_file = file_name_check
-                            ey_found = True
-                    if vx_found and vy_found and ex_found and ey_found:
-                        fileIDs.append(fileID)
-                        file_sets.append([vx_file, vy_file, ex_file, ey_file])
-
-    output_date_pairs = []
-    start_dates = []
-    end_dates = []
-
-    x, y, xIndices, yIndices = get_x_y(file_sets[0][0])
-    vx_grid = np.zeros((len(date_pairs), len(y), len(x)))
-    vy_grid = np.zeros((len(date_pairs), len(y), len(x)))
-    ex_grid = np.zeros((len(date_pairs), len(y), len(x)))
-    ey_grid = np.zeros((len(date_pairs), len(y), len(x)))
-    v_grid = np.zeros((len(date_pairs), len(y), len(x)))
-    e_grid = np.zeros((len(date_pairs), len(y), len(x)))
-
-    vx_grid[::] = np.nan
-    vy_grid[::] = np.nan
-    ex_grid[::] = np.nan
-    ey_grid[::] = np.nan
-    v_grid[::] = np.nan
-    e_grid[::] = np.nan
+    complete_date_pairs = []
+    for date_pair in sorted(file_index):
+        file_set = file_index[date_pair]
+        if all([v in file_set for v in variables]):
+            complete_date_pairs.append(date_pair)
+            file_sets.append([file_set[v] for v in variables])
+
+    return complete_date_pairs, file_sets
+
+
+def create_cell_stacks(IC_object, date_pairs, file_sets, extents_list):
+    # Build the velocity stacks of several cells in a single pass over the
+    # mosaics. Returns a list with, for each extents, the tuple
+    # (x, y, vx_grid, vy_grid, v_grid, ex_grid, ey_grid, e_grid, date_pairs),
+    # or None if the extents do not overlap the mosaics.
+
+    # get the x, y of each cell and its pixel window in the mosaics from
+    # the header of the first file, so only the cells' pixels are decoded
+    transform, n_cols, n_rows = get_mosaic_grid(
+        os.path.join(IC_object.download_path, file_sets[0][0]))
+
+    coordinates = []
+    windows = []
+    grids = []
+    for extents in extents_list:
+        x, y, window = window_from_geotransform(transform, n_cols, n_rows,
+                                                extents)
+        coordinates.append([x, y])
+        windows.append(window)
+
+        # vx, vy, ex, ey, v, e
+        cell_grids = []
+        for g in range(6):
+            grid = np.full((len(date_pairs), len(y), len(x)),
+                           np.nan,
+                           dtype=memory.working_dtype(IC_object))
+            cell_grids.append(grid)
+        grids.append(cell_grids)
 
     for dd in range(len(date_pairs)):
         date_pair = date_pairs[dd]
-        fileID = fileIDs[dd]
         file_set = file_sets[dd]
 
         message = '            Looking for velocity points in ' + date_pair + ' (file ' + str(
@@ -147,63 +235,101 @@ def create_velocity_stack(IC_object, measures_mosaic_file_names):
         if IC_object.print_sub_outputs:
             print(message)
 
-        start_date = date_pair.split('-')[0]
-        end_date = date_pair.split('-')[1]
-        start_dates.append(start_date)
-        end_dates.append(end_date)
-
-        vx_file_name = file_set[0]
-        vy_file_name = file_set[1]
-        ex_file_name = file_set[2]
-        ey_file_name = file_set[3]
-
-        vx_file = os.path.join(IC_object.download_path, vx_file_name)
-        ds = gdal.Open(vx_file)
-        vx_array = np.array(ds.GetRasterBand(1).ReadAsArray())
-        ds = None
+        # vx, vy, ex, ey arrays of every cell
+        component_arrays = []
+        for file_name in file_set:
+            component_arrays.append(
+                read_mosaic_windows(
+                    os.path.join(IC_object.download_path, file_name),
+                    extents_list, windows, transform))
 
-        vx_array = vx_array[yIndices, :]
-        vx_array = vx_array[:, xIndices]
-        vx_array[vx_array < -1.e+09] = np.nan
-        vx_grid[dd] = vx_array
+        for cc in range(len(extents_list)):
+            vx_array, vy_array, ex_array, ey_array = [
+                arrays[cc] for arrays in component_arrays
+            ]
+            vx_grid, vy_grid, ex_grid, ey_grid, v_grid, e_grid = grids[cc]
 
-        vy_file = os.path.join(IC_object.download_path, vy_file_name)
-        ds = gdal.Open(vy_file)
-        vy_array = np.array(ds.GetRasterBand(1).ReadAsArray())
-        ds = None
+            # leave the date pair empty if any mosaic could not be windowed
+            if any([
+                    a is None
+                    for a in [vx_array, vy_array, ex_array, ey_array]
+            ]):
+                continue
 
-        vy_array = vy_array[yIndices, :]
-        vy_array = vy_array[:, xIndices]
-        vy_array[vy_array < -1.e+09] = np.nan
-        vy_grid[dd] = vy_array
+            vx_array[vx_array < -1.e+09] = np.nan
+            vx_grid[dd] = vx_array
 
-        ex_file = os.path.join(IC_object.download_path, ex_file_name)
-        ds = gdal.Open(ex_file)
-        ex_array = np.array(ds.GetRasterBand(1).ReadAsArray())
-        ds = None
+            vy_array[vy_array < -1.e+09] = np.nan
+            vy_grid[dd] = vy_array
 
-        ex_array = ex_array[yIndices, :]
-        ex_array = ex_array[:, xIndices]
+            ex_array[ex_array < 0] = np.nan
+            ex_grid[dd] = ex_array
 
-        ex_array[ex_array < 0] = np.nan
-        ex_grid[dd] = ex_array
+            ey_array[ey_array < 0] = np.nan
+            ey_grid[dd] = ey_array
 
-        ey_file = os.path.join(IC_object.download_path, ey_file_name)
-        ds = gdal.Open(ey_file)
-        ey_array = np.array(ds.GetRasterBand(1).ReadAsArray())
-        ds = None
+            v_array = (vx_array**2 + vy_array**2)**0.5
+            v_grid[dd] = v_array
 
-        ey_array = ey_array[yIndices, :]
-        ey_array = ey_array[:, xIndices]
-        ey_array[ey_array < 0] = np.nan
-        ey_grid[dd] = ey_array
+            e_array = (ex_array**2 + ey_array**2)**0.5
+            e_grid[dd] = e_array
 
-        v_array = (vx_array**2 + vy_array**2)**0.5
-        v_grid[dd] = v_array
+    results = []
+    for cc in range(len(extents_list)):
+        if windows[cc] is None:
+            results.append(None)
+            continue
+        x, y = coordinates[cc]
+        vx_grid, vy_grid, ex_grid, ey_grid, v_grid, e_grid = grids[cc]
+        results.append((x, y, vx_grid, vy_grid, v_grid, ex_grid, ey_grid,
+                        e_grid, list(date_pairs)))
 
-        e_array = (ex_array**2 + ey_array**2)**0.5
-        e_grid[dd] = e_array
+    return results
 
-        output_date_pairs.append(date_pair)
 
-    return x, y, vx_grid, vy_grid, v_grid, ex_grid, ey_grid, e_grid, output_date_pairs
\ No newline at end of file
+#import toolbox.measures as measures
+def create_velocity_stack(IC_object, measures_mosaic_file_names):
+    date_pairs, file_sets = get_measures_file_sets(IC_object,
+                                                   measures_mosaic_file_names)
+    if len(date_pairs) == 0:
+        print('Error: no complete sets of MEaSUREs mosaics were found')
+        return
+
+    result = create_cell_stacks(IC_object, date_pairs, file_sets,
+                                [IC_object.extents])[0]
+    if result is None:
+        print('Error: the cell does not overlap the MEaSUREs mosaics')
+        return
+
+    return result
+
+
+def create_velocity_stacks(IC_object, measures_mosaic_file_names, cell_IDs):
+    # Build the stacks of several cells with one read of each mosaic.
+    # Returns {cell_ID: create_velocity_stack output} for the cells which
+    # overlap the mosaics.
+    date_pairs, file_sets = get_measures_file_sets(IC_object,
+                                                   measures_mosaic_file_names)
+
+    import toolbox.grid_generation as grid
+
+    if len(date_pairs) == 0:
+        print('Error: no complete sets of MEaSUREs mosaics were found')
+        return {}
+
+    extents_list = [
+        grid.grid_cell_ID_to_cell_bounds(cell_ID, IC_object.grid_dict)
+        for cell_ID in cell_IDs
+    ]
+    results = create_cell_stacks(IC_object, date_pairs, file_sets,
+                                 extents_list)
+
+    stacks = {}
+    for cc in range(len(cell_IDs)):
+        if results[cc] is None:
+            print('Warning: ' + cell_IDs[cc] +
+                  ' does not overlap the MEaSUREs mosaics')
+            continue
+        stacks[cell_IDs[cc]] = results[cc]
+
+    return stacks
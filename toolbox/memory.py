@@ -0,0 +1,164 @@
+import os
+import numpy as np
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Working dtype and memory accounting
+#
+# The stacks, the interpolated slices and the quilts are held in
+# IC.working_dtype (float32 by default, which is also what the writers
+# store). The estimators below give the peak bytes of a job before it runs,
+# so jobs which do not fit in IC.memory_budget can be split into batches of
+# epochs (or streamed) instead of running out of memory.
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+default_working_dtype = 'float32'
+
+# (time, y, x) grids held per epoch of a cell: the six MEaSUREs stacks plus
+# the four decoded windows, and for ATL15 the cropped source, the four
+# gathered neighbours and the interpolated slice
+grids_per_epoch = {'velocity': 10, 'elevation': 6}
+
+
+def working_dtype(IC_object=None):
+    return np.dtype(getattr(IC_object, 'working_dtype', default_working_dtype))
+
+
+def physical_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def memory_budget(IC_object):
+    # IC.memory_budget in bytes, or half of the physical memory
+    budget = getattr(IC_object, 'memory_budget', None)
+    if budget is None and physical_memory() is not None:
+        budget = physical_memory() // 2
+    return budget
+
+
+def plan_memory(IC_object):
+    # bytes of resampling plans kept in memory (by each worker): an eighth of
+    # the memory budget, and no more than IC.plan_cache_size
+    limit = getattr(IC_object, 'plan_cache_size', None)
+    budget = memory_budget(IC_object)
+    if budget is not None:
+        limit = budget // 8 if limit is None else min(limit, budget // 8)
+    if limit is None:
+        import toolbox.resample.plan_cache as plan_cache
+        limit = plan_cache.default_max_session_bytes
+    return limit
+
+
+def native_geotransform(IC_object):
+    # The cataloged geotransform of the downloaded MEaSUREs mosaics (they
+    # share one grid), or None if it is not known
+    import toolbox.catalog as catalog
+
+    if not os.path.exists(IC_object.download_path):
+        return None
+    file_names = catalog.list_files(IC_object, suffix='.tif')
+    if len(file_names) == 0:
+        return None
+    return catalog.get_geotransform(IC_object, file_names[0])
+
+
+def native_cell_pixels(transform, extents):
+    # pixels of a mosaic with the geotransform which fall within the extents
+    import toolbox.measures as measures
+
+    # enough columns and rows from the origin of the mosaic to cover the
+    # extents (the mosaics cover the grid of the ice sheet)
+    n_cols = int(
+        max(abs(extents[0] - transform[0]), abs(extents[2] - transform[0])) /
+        abs(transform[1])) + 2
+    n_rows = int(
+        max(abs(extents[1] - transform[3]), abs(extents[3] - transform[3])) /
+        abs(transform[5])) + 2
+    x, y, window = measures.window_from_geotransform(transform, n_cols, n_rows,
+                                                     extents)
+    if window is None:
+        return None
+    return window[2] * window[3]
+
+
+def cell_pixels(IC_object, extents):
+    # The MEaSUREs stacks are read at the native resolution of the mosaics,
+    # the other stacks are interpolated at IC.posting
+    if IC_object.data_type.lower() == 'velocity':
+        transform = native_geotransform(IC_object)
+        if transform is not None:
+            n_pixels = native_cell_pixels(transform, extents)
+            if n_pixels is not None:
+                return n_pixels
+
+    n_x = int((extents[2] - extents[0]) / IC_object.posting) + 1
+    n_y = int((extents[3] - extents[1]) / IC_object.posting) + 1
+    return n_x * n_y
+
+
+def estimate_epoch_memory(IC_object, extents):
+    # peak bytes of one epoch of the stack of a cell
+    n_grids = grids_per_epoch.get(IC_object.data_type.lower(), 10)
+    return n_grids * cell_pixels(IC_object,
+                                 extents) * working_dtype(IC_object).itemsize
+
+
+def estimate_cell_memory(IC_object, extents, n_epochs):
+    # peak bytes of building the stack of a cell
+    return n_epochs * estimate_epoch_memory(IC_object, extents)
+
+
+def estimate_quilt_memory(IC_object, n_epochs, n_y, n_x, n_variables=1):
+    # peak bytes of quilting a region in memory
+    return n_variables * n_epochs * n_y * n_x * working_dtype(
+        IC_object).itemsize
+
+
+def format_bytes(n_bytes):
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if abs(n_bytes) < 1000:
+            return str(round(n_bytes, 1)) + ' ' + unit
+        n_bytes = n_bytes / 1000.
+    return str(round(n_bytes, 1)) + ' TB'
+
+
+def epochs_per_batch(IC_object, extents, n_epochs):
+    # The number of epochs of a cell which fit in the memory budget: all of
+    # them, fewer (so the cell is built in batches), or 0 if not even one
+    # epoch fits (the job is refused)
+    budget = memory_budget(IC_object)
+    if budget is None:
+        return n_epochs
+    per_epoch = estimate_epoch_memory(IC_object, extents)
+    return int(min(n_epochs, budget // max(per_epoch, 1)))
+
+
+def preflight(IC_object, extents, n_epochs, label='cell'):
+    # Report the peak memory of a job and get the number of epochs to
+    # process at once (0 if the job is refused or has no epochs)
+    if n_epochs == 0:
+        return 0
+
+    needed = estimate_cell_memory(IC_object, extents, n_epochs)
+    budget = memory_budget(IC_object)
+    batch = epochs_per_batch(IC_object, extents, n_epochs)
+
+    message = '        Estimated peak memory of ' + label + ': ' + format_bytes(
+        needed)
+    if budget is not None:
+        message += ' (budget ' + format_bytes(budget) + ')'
+    IC_object.output_summary += '\n' + message
+    if IC_object.print_sub_outputs:
+        print(message)
+
+    if batch == 0:
+        print('Error: a single epoch of ' + label + ' needs ' +
+              format_bytes(estimate_epoch_memory(IC_object, extents)) +
+              ', which is more than the memory budget. Skipping...')
+    elif batch < n_epochs:
+        print('        Splitting ' + label + ' into batches of ' + str(batch) +
+              ' epochs to fit in the memory budget')
+
+    return batch
@@ -0,0 +1,309 @@
+import os
+import json
+import numpy as np
+import toolbox.grid_generation as grid
+import toolbox.memory as memory
+import toolbox.store_nc as store
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Virtual mosaic of the per-cell stacks
+#
+# Instead of copying every cell into a new quilted file, a VirtualMosaic
+# keeps the axes of the region and the window of each cell in the region.
+# Its time axis is the union of the epochs of all of the cells, and each
+# cell keeps the position of its own epochs on it, so cells which hold
+# different epochs are still read at the right times.
+# A read of a window or a point only opens the cell files which intersect
+# it. The mosaic can be saved as a small JSON sidecar index (similar to a
+# GDAL VRT) and loaded again without touching the cell files.
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+class VirtualMosaic:
+    def __init__(self,
+                 t,
+                 x,
+                 y,
+                 variables,
+                 cells,
+                 no_data_value=np.nan,
+                 dtype=None):
+        # cells is a list of dicts with the cell_ID, the path of its stack,
+        # its window (row, col, n_rows, n_cols) in the mosaic and the
+        # indices of its epochs in t. The blocks are read as dtype (the
+        # working dtype by default).
+        self.t = np.asarray(t)
+        self.x = np.asarray(x)
+        self.y = np.asarray(y)
+        self.variables = list(variables)
+        self.cells = cells
+        self.no_data_value = no_data_value
+        if dtype is None:
+            dtype = memory.working_dtype()
+        self.dtype = np.dtype(dtype)
+
+    def __repr__(self):
+        return ('VirtualMosaic(' + str(len(self.cells)) + ' cells, shape ' +
+                str(self.shape) + ', variables ' + str(self.variables) + ')')
+
+    @property
+    def shape(self):
+        return (len(self.t), len(self.y), len(self.x))
+
+    def read(self, variable, t=slice(None), rows=slice(None),
+             cols=slice(None)):
+        # Read the (t, y, x) block of a variable given by the time slice and
+        # the row and column ranges of the mosaic
+        if isinstance(t, slice) and t.step is not None and t.step <= 0:
+            raise ValueError('Only increasing time steps can be read')
+        t = range(len(self.t))[t]
+        rows = range(len(self.y))[rows]
+        cols = range(len(self.x))[cols]
+        if rows.step != 1 or cols.step != 1:
+            raise ValueError('Only contiguous rows and columns can be read')
+
+        output = np.full((len(t), len(rows), len(cols)),
+                         self.no_data_value,
+                         dtype=self.dtype)
+        if len(rows) == 0 or len(cols) == 0:
+            return output
+
+        for cell in self.cells:
+            # skip the cells which do not intersect the block
+            if cell['row'] >= rows.stop or cell['row'] + cell[
+                    'n_rows'] <= rows.start:
+                continue
+            if cell['col'] >= cols.stop or cell['col'] + cell[
+                    'n_cols'] <= cols.start:
+                continue
+            read_cell_block(cell, variable, t, rows, cols, self.x, self.y,
+                            output)
+
+        return output
+
+    def read_window(self, variable, extents, t=slice(None)):
+        # Read the block within the extents [min_x, min_y, max_x, max_y]
+        cols = np.nonzero((self.x >= extents[0]) & (self.x <= extents[2]))[0]
+        rows = np.nonzero((self.y >= extents[1]) & (self.y <= extents[3]))[0]
+        if len(cols) == 0 or len(rows) == 0:
+            return self.x[cols], self.y[rows], np.full(
+                (len(self.t[t]), len(rows), len(cols)),
+                self.no_data_value,
+                dtype=self.dtype)
+
+        block = self.read(variable, t, slice(rows[0], rows[-1] + 1),
+                          slice(cols[0], cols[-1] + 1))
+        return self.x[cols], self.y[rows], block
+
+    def read_point(self, variable, point_x, point_y, t=slice(None)):
+        # Read the time series of the pixel nearest to a point. A point
+        # outside of the mosaic gives a series of no_data_value.
+        if not (axis_contains(self.x, point_x)
+                and axis_contains(self.y, point_y)):
+            return np.full(len(self.t[t]),
+                           self.no_data_value,
+                           dtype=self.dtype)
+        col = int(np.argmin(np.abs(self.x - point_x)))
+        row = int(np.argmin(np.abs(self.y - point_y)))
+        return self.read(variable, t, slice(row, row + 1),
+                         slice(col, col + 1))[:, 0, 0]
+
+    def save(self, index_file):
+        # Write the sidecar index. Cell paths are stored relative to the
+        # index so the Output folder can be moved.
+        index_folder = os.path.dirname(os.path.abspath(index_file))
+        cells = []
+        for cell in self.cells:
+            cell = dict(cell)
+            cell['path'] = os.path.relpath(cell['path'], index_folder)
+            cells.append(cell)
+
+        index = {
+            't': [float(v) for v in self.t],
+            'x': axis_to_index(self.x),
+            'y': axis_to_index(self.y),
+            'variables': self.variables,
+            'no_data_value': none_if_nan(self.no_data_value),
+            'dtype': self.dtype.name,
+            'cells': cells
+        }
+        with open(index_file, 'w') as f:
+            json.dump(index, f, indent=1)
+
+        return index_file
+
+
+def axis_to_index(axis):
+    # regular axes are stored as their start, step and size
+    if len(axis) > 1 and np.allclose(np.diff(axis), axis[1] - axis[0]):
+        return {
+            'start': float(axis[0]),
+            'step': float(axis[1] - axis[0]),
+            'size': len(axis)
+        }
+    return [float(v) for v in axis]
+
+
+def axis_from_index(index):
+    if isinstance(index, dict):
+        return index['start'] + np.arange(index['size']) * index['step']
+    return np.array(index)
+
+
+def axis_contains(axis, value):
+    # whether a value falls within the pixels of a regular axis
+    half_step = 0
+    if len(axis) > 1:
+        half_step = abs(axis[1] - axis[0]) / 2
+    return np.min(axis) - half_step <= value <= np.max(axis) + half_step
+
+
+def none_if_nan(value):
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def cell_window(x, y, cell_x, cell_y):
+    # The window (row, col, n_rows, n_cols) of a cell in the mosaic axes.
+    # The cell is placed by its own coordinates, and whether it is stored
+    # from the top row down (and has to be flipped) is returned too.
+    flip_y = len(cell_y) > 1 and cell_y[0] > cell_y[-1]
+    if flip_y:
+        cell_y = cell_y[::-1]
+    col = grid.axis_offset(x, cell_x)
+    row = grid.axis_offset(y, cell_y)
+    n_cols = min(len(cell_x), len(x) - col)
+    n_rows = min(len(cell_y), len(y) - row)
+    return row, col, n_rows, n_cols, flip_y
+
+
+def read_cell_block(cell, variable, t, rows, cols, x, y, output):
+    # Copy the part of one cell which falls in the block into output, at the
+    # epochs of the cell which are in the time range t of the mosaic.
+    ds = store.open_stack(cell['path'])
+    cell_x = np.array(ds.variables['x'][:])
+    cell_y = np.array(ds.variables['y'][:])
+    j0, i0, n_rows, n_cols, flip_y = cell_window(x, y, cell_x, cell_y)
+
+    # the intersection of the cell and the block in mosaic indices
+    c0 = max(cols.start, i0)
+    c1 = min(cols.stop, i0 + n_cols)
+    r0 = max(rows.start, j0)
+    r1 = min(rows.stop, j0 + n_rows)
+
+    # the times of the block at which the cell has an epoch, and its epochs
+    n_epochs = ds.variables[variable].shape[0]
+    epoch_times = np.asarray(cell.get('epochs', np.arange(n_epochs)))
+    matches = np.asarray(t)[:, np.newaxis] == epoch_times[np.newaxis, :]
+    found = np.nonzero(np.any(matches, axis=1))[0]
+    epochs = np.argmax(matches[found], axis=1)
+    if c0 >= c1 or r0 >= r1 or len(found) == 0:
+        ds.close()
+        return
+
+    # the same intersection in cell indices (before flipping)
+    if flip_y:
+        y_slice = slice(len(cell_y) - (r1 - j0), len(cell_y) - (r0 - j0))
+    else:
+        y_slice = slice(r0 - j0, r1 - j0)
+    x_slice = slice(c0 - i0, c1 - i0)
+
+    # read the epochs between the first and the last needed at once
+    e0 = int(np.min(epochs))
+    e1 = int(np.max(epochs)) + 1
+    slab = np.ma.filled(ds.variables[variable][e0:e1, y_slice, x_slice],
+                        np.nan)
+    slab = slab[epochs - e0]
+    if flip_y:
+        slab = slab[:, ::-1, :]
+    ds.close()
+
+    output[found, r0 - rows.start:r1 - rows.start,
+           c0 - cols.start:c1 - cols.start] = slab
+
+
+def build_virtual_mosaic(IC, no_data_value=np.nan):
+    # Build the mosaic of the stacks of IC.cells. Only the coordinates of
+    # each stack are read: the window of a cell comes from its own x and y,
+    # the same way as the cells are read, and the time axis is the union of
+    # the epochs of all of the cells.
+    input_file_paths, output_path = grid.create_input_file_path_dict(IC)
+    if len(input_file_paths) == 0:
+        print('Error: no cell stacks were found')
+        return
+
+    x, y = grid.quilt_grid_axes(IC, IC.posting)
+
+    cells = []
+    cell_times = []
+    variables = None
+    for cell_ID in input_file_paths:
+        ds = store.open_stack(input_file_paths[cell_ID])
+        cell_times.append(grid.stack_times(ds))
+        if variables is None:
+            variables = [
+                v for v in ds.variables
+                if store.variable_dimensions(ds.variables[v])[1:] == ('y',
+                                                                      'x')
+            ]
+        row, col, n_rows, n_cols, flip_y = cell_window(
+            x, y, np.array(ds.variables['x'][:]),
+            np.array(ds.variables['y'][:]))
+        ds.close()
+
+        cells.append({
+            'cell_ID': cell_ID,
+            'path': os.path.abspath(input_file_paths[cell_ID]),
+            'row': row,
+            'col': col,
+            'n_rows': n_rows,
+            'n_cols': n_cols
+        })
+
+    t = np.unique(np.concatenate(cell_times))
+    for cell, times in zip(cells, cell_times):
+        cell['epochs'] = [int(i) for i in np.searchsorted(t, times)]
+
+    return VirtualMosaic(t, x, y, variables, cells, no_data_value,
+                         memory.working_dtype(IC))
+
+
+def load_virtual_mosaic(index_file):
+    with open(index_file, 'r') as f:
+        index = json.load(f)
+
+    index_folder = os.path.dirname(os.path.abspath(index_file))
+    cells = []
+    for cell in index['cells']:
+        cell = dict(cell)
+        cell['path'] = os.path.normpath(
+            os.path.join(index_folder, cell['path']))
+        cells.append(cell)
+
+    no_data_value = index['no_data_value']
+    if no_data_value is None:
+        no_data_value = np.nan
+
+    # indexes saved before the dtype was kept are read as the working dtype
+    return VirtualMosaic(index['t'], axis_from_index(index['x']),
+                         axis_from_index(index['y']), index['variables'],
+                         cells, no_data_value, index.get('dtype'))
+
+
+def save_virtual_mosaic(IC, no_data_value=np.nan):
+    # Build the mosaic of IC.cells and save its index next to the quilted
+    # files as <nickname>_mosaic.json
+    mosaic = build_virtual_mosaic(IC, no_data_value)
+    if mosaic is None:
+        return
+
+    output_path = os.path.join(IC.data_folder, 'Output', IC.icesheet_name,
+                               IC.data_type.title())
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    index_file = os.path.join(output_path, IC.nickname + "_mosaic.json")
+    mosaic.save(index_file)
+    print('Saved mosaic index to ' + index_file)
+
+    return mosaic
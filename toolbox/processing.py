@@ -0,0 +1,296 @@
+import os
+import time
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import toolbox.catalog as catalog
+import toolbox.grid_generation as grid
+import toolbox.memory as memory
+import toolbox.store_nc as store
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Parallel per-cell processing
+#
+# The pipeline works on one cell at a time by setting region_name, extents
+# and the grids on a shared IcesheetCHANGES object, so cells cannot be run
+# concurrently on that object. Instead, every cell is described by an
+# immutable CellJob holding the cell ID, its bounds from the grid_dict and a
+# copy of the configuration. Each job is run in a worker process on a fresh
+# IcesheetCHANGES object, and the results (or errors) are collected by cell.
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+CellJob = collections.namedtuple('CellJob', [
+    'cell_ID', 'extents', 'icesheet_name', 'project_folder', 'data_folder',
+    'settings'
+])
+
+CellResult = collections.namedtuple(
+    'CellResult', ['cell_ID', 'output_file', 'error', 'summary', 'seconds'])
+
+# attributes which are set for each cell and are not part of the settings
+cell_attributes = ['region_name', 'extents', 'output_summary']
+
+
+def cell_output_file(IC, cell_ID):
+    return store.stack_path(IC, cell_ID)
+
+
+def job_settings(IC):
+    # Copy the scalar settings of an IcesheetCHANGES object (collection,
+    # posting, epsg, paths, ...) as a tuple of (name, value) pairs
+    settings = []
+    for name, value in sorted(vars(IC).items()):
+        if name in cell_attributes:
+            continue
+        if value is None or isinstance(value, (bool, int, float, str)):
+            settings.append((name, value))
+    return tuple(settings)
+
+
+def with_setting(settings, name, value):
+    return tuple([(n, v) for n, v in settings if n != name] + [(name, value)])
+
+
+def build_cell_jobs(IC, cell_IDs=None, skip_existing=True):
+    if cell_IDs is None:
+        cell_IDs = IC.cells
+
+    settings = job_settings(IC)
+    jobs = []
+    for cell_ID in cell_IDs:
+        # with incremental updates the existing stacks get the new epochs
+        if skip_existing and not IC.incremental_update and os.path.exists(
+                cell_output_file(IC, cell_ID)):
+            print("        Skipping existing file for " + cell_ID + "...")
+            continue
+        extents = tuple(grid.grid_cell_ID_to_cell_bounds(
+            cell_ID, IC.grid_dict))
+        jobs.append(
+            CellJob(cell_ID, extents, IC.icesheet_name, IC.project_folder,
+                    IC.data_folder, settings))
+
+    return jobs
+
+
+def ic_from_job(job):
+    # Rebuild an IcesheetCHANGES object for a single cell
+    import toolbox.IcesheetCHANGES as ic
+
+    if job.icesheet_name == 'Greenland':
+        IC = ic.GreenlandCHANGES(job.project_folder, job.data_folder)
+    elif job.icesheet_name == 'Antarctic':
+        IC = ic.AntarcticCHANGES(job.project_folder, job.data_folder)
+    else:
+        raise ValueError('Icesheet not recognized: ' + job.icesheet_name)
+
+    for name, value in job.settings:
+        setattr(IC, name, value)
+
+    IC.region_name = job.cell_ID
+    IC.extents = list(job.extents)
+
+    return IC
+
+
+def run_cell_job(job):
+    import toolbox.data_handling as data
+    import toolbox.initiation.grid_construction as grid_construction
+
+    start = time.time()
+    IC = ic_from_job(job)
+    error = None
+    try:
+        # create the grids in memory
+        grid_construction.create_grid_from_extents(IC)
+
+        if IC.short_name == 'ATL15 Antarctic Elevation':
+            data.handle_atl(IC)
+        elif IC.data_type.lower() == 'velocity':
+            data.handle_measures(IC)
+        else:
+            raise ValueError('No handler for ' + IC.short_name)
+    except Exception as e:
+        error = type(e).__name__ + ': ' + str(e)
+
+    output_file = cell_output_file(IC, job.cell_ID)
+    if error is None and not os.path.exists(output_file):
+        output_file = None
+
+    return CellResult(job.cell_ID, output_file, error, IC.output_summary,
+                      time.time() - start)
+
+
+def count_epochs(IC):
+    # Number of epochs in the stack of a cell, used to estimate its memory
+    if IC.data_type.lower() == 'velocity':
+        return max(len(catalog.measures_file_sets(IC)), 1)
+
+    import netCDF4 as nc
+    files = catalog.list_files(IC, suffix='.nc')
+    if len(files) == 0:
+        return 1
+    ds = nc.Dataset(os.path.join(IC.download_path, files[0]), 'r')
+    if 'delta_h' in ds.groups:
+        n_epochs = len(ds.groups['delta_h'].dimensions['time'])
+    else:
+        n_epochs = 1
+    ds.close()
+    return n_epochs
+
+
+def pool_size(IC, jobs, n_workers=None):
+    # The number of worker processes is limited by the cores, the memory
+    # budget and the number of jobs
+    if n_workers is None:
+        n_workers = IC.processing_workers
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+
+    memory_budget = memory.memory_budget(IC)
+    if memory_budget is not None and len(jobs) > 0:
+        n_epochs = count_epochs(IC)
+        largest = max([
+            memory.estimate_cell_memory(IC, j.extents, n_epochs)
+            for j in jobs
+        ])
+        print('Estimated peak memory per cell: ' +
+              memory.format_bytes(largest) + ' (budget ' +
+              memory.format_bytes(memory_budget) + ')')
+        if largest > memory_budget:
+            # the cells are built in batches of epochs (see
+            # data_handling.handle_measures), one cell at a time
+            print('Warning: a cell needs more than the memory budget, so '
+                  'its epochs are processed in batches')
+        n_workers = min(n_workers, max(memory_budget // max(largest, 1), 1))
+
+    return int(max(min(n_workers, len(jobs)), 1))
+
+
+def run_cells(IC, cell_IDs=None, n_workers=None, skip_existing=True):
+    # Process the cells in a pool of worker processes. Returns
+    # {cell_ID: CellResult}; a cell which failed has its error set.
+    jobs = build_cell_jobs(IC, cell_IDs, skip_existing)
+    if len(jobs) == 0:
+        return {}
+
+    # bring the catalog up to date once, so the workers only read it
+    catalog.list_files(IC)
+
+    n_workers = pool_size(IC, jobs, n_workers)
+    print('Processing ' + str(len(jobs)) + ' cells with ' + str(n_workers) +
+          ' workers')
+
+    # the workers share the memory budget
+    budget = memory.memory_budget(IC)
+    if budget is not None:
+        jobs = [
+            job._replace(settings=with_setting(job.settings, 'memory_budget',
+                                               budget // n_workers))
+            for job in jobs
+        ]
+
+    results = {}
+    start = time.time()
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=n_workers,
+                             mp_context=context) as executor:
+        futures = {executor.submit(run_cell_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # the worker process itself failed (e.g. it ran out of memory)
+                result = CellResult(job.cell_ID, None,
+                                    type(e).__name__ + ': ' + str(e), '', 0.)
+            results[job.cell_ID] = result
+            IC.output_summary += result.summary
+
+            if result.error is None:
+                message = 'Finished ' + job.cell_ID
+            else:
+                message = 'Error in ' + job.cell_ID + ': ' + result.error
+            print(message + ' (' + str(len(results)) + ' of ' +
+                  str(len(jobs)) + ')')
+
+    failed = [c for c in results if results[c].error is not None]
+    print('Processed ' + str(len(results)) + ' cells in ' +
+          str(round(time.time() - start, 1)) + ' s (' + str(len(failed)) +
+          ' failed)')
+
+    return results
+
+
+def quilt_cell_job(output_file, x, y, cell_file, grid_variable_labels,
+                   time_chunk, cell_shape):
+    # Copy one cell into a shared Zarr quilt. The chunks of the quilt are
+    # aligned to the cells, so the workers never write the same chunk.
+    start = time.time()
+    error = None
+    try:
+        output = store.open_stack(output_file, 'a')
+        grid.copy_cell_into_quilt(output, x, y, cell_file,
+                                  grid_variable_labels, time_chunk,
+                                  cell_shape)
+        output.close()
+    except Exception as e:
+        error = type(e).__name__ + ': ' + str(e)
+    return error, time.time() - start
+
+
+def quilt_cells(IC, grid_variable_labels, n_workers=None, no_data_value=0):
+    # Quilt the stacks of IC.cells into one Zarr store
+    # (<nickname>_stack.zarr), with the cells written by a pool of worker
+    # processes at the same time. Returns (output_file, {cell_ID: error})
+    # for the cells which failed.
+    if isinstance(grid_variable_labels, str):
+        grid_variable_labels = [grid_variable_labels]
+
+    input_file_paths, output_path = grid.create_input_file_path_dict(IC)
+    if len(input_file_paths) == 0:
+        print('Error: no cell stacks were found')
+        return None, {}
+    output_file = os.path.join(
+        output_path, IC.nickname + "_stack" + store.storage_backends['zarr'])
+
+    output, x, y = grid.create_quilt(IC, input_file_paths,
+                                     grid_variable_labels, IC.posting,
+                                     output_file, no_data_value)
+    time_chunk = grid.quilt_time_chunk(
+        output.variables[grid_variable_labels[0]])
+    cell_shape = grid.cell_grid_shape(IC, x, y)
+    output.close()
+
+    if n_workers is None:
+        n_workers = IC.processing_workers
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = max(min(n_workers, len(input_file_paths)), 1)
+    print('Quilting ' + str(len(input_file_paths)) + ' cells with ' +
+          str(n_workers) + ' workers')
+
+    errors = {}
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=n_workers,
+                             mp_context=context) as executor:
+        futures = {
+            executor.submit(quilt_cell_job, output_file, x, y,
+                            input_file_paths[cell], grid_variable_labels,
+                            time_chunk, cell_shape): cell
+            for cell in input_file_paths
+        }
+        for future in as_completed(futures):
+            cell = futures[future]
+            try:
+                error, seconds = future.result()
+            except Exception as e:
+                error = type(e).__name__ + ': ' + str(e)
+            if error is not None:
+                errors[cell] = error
+                print('Error in ' + cell + ': ' + error)
+
+    print('Saved quilt to ' + output_file + ' (' + str(len(errors)) +
+          ' cells failed)')
+
+    return output_file, errors
@@ -1,66 +1,142 @@
-
-from pyproj import Transformer
-from pyproj import Proj, transform
+import os
+import threading
+from pyproj import CRS, Transformer
 import numpy as np
 
+# Transformers are costly to build (they look up the PROJ database), so one
+# is kept per (inputCRS, outputCRS, always_xy) for the whole process. pyproj
+# transformers can be shared between threads, and the lock makes sure each
+# one is only built (and tested) once.
+transformers = {}
+tested_pairs = set()
+transformers_lock = threading.Lock()
 
+# known (lon, lat) -> (x, y) points of the polar stereographic projections
+reference_points = {
+    3413: [(-45, 70), (0.0, -2187927.649279021)],
+    3031: [(0, -71), (0.0, 2082760.1085429136)],
+}
 
-def run_reprojection_test(inputCRS,outputCRS):
-    transformer = Transformer.from_crs('EPSG:' + str(inputCRS), 'EPSG:' + str(outputCRS))
-    if inputCRS == 4326 and outputCRS == 3413:
-        x = -45
-        y = 70
-        x_test, y_test = transformer.transform(y, x)
-        if round(x_test) == 0.0 and round(y_test) == round(-2187927.649279021):
-            a = 1  # everything is fine
-        else:
-            raise ValueError('The reproject_polygon script is not working as expected')
-    elif inputCRS == 3413 and outputCRS == 4326:
-        x = 474989
-        y = -2282155
-        y_test, x_test = transformer.transform(x, y)
-        if round(x_test) == round(-33.24277887223666) and round(y_test) == round(68.71949001916302):
-            a = 1  # everything is fine
-        else:
-            raise ValueError('The reproject_polygon script is not working as expected')
-    else:
-        raise ValueError('This epsg is not available in the reprojection script test')
 
+def get_transformer(inputCRS,outputCRS,always_xy=True,run_test=True):
+    # Get the cached transformer between two EPSG codes. With always_xy the
+    # points are always (x, y) or (lon, lat), whatever the axis order of the
+    # CRS is.
+    key = (int(inputCRS), int(outputCRS), bool(always_xy))
+    with transformers_lock:
+        if key not in transformers:
+            transformers[key] = Transformer.from_crs('EPSG:' + str(key[0]), 'EPSG:' + str(key[1]),
+                                                     always_xy=key[2])
+        transformer = transformers[key]
 
+        if run_test and key[:2] not in tested_pairs:
+            run_reprojection_test(key[0], key[1])
+            tested_pairs.add(key[:2])
 
+    return transformer
 
 
-def reproject_polygon(polygon_array,inputCRS,outputCRS,x_column=0,y_column=1,run_test = True):
+def test_point(epsg):
+    # a point in the area of use of a CRS, in its own (x, y)
+    if epsg == 4326:
+        return 0.0, 0.0
+    if epsg in reference_points:
+        return reference_points[epsg][1]
+    area = CRS.from_epsg(epsg).area_of_use
+    lon = (area.west + area.east) / 2
+    lat = (area.south + area.north) / 2
+    transformer = Transformer.from_crs('EPSG:4326', 'EPSG:' + str(epsg), always_xy=True)
+    return transformer.transform(lon, lat)
+
 
-    transformer = Transformer.from_crs('EPSG:' + str(inputCRS), 'EPSG:' + str(outputCRS))
-
-    # There seems to be a serious problem with pyproj
-    # The x's and y's are mixed up for these transformations
-    #       For 4326->3413, you put in (y,x) and get out (x,y)
-    #       For 3413->4326, you put in (x,y) and get out (y,x)
-    #       For 326XX->3413, you put in (x,y) and get out (x,y)
-    # Safest to run check here to ensure things are outputting as expected with future iterations of pyproj
-
-    if inputCRS == 4326 and outputCRS == 3413:
-        x2, y2 = transformer.transform(polygon_array[:,y_column], polygon_array[:,x_column])
-        x2 = np.array(x2)
-        y2 = np.array(y2)
-    elif inputCRS == 3413 and outputCRS == 4326:
-        y2, x2 = transformer.transform(polygon_array[:, x_column], polygon_array[:, y_column])
-        x2 = np.array(x2)
-        y2 = np.array(y2)
-    elif str(inputCRS)[:3] == '326' and outputCRS == 3413:
-        x2, y2 = transformer.transform(polygon_array[:,x_column], polygon_array[:,y_column])
-        x2 = np.array(x2)
-        y2 = np.array(y2)
-        run_test = False
+def run_reprojection_test(inputCRS,outputCRS):
+    # Check a transformation once before it is used. Between EPSG:4326 and a
+    # projection with a reference point, the point must come out where it is
+    # expected; any other pair must take a point there and back again.
+    inputCRS = int(inputCRS)
+    outputCRS = int(outputCRS)
+    to_output = Transformer.from_crs('EPSG:' + str(inputCRS), 'EPSG:' + str(outputCRS), always_xy=True)
+
+    if inputCRS == 4326 and outputCRS in reference_points:
+        (x, y), expected = reference_points[outputCRS]
+    elif outputCRS == 4326 and inputCRS in reference_points:
+        expected, (x, y) = reference_points[inputCRS]
     else:
-        raise ValueError('Reprojection with this epsg is not safe - no test for validity has been implemented')
+        x, y = test_point(inputCRS)
+        to_input = Transformer.from_crs('EPSG:' + str(outputCRS), 'EPSG:' + str(inputCRS), always_xy=True)
+        expected = (x, y)
+        x, y = to_output.transform(x, y)
+        to_output = to_input
+
+    x_test, y_test = to_output.transform(x, y)
+    if not np.allclose([x_test, y_test], expected, atol=1e-3):
+        raise ValueError('The reprojection from EPSG:' + str(inputCRS) + ' to EPSG:' + str(outputCRS) +
+                         ' is not working as expected')
+
+
+def transform_points(x,y,inputCRS,outputCRS,run_test=True):
+    # reproject arrays of x and y (lon and lat for EPSG:4326)
+    if int(inputCRS) == int(outputCRS):
+        return np.array(x, dtype=float), np.array(y, dtype=float)
+    transformer = get_transformer(inputCRS, outputCRS, run_test=run_test)
+    x2, y2 = transformer.transform(x, y)
+    return np.array(x2), np.array(y2)
 
-    if run_test:
-        run_reprojection_test(inputCRS,outputCRS)
+
+def reproject_polygon(polygon_array,inputCRS,outputCRS,x_column=0,y_column=1,run_test = True):
+    # The transformers always take and give (x, y), or (lon, lat) for
+    # EPSG:4326, so any pair of EPSG codes can be used (e.g. 3031 <-> 4326).
+    # The test of each pair is run once per process.
+    x2, y2 = transform_points(polygon_array[:, x_column], polygon_array[:, y_column],
+                              inputCRS, outputCRS, run_test)
 
     output_polygon=np.copy(polygon_array)
     output_polygon[:,x_column] = x2
     output_polygon[:,y_column] = y2
-    return output_polygon
\ No newline at end of file
+    return output_polygon
+
+
+def reproject_grid(x,y,inputCRS,outputCRS,out_x=None,out_y=None,rows_per_block=64,n_workers=None):
+    # Reproject every point of the grid given by the 1-D axes x and y. The
+    # results are written straight into out_x and out_y, (len(y), len(x))
+    # float64 arrays which can be memory maps (np.lib.format.open_memmap),
+    # or new arrays if they are not given. Each block of rows is filled with
+    # its axes and transformed in place on a pool of threads, since PROJ
+    # releases the GIL. Returns out_x, out_y.
+    from concurrent.futures import ThreadPoolExecutor
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    shape = (len(y), len(x))
+    if out_x is None:
+        out_x = np.empty(shape)
+    if out_y is None:
+        out_y = np.empty(shape)
+    for out in [out_x, out_y]:
+        if out.shape != shape or out.dtype != np.float64 or not out.flags['C_CONTIGUOUS']:
+            raise ValueError('The output arrays must be C-contiguous float64 arrays of shape ' + str(shape))
+
+    transformer = None
+    if int(inputCRS) != int(outputCRS):
+        transformer = get_transformer(inputCRS, outputCRS)
+
+    def reproject_rows(start):
+        stop = min(start + rows_per_block, len(y))
+        block_x = out_x[start:stop]
+        block_y = out_y[start:stop]
+        block_x[:] = x[np.newaxis, :]
+        block_y[:] = y[start:stop, np.newaxis]
+        if transformer is not None:
+            transformer.transform(block_x, block_y, inplace=True)
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    starts = range(0, len(y), rows_per_block)
+    if n_workers == 1 or len(starts) == 1:
+        for start in starts:
+            reproject_rows(start)
+    else:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            list(executor.map(reproject_rows, starts))
+
+    return out_x, out_y
@@ -1,80 +1,93 @@
-
 # this function is used to interpolate a coarser resolution grid onto more dense grid
 
 import numpy as np
-import matplotlib.pyplot as plt
-from ..series import series_to_N_points
-from ..reprojection import reproject_polygon
-from scipy.interpolate import interp2d
-import matplotlib.path as mplPath
+from ..reprojection import reproject_grid
+from . import plan_cache
+from scipy.interpolate import RegularGridInterpolator
+
+
+def source_interpolator(source_x,source_y,source_grid,interpolation_type='linear'):
+    # RegularGridInterpolator needs ascending axes, so flip descending ones
+    source_x = np.asarray(source_x,dtype=float)
+    source_y = np.asarray(source_y,dtype=float)
+    source_grid = np.asarray(source_grid,dtype=float)
+    if len(source_x)>1 and source_x[0]>source_x[-1]:
+        source_x = source_x[::-1]
+        source_grid = source_grid[:,::-1]
+    if len(source_y)>1 and source_y[0]>source_y[-1]:
+        source_y = source_y[::-1]
+        source_grid = source_grid[::-1,:]
+
+    return RegularGridInterpolator((source_y,source_x),source_grid,method=interpolation_type,
+                                   bounds_error=False,fill_value=np.nan)
+
+
+def linear_plan(source_x,source_y,dest_x,dest_y,source_epsg,dest_epsg,rows_per_block=256):
+    # the bilinear plan of the destination grid, built in blocks of rows
+    plans = []
+    for yi in range(0,len(dest_y),rows_per_block):
+        X, Y = reproject_grid(dest_x,dest_y[yi:yi+rows_per_block],dest_epsg,source_epsg)
+        plans.append(plan_cache.bilinear_point_plan(source_x,source_y,X,Y,offset=yi*len(dest_x)))
+    return plan_cache.concatenate_plans(plans,(len(dest_y),len(dest_x)))
+
 
 def reproject_and_interpolate_onto_grid(source_x,source_y,source_grid,source_epsg,
                                         dest_x,dest_y,dest_epsg,
-                                        print_status_messages=False, interpolation_type = 'linear'):
+                                        print_status_messages=False, interpolation_type = 'linear',
+                                        rows_per_block=256,plan_folder=None,
+                                        max_plan_bytes=plan_cache.default_max_bytes):
+
+    # The destination grid is sampled in blocks of rows, so only the points
+    # of one block are reprojected and held in memory at a time. Points
+    # outside of the source grid, or where the interpolation is nan, are -99.
+    # Linear interpolation uses a cached plan of the neighbours and weights
+    # (kept in plan_folder, if given, for later runs), so the same pair of
+    # grids is only reprojected once.
 
-    # plt.contourf(source_x,source_y,source_grid)
-    # plt.show()
+    dest_x = np.asarray(dest_x,dtype=float)
+    dest_y = np.asarray(dest_y,dtype=float)
+
+    if interpolation_type == 'linear':
+        key = plan_cache.plan_key(source_x,source_y,dest_x,dest_y,source_epsg,dest_epsg,'linear')
+        plan = plan_cache.get_plan(plan_folder,key,
+                                   lambda: linear_plan(source_x,source_y,dest_x,dest_y,
+                                                       source_epsg,dest_epsg,rows_per_block),
+                                   max_plan_bytes)
+        if print_status_messages:
+            print('                    Sampling the interpolation plan on the grid')
+        grid = plan_cache.apply_plan(plan,source_grid,-99)
+        grid[np.isnan(grid)] = -99
+        return(grid)
 
     if print_status_messages:
         print('                    Creating the interpolation object')
-    set_int = interp2d(source_x,source_y,source_grid, kind=interpolation_type)
+    set_int = source_interpolator(source_x,source_y,source_grid,interpolation_type)
 
-    X, Y = np.meshgrid(dest_x,dest_y)
-    points = np.hstack([np.reshape(X, (np.size(X), 1)),
-                        np.reshape(Y, (np.size(Y), 1))]).astype(float)
+    # the bounds of the source grid in the source projection
+    # (interpolation seems to give "valid" values outside due to reprojection)
+    min_x = np.min(source_x)
+    max_x = np.max(source_x)
+    min_y = np.min(source_y)
+    max_y = np.max(source_y)
 
-    if source_epsg!=dest_epsg:
-        if print_status_messages:
-            print('                    Reprojecting the points to ' + str(source_epsg)+' for interpolation')
-        points = reproject_polygon(points, dest_epsg, source_epsg)
+    grid = -99*np.ones((len(dest_y),len(dest_x)))
 
+    if source_epsg!=dest_epsg and print_status_messages:
+        print('                    Reprojecting the points to ' + str(source_epsg)+' for interpolation')
     if print_status_messages:
         print('                    Sampling the interpolation object on the grid')
-    X = np.reshape(points[:, 0], np.shape(X))
-    Y = np.reshape(points[:, 1], np.shape(X))
-    grid = -99*np.ones_like(X)
-
-    # spell this path out to make sure corners are preserved
-    southern_line = np.array([[np.min(source_x),np.min(source_y)],
-                            [np.max(source_x),np.min(source_y)]])
-    southern_line = series_to_N_points(southern_line, 25)
-    eastern_line = np.array([[np.max(source_x), np.min(source_y)],
-                            [np.max(source_x), np.max(source_y)]])
-    eastern_line = series_to_N_points(eastern_line, 25)
-    northern_line = np.array([[np.max(source_x), np.max(source_y)],
-                            [np.min(source_x), np.max(source_y)]])
-    northern_line = series_to_N_points(northern_line, 25)
-    western_line = np.array([[np.min(source_x), np.max(source_y)],
-                            [np.min(source_x), np.min(source_y)]])
-    western_line = series_to_N_points(western_line, 25)
-    bbox = np.vstack([southern_line,
-                     eastern_line,
-                     northern_line,
-                     western_line])
-
-    # plt.plot(points[:,0],points[:,1],'k.')
-    # plt.plot(bbox[:,0],bbox[:,1],'r-')
-    # plt.show()
-
-    source_path = mplPath.Path(bbox)
-
-    for yi in range(np.shape(X)[0]):
-        if print_status_messages:
-            if yi == int(0.25*np.shape(X)[0]):
-                print('                      25% complete...')
-            if yi == int(0.5*np.shape(X)[0]):
-                print('                      50% complete...')
-            if yi == int(0.75*np.shape(X)[0]):
-                print('                      75% complete...')
-        for xi in range(np.shape(X)[1]):
-            # make sure the point is inside the boundary
-            # (interpolation seems to give "valid" values outside due to reprojection)
-            # is_inside = source_path.contains_point((X[yi,xi],Y[yi,xi]))
-            # int_val = set_int(X[yi, xi], Y[yi, xi])
-            if source_path.contains_point((X[yi,xi],Y[yi,xi])):
-                int_val = set_int(X[yi,xi],Y[yi,xi])
-                if not np.isnan(int_val):
-                    grid[yi,xi] = int_val
 
-    return(grid)
+    for yi in range(0,len(dest_y),rows_per_block):
+        if print_status_messages and len(dest_y)>rows_per_block:
+            print('                      '+str(int(100*yi/len(dest_y)))+'% complete...')
+
+        # the points of the block in the source projection
+        X, Y = reproject_grid(dest_x,dest_y[yi:yi+rows_per_block],dest_epsg,source_epsg)
 
+        # make sure the points are inside the boundary
+        inside = (X>=min_x) & (X<=max_x) & (Y>=min_y) & (Y<=max_y)
+        values = set_int(np.column_stack([Y[inside],X[inside]]))
+        values[np.isnan(values)] = -99
+        grid[yi:yi+rows_per_block,:][inside] = values
+
+    return(grid)
@@ -0,0 +1,230 @@
+import os
+import hashlib
+import collections
+import numpy as np
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Cache of resampling plans
+#
+# A plan holds, for every destination pixel which falls in the source grid,
+# the indices of its neighbouring source pixels and their weights, so that
+# resampling a grid is only a gather and a weighted sum. A plan only depends
+# on the geometry (the source and destination grids, the EPSG codes and the
+# method), so it is keyed by a hash of those and kept in memory for the
+# session and as a compressed .npz in a plan folder for later runs. Both the
+# plans in memory and the plan folder are limited in total size, and the
+# least recently used plans are removed first.
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# plans which have been used in this session, most recently used last, and
+# their total size in bytes
+session_plans = collections.OrderedDict()
+session_bytes = 0
+
+default_max_bytes = 2 * 1024**3
+default_max_session_bytes = 512 * 1024**2
+
+
+def plan_key(source_x, source_y, dest_x, dest_y, source_epsg=None,
+             dest_epsg=None, method='linear'):
+    # the same geometry always gives the same plan
+    key = hashlib.sha1()
+    for a in [source_x, source_y, dest_x, dest_y]:
+        a = np.ascontiguousarray(a, dtype='f8')
+        key.update(str(a.shape).encode())
+        key.update(a.tobytes())
+    key.update(str((source_epsg, dest_epsg, method)).encode())
+    return key.hexdigest()
+
+
+def plan_file(plan_folder, key):
+    return os.path.join(plan_folder, key + '.npz')
+
+
+def folder_size(plan_folder):
+    # total size of the plans in a folder, and the plans oldest first
+    plans = []
+    for file_name in os.listdir(plan_folder):
+        if not file_name.endswith('.npz') or file_name.endswith('.tmp.npz'):
+            continue
+        try:
+            stat = os.stat(os.path.join(plan_folder, file_name))
+        except FileNotFoundError:
+            continue
+        plans.append((stat.st_mtime, stat.st_size, file_name))
+    plans.sort()
+    return sum([p[1] for p in plans]), plans
+
+
+def evict_plans(plan_folder, max_bytes=default_max_bytes):
+    # remove the least recently used plans until the folder fits in max_bytes
+    total, plans = folder_size(plan_folder)
+    for mtime, size, file_name in plans:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(plan_folder, file_name))
+        except FileNotFoundError:
+            # another process removed it first
+            pass
+        total -= size
+    return total
+
+
+def plan_bytes(plan):
+    return sum([np.asarray(v).nbytes for v in plan.values()])
+
+
+def forget_plan(key):
+    global session_bytes
+    session_bytes -= plan_bytes(session_plans.pop(key))
+
+
+def remember_plan(key, plan, max_session_bytes=default_max_session_bytes):
+    # keep the plan in memory, and forget the least recently used plans until
+    # the plans in memory fit in max_session_bytes (a plan which is larger
+    # than that on its own is not kept)
+    global session_bytes
+    if key in session_plans:
+        forget_plan(key)
+    session_plans[key] = plan
+    session_bytes += plan_bytes(plan)
+    while session_bytes > max_session_bytes and len(session_plans) > 0:
+        forget_plan(next(iter(session_plans)))
+
+
+def load_plan(plan_folder, key,
+              max_session_bytes=default_max_session_bytes):
+    # Get a plan from this session or from the plan folder (or None)
+    if key in session_plans:
+        session_plans.move_to_end(key)
+        return session_plans[key]
+    if plan_folder is None or not os.path.exists(plan_file(plan_folder, key)):
+        return None
+
+    try:
+        with np.load(plan_file(plan_folder, key)) as f:
+            plan = dict(f)
+        # mark the plan as recently used
+        os.utime(plan_file(plan_folder, key))
+    except (FileNotFoundError, OSError, ValueError):
+        # evicted by another process, or not a valid plan
+        return None
+
+    remember_plan(key, plan, max_session_bytes)
+    return plan
+
+
+def save_plan(plan_folder, key, plan, max_bytes=default_max_bytes,
+              max_session_bytes=default_max_session_bytes):
+    remember_plan(key, plan, max_session_bytes)
+    if plan_folder is None:
+        return
+
+    if not os.path.exists(plan_folder):
+        os.makedirs(plan_folder, exist_ok=True)
+    # write to a temporary file first, so other processes never see a
+    # partially written plan
+    temp_file = plan_file(plan_folder, key) + '.' + str(os.getpid()) + '.tmp.npz'
+    np.savez_compressed(temp_file, **plan)
+    os.replace(temp_file, plan_file(plan_folder, key))
+
+    evict_plans(plan_folder, max_bytes)
+
+
+def get_plan(plan_folder, key, build_plan, max_bytes=default_max_bytes,
+             max_session_bytes=default_max_session_bytes):
+    # Get a plan from the cache, or build it with build_plan() and cache it.
+    # With plan_folder None, plans are only kept for the session. max_bytes
+    # limits the plan folder and max_session_bytes the plans in memory.
+    plan = load_plan(plan_folder, key, max_session_bytes)
+    if plan is None:
+        plan = build_plan()
+        save_plan(plan_folder, key, plan, max_bytes, max_session_bytes)
+    return plan
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Bilinear plans
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def axis_weights(axis, points):
+    # Get the index of the lower neighbour on a regular (ascending or
+    # descending) axis for each point and the weight of the upper neighbour.
+    # Points outside of the axis get an index of -1.
+    if axis[0] > axis[-1]:
+        lower, weight = axis_weights(axis[::-1], points)
+        valid = lower >= 0
+        lower[valid] = len(axis) - 2 - lower[valid]
+        weight[valid] = 1 - weight[valid]
+        return lower, weight
+
+    lower = np.searchsorted(axis, points, side='right') - 1
+    # points on the last grid line use the last interval
+    lower[points == axis[-1]] = len(axis) - 2
+    valid = (lower >= 0) & (lower <= len(axis) - 2)
+    lower[~valid] = -1
+
+    weight = np.zeros(len(points))
+    weight[valid] = (points[valid] - axis[lower[valid]]) / (
+        axis[lower[valid] + 1] - axis[lower[valid]])
+    return lower, weight
+
+
+def bilinear_point_plan(x, y, points_x, points_y, offset=0):
+    # Indices of the four neighbouring source points (flattened over y, x) of
+    # each point and their bilinear weights. Points outside of the source grid
+    # get no neighbours. The targets are the indices of the points plus
+    # offset.
+    x = np.asarray(x, dtype='f8')
+    y = np.asarray(y, dtype='f8')
+    i, wx = axis_weights(x, np.ravel(points_x))
+    j, wy = axis_weights(y, np.ravel(points_y))
+    valid = (i >= 0) & (j >= 0)
+
+    i = i[valid]
+    j = j[valid]
+    wx = wx[valid]
+    wy = wy[valid]
+    indices = np.column_stack(((j * len(x)) + i, (j * len(x)) + i + 1,
+                               ((j + 1) * len(x)) + i,
+                               ((j + 1) * len(x)) + i + 1))
+    weights = np.column_stack(((1 - wx) * (1 - wy), wx * (1 - wy),
+                               (1 - wx) * wy, wx * wy))
+
+    return {'targets': np.nonzero(valid)[0] + offset, 'indices': indices,
+            'weights': weights}
+
+
+def concatenate_plans(plans, shape):
+    # join the plans of blocks of a destination grid of the given shape
+    return {
+        'targets': np.concatenate([p['targets'] for p in plans]),
+        'indices': np.concatenate([p['indices'] for p in plans]).reshape(-1, 4),
+        'weights': np.concatenate([p['weights'] for p in plans]).reshape(-1, 4),
+        'shape': np.array(shape)
+    }
+
+
+def apply_plan(plan, values, fill_value=np.nan, dtype='float64'):
+    # Resample a (y, x) grid or all time slices of a (time, y, x) stack at
+    # once. A nan at any of the neighbours gives a nan, and the destination
+    # pixels outside of the source grid are fill_value.
+    values = np.asarray(values, dtype=dtype)
+    single = values.ndim == 2
+    if single:
+        values = values[np.newaxis]
+    n_time = values.shape[0]
+    values = np.reshape(values, (n_time, -1))
+    n_targets = plan['shape'][0] * plan['shape'][1]
+
+    output = np.full((n_time, n_targets), fill_value, dtype=dtype)
+    weights = plan['weights'].astype(dtype)
+    output[:, plan['targets']] = np.sum(values[:, plan['indices']] * weights,
+                                        axis=2)
+
+    output = np.reshape(output, (n_time, plan['shape'][0], plan['shape'][1]))
+    if single:
+        return output[0]
+    return output
@@ -3,45 +3,41 @@ import numpy as np
 from scipy.interpolate import interp1d
 
 def series_to_N_points(series,N):
-    #find the total length of the series
-    totalDistance=0
-    for s in range(len(series[:,0])-1):
-        totalDistance+=((series[s,0]-series[s+1,0])**2+(series[s,1]-series[s+1,1])**2)**0.5
-    intervalDistance=totalDistance/(N-1)
-
-    #make the list of points
-    newSeries=series[0,:]
-    currentS = 0
-    currentPoint1=series[currentS,:]
-    currentPoint2=series[currentS+1,:]
-    for p in range(N-2):
-        distanceAccrued = 0
-        while distanceAccrued<intervalDistance:
-            currentLineDistance=((currentPoint1[0]-currentPoint2[0])**2+(currentPoint1[1]-currentPoint2[1])**2)**0.5
-            if currentLineDistance<intervalDistance-distanceAccrued:
-                distanceAccrued+=currentLineDistance
-                currentS+=1
-                currentPoint1 = series[currentS, :]
-                currentPoint2 = series[currentS + 1, :]
-            else:
-                distance=intervalDistance-distanceAccrued
-                newX=currentPoint1[0]+(distance/currentLineDistance)*(currentPoint2[0]-currentPoint1[0])
-                newY = currentPoint1[1] + (distance / currentLineDistance) * (currentPoint2[1] - currentPoint1[1])
-                distanceAccrued=intervalDistance+1
-                newSeries=np.vstack([newSeries,np.array([newX,newY])])
-                currentPoint1=np.array([newX,newY])
-    newSeries = np.vstack([newSeries, series[-1,:]])
+    #find the distance along the series at each of its points
+    segmentDistances=np.sqrt(np.sum(np.diff(series[:,:2],axis=0)**2,axis=1))
+    cumulativeDistance=np.concatenate([[0],np.cumsum(segmentDistances)])
+    #a series without any length has no inner points
+    if cumulativeDistance[-1]==0:
+        return(np.vstack([series[0,:],series[-1,:]]))
+    intervalDistance=cumulativeDistance[-1]/(N-1)
+
+    #place the N-2 inner points at equal distances along the series
+    pointDistances=np.arange(1,N-1)*intervalDistance
+    newX=np.interp(pointDistances,cumulativeDistance,series[:,0])
+    newY=np.interp(pointDistances,cumulativeDistance,series[:,1])
+    newSeries=np.vstack([series[0,:],np.column_stack([newX,newY]),series[-1,:]])
     return(newSeries)
 
 def sliding_average(series,N):
+    #average over the window [i-(N-1)/2, i+(N-1)/2) of each point, truncated
+    #at the ends, using prefix sums. A window with a nan in it averages to nan.
     if N%2==0:
         N+=1
     averagedSeries=np.zeros_like(series)
     averagedSeries[:,0]=series[:,0]
-    for i in range(len(series)):
-        minIndex=int(np.max([0,i-(N-1)/2]))
-        maxIndex=int(np.min([len(series),i+(N-1)/2]))
-        averagedSeries[i,1]=np.mean(series[minIndex:maxIndex,1])
+    values=np.asarray(series[:,1],dtype=float)
+    isNan=np.isnan(values)
+    valueSums=np.concatenate([[0],np.cumsum(np.where(isNan,0,values))])
+    nanCounts=np.concatenate([[0],np.cumsum(isNan)])
+
+    indices=np.arange(len(series))
+    minIndices=np.maximum(0,indices-(N-1)//2)
+    maxIndices=np.minimum(len(series),indices+(N-1)//2)
+    counts=maxIndices-minIndices
+    with np.errstate(invalid='ignore',divide='ignore'):
+        means=(valueSums[maxIndices]-valueSums[minIndices])/counts
+    means[nanCounts[maxIndices]-nanCounts[minIndices]>0]=np.nan
+    averagedSeries[:,1]=means
     return(averagedSeries)
 
 def smooth_timeseries_annually(timeseries):
@@ -64,4 +60,68 @@ def smooth_timeseries_seasonally(timeseries):
                                            np.reshape(set_int(time),(len(time),1))])
     smooth_timeseries = sliding_average(dense_timeseries,90)
 
-    return(smooth_timeseries)
\ No newline at end of file
+    return(smooth_timeseries)
+
+def interpolate_stack(time,stack,newTime):
+    #linearly interpolate each column of a (N, P) stack from time onto newTime
+    #(both sorted), bridging nan gaps. Times outside the valid values of a
+    #column are nan.
+    N=len(time)
+    valid=np.isfinite(stack)
+    indices=np.arange(N)[:,None]
+    previousValid=np.maximum.accumulate(np.where(valid,indices,-1),axis=0)
+    nextValid=np.minimum.accumulate(np.where(valid,indices,N)[::-1],axis=0)[::-1]
+
+    j=np.clip(np.searchsorted(time,newTime,side='right')-1,0,N-1)
+    lowIndices=previousValid[j]
+    highIndices=nextValid[np.minimum(j+1,N-1)]
+    highIndices=np.where(highIndices>=N,np.maximum(lowIndices,0),highIndices)
+    lowIndices=np.where(lowIndices<0,highIndices,lowIndices)
+    lowIndices=np.minimum(lowIndices,N-1)
+    highIndices=np.minimum(highIndices,N-1)
+
+    lowTime=time[lowIndices]
+    highTime=time[highIndices]
+    t=newTime[:,None]
+    span=highTime-lowTime
+    with np.errstate(invalid='ignore',divide='ignore'):
+        weights=np.where(span>0,(t-lowTime)/span,0)
+    newStack=(np.take_along_axis(stack,lowIndices,axis=0)*(1-weights)+
+              np.take_along_axis(stack,highIndices,axis=0)*weights)
+    newStack[(t<lowTime)|(t>highTime)]=np.nan
+    return(newStack)
+
+def sliding_average_stack(stack,N):
+    #sliding_average along the first axis of a (M, P) stack, over the same
+    #truncated windows, ignoring nans
+    if N%2==0:
+        N+=1
+    isNan=np.isnan(stack)
+    zeros=np.zeros((1,np.shape(stack)[1]))
+    valueSums=np.concatenate([zeros,np.cumsum(np.where(isNan,0,stack),axis=0)])
+    valueCounts=np.concatenate([zeros,np.cumsum(~isNan,axis=0)])
+
+    indices=np.arange(len(stack))
+    minIndices=np.maximum(0,indices-(N-1)//2)
+    maxIndices=np.minimum(len(stack),indices+(N-1)//2)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        averagedStack=((valueSums[maxIndices]-valueSums[minIndices])/
+                       (valueCounts[maxIndices]-valueCounts[minIndices]))
+    return(averagedStack)
+
+def smooth_stack_seasonally(time,stack):
+    #smooth_timeseries_seasonally for every column of a (N, P) stack at once,
+    #for the times (in decimal years) of the stack, which can be irregular
+    #and have nan gaps. The daily grid ends at the last time (so the last
+    #epoch can be filtered too), and is nan in a column outside its valid
+    #values. Returns the daily times and the (M, P) smoothed stack.
+    step=1/365.25
+    time=np.asarray(time,dtype=float)
+    denseTime=np.arange(np.min(time),np.max(time),step)
+    denseTime=np.append(denseTime,np.max(time))
+
+    denseStack=interpolate_stack(time,np.asarray(stack,dtype=float),denseTime)
+    smoothStack=sliding_average_stack(denseStack,90)
+    smoothStack[np.isnan(denseStack)]=np.nan
+
+    return(denseTime,smoothStack)
@@ -1,27 +1,460 @@
 import os
+import shutil
 import netCDF4 as nc
 import datetime as dt
 import xarray as xr
 import numpy as np
 
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Output profiles
+#
+# A profile sets the compression, the chunk shape and the dtype of the
+# (time, y, x) grids of every writer. 'timeseries' chunks the grids as
+# (T, 32, 32) so the time series of a pixel is one chunk, 'maps' chunks
+# them as (1, Y, X) so an epoch is one chunk, and 'uncompressed' keeps the
+# previous unchunked layout. The writers take the profile name (default
+# IC.output_profile) and record it in the output_profile file attribute.
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+output_profiles = {
+    'timeseries': {
+        'zlib': True,
+        'complevel': 4,
+        'shuffle': True,
+        'chunks': 'timeseries',
+        'dtype': 'f4'
+    },
+    'maps': {
+        'zlib': True,
+        'complevel': 4,
+        'shuffle': True,
+        'chunks': 'maps',
+        'dtype': 'f4'
+    },
+    'uncompressed': {
+        'zlib': False,
+        'complevel': 0,
+        'shuffle': False,
+        'chunks': None,
+        'dtype': 'f4'
+    },
+}
+
+default_output_profile = 'timeseries'
+
+# size of the pixel blocks of the 'timeseries' profile and the largest
+# block of the 'maps' profile (netCDF chunks are limited to 4 GB)
+timeseries_block = 32
+max_map_block = 4096
+
+
+def get_profile(IC_object=None, profile=None):
+    if profile is None:
+        profile = getattr(IC_object, 'output_profile', default_output_profile)
+    if profile not in output_profiles:
+        raise ValueError('Output profile not recognized: ' + str(profile) +
+                         '. Available profiles: ' +
+                         ', '.join(output_profiles))
+    return profile
+
+
+def profile_chunks(profile, shape):
+    # chunk shape of a (time, y, x) or (y, x) grid
+    chunks = output_profiles[profile]['chunks']
+    if chunks is None:
+        return None
+
+    shape = [max(int(n), 1) for n in shape]
+    if chunks == 'timeseries':
+        block = [min(n, timeseries_block) for n in shape[-2:]]
+        if len(shape) == 3:
+            return tuple([shape[0]] + block)
+        return tuple(block)
+
+    block = [min(n, max_map_block) for n in shape[-2:]]
+    if len(shape) == 3:
+        return tuple([1] + block)
+    return tuple(block)
+
+
+def netcdf_variable_options(profile, shape):
+    # keyword arguments of netCDF4 createVariable for a grid
+    options = output_profiles[profile]
+    kwargs = {}
+    if options['zlib']:
+        kwargs['zlib'] = True
+        kwargs['complevel'] = options['complevel']
+        kwargs['shuffle'] = options['shuffle']
+    chunks = profile_chunks(profile, shape)
+    if chunks is not None:
+        kwargs['chunksizes'] = chunks
+    return kwargs
+
+
+def xarray_encoding(profile, shape):
+    # xarray to_netcdf encoding of a grid
+    encoding = netcdf_variable_options(profile, shape)
+    encoding['dtype'] = output_profiles[profile]['dtype']
+    return encoding
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Storage backends
+#
+# Stacks and quilts are written either as NetCDF4 files or as Zarr
+# directory stores, selected with IC.storage_backend. In a Zarr store every
+# chunk is a separate file, so several processes can write disjoint chunks
+# of one array at the same time and readers only fetch the chunks they
+# touch. open_stack returns a netCDF4.Dataset, or a ZarrDataset which offers
+# the same variables/attributes access, so the readers work on both.
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+storage_backends = {'netcdf': '.nc', 'zarr': '.zarr'}
+
+default_storage_backend = 'netcdf'
+
+
+def get_backend(IC_object=None, backend=None):
+    if backend is None:
+        backend = getattr(IC_object, 'storage_backend',
+                          default_storage_backend)
+    if backend not in storage_backends:
+        raise ValueError('Storage backend not recognized: ' + str(backend) +
+                         '. Available backends: ' +
+                         ', '.join(storage_backends))
+    return backend
+
+
+def stack_path(IC_object, cell_ID=None, backend=None):
+    # path of the stack of a cell (default IC.region_name)
+    if cell_ID is None:
+        cell_ID = IC_object.region_name
+    suffix = storage_backends[get_backend(IC_object, backend)]
+    return os.path.join(IC_object.data_folder, 'Output',
+                        IC_object.icesheet_name, cell_ID,
+                        IC_object.short_name + "_stack" + suffix)
+
+
+def remove_output(output_file):
+    if os.path.isdir(output_file):
+        shutil.rmtree(output_file)
+    elif os.path.isfile(output_file):
+        os.remove(output_file)
+
+
+def is_zarr(path):
+    return path.endswith(storage_backends['zarr'])
+
+
+class ZarrDataset:
+    # A Zarr group with the variables (name -> array) and the attribute
+    # access of a netCDF4.Dataset
+    def __init__(self, path, mode='r'):
+        import zarr
+
+        if mode == 'a':
+            mode = 'r+'
+        self.path = path
+        self.group = zarr.open_group(path, mode=mode)
+        self.variables = {
+            name: self.group[name]
+            for name in self.group.array_keys()
+        }
+
+    def __getattr__(self, name):
+        attrs = self.__dict__['group'].attrs
+        if name in attrs:
+            return attrs[name]
+        raise AttributeError(name)
+
+    def setncattr(self, name, value):
+        self.group.attrs[name] = value
+
+    def ncattrs(self):
+        return list(self.group.attrs)
+
+    def close(self):
+        return
+
+
+def open_stack(path, mode='r'):
+    if is_zarr(path):
+        return ZarrDataset(path, mode)
+    return nc.Dataset(path, mode)
+
+
+def variable_dimensions(variable):
+    # dimension names of a netCDF4 variable or a Zarr array
+    if hasattr(variable, 'dimensions'):
+        return tuple(variable.dimensions)
+    metadata = getattr(variable, 'metadata', None)
+    if getattr(metadata, 'dimension_names', None) is not None:
+        return tuple(metadata.dimension_names)
+    return tuple(variable.attrs.get('_ARRAY_DIMENSIONS', []))
+
+
+def create_zarr_array(group, name, shape, chunks, dtype, fill_value,
+                      dimensions):
+    if hasattr(group, 'create_array'):
+        # zarr 3
+        return group.create_array(name,
+                                  shape=shape,
+                                  chunks=chunks,
+                                  dtype=dtype,
+                                  fill_value=fill_value,
+                                  dimension_names=dimensions)
+    array = group.create_dataset(name,
+                                 shape=shape,
+                                 chunks=chunks,
+                                 dtype=dtype,
+                                 fill_value=fill_value)
+    array.attrs['_ARRAY_DIMENSIONS'] = list(dimensions)
+    return array
+
+
+def aligned_block(n_cell, block):
+    # largest chunk size of at most block which divides the cells, so each
+    # cell of a shared array is written to its own chunks
+    for n in range(min(n_cell, block), 0, -1):
+        if n_cell % n == 0:
+            return n
+    return 1
+
+
+def write_records(variable, start, values):
+    # write values from record start of a variable, growing a Zarr array
+    # along its first (time) dimension when needed
+    stop = start + len(values)
+    if hasattr(variable, 'resize') and variable.shape[0] < stop:
+        variable.resize((stop, ) + tuple(variable.shape[1:]))
+    variable[start:stop] = values
+
+
+def write_zarr_stack(output_file,
+                     axes,
+                     time_values,
+                     grids,
+                     attributes,
+                     profile,
+                     no_data_value=np.nan,
+                     grid_chunks=None,
+                     time_dimension='time'):
+    # Write a stack as a Zarr store. axes maps 'x'/'y' to their values,
+    # time_values maps the time variables to their values and grids maps the
+    # (time, y, x) grids to their values (or to their shape, to create them
+    # empty). Returns the open ZarrDataset.
+    import zarr
+
+    remove_output(output_file)
+    group = zarr.open_group(output_file, mode='w')
+    for name in attributes:
+        group.attrs[name] = attributes[name]
+    group.attrs['output_profile'] = profile
+
+    for name in axes:
+        values = np.asarray(axes[name])
+        array = create_zarr_array(group, name, values.shape,
+                                  (max(len(values), 1), ), 'f8', np.nan,
+                                  [name])
+        array[:] = values
+
+    for name in time_values:
+        values = np.asarray(time_values[name], dtype='f8')
+        array = create_zarr_array(group, name, values.shape, (1024, ), 'f8',
+                                  np.nan, [time_dimension])
+        array[:] = values
+
+    dtype = output_profiles[profile]['dtype']
+    for name in grids:
+        values = grids[name]
+        if isinstance(values, tuple):
+            shape = values
+            values = None
+        else:
+            values = np.asarray(values)
+            shape = values.shape
+        chunks = grid_chunks
+        if chunks is None:
+            chunks = profile_chunks(profile, shape)
+        if chunks is None:
+            chunks = tuple([max(n, 1) for n in shape])
+        array = create_zarr_array(group, name, shape, chunks, dtype,
+                                  no_data_value, [time_dimension, 'y', 'x'])
+        if values is not None:
+            array[:] = values
+
+    return ZarrDataset(output_file, 'a')
+
+
+def add_mask_variable(dataset, mask_name, like_name, profile=None):
+    # Get a uint8 mask variable of an open stack (netCDF4 or Zarr) with the
+    # dimensions and shape of the variable like_name, creating it if needed
+    if mask_name in dataset.variables:
+        return dataset.variables[mask_name]
+
+    profile = get_profile(profile=profile)
+    like = dataset.variables[like_name]
+    dimensions = variable_dimensions(like)
+    shape = tuple(like.shape)
+
+    if isinstance(dataset, ZarrDataset):
+        chunks = profile_chunks(profile, shape)
+        if chunks is None:
+            chunks = tuple([max(n, 1) for n in shape])
+        variable = create_zarr_array(dataset.group, mask_name, shape, chunks,
+                                     'u1', 0, list(dimensions))
+        dataset.variables[mask_name] = variable
+        return variable
+
+    return dataset.createVariable(mask_name, 'u1', dimensions,
+                                  **netcdf_variable_options(profile, shape))
+
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Incremental updates of the per-cell stacks
+#
+# Stacks are written with an unlimited time dimension, so new epochs can be
+# added to an existing stack without rewriting it. The new epochs are put in
+# sorted position: epochs after the last stored one are appended, and only
+# the stored epochs after an earlier new epoch are moved.
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+
+def timestamp_to_date_string(timestamp):
+    # the times are stored as f4 timestamps of midnight, which can be off by
+    # a minute, so they are rounded to the nearest day
+    date = dt.datetime.fromtimestamp(float(timestamp)) + dt.timedelta(hours=12)
+    return date.strftime('%Y%m%d')
+
+
+def stack_can_be_appended(output_file):
+    if not os.path.exists(output_file):
+        return False
+    if is_zarr(output_file):
+        # Zarr arrays can always be resized
+        return True
+    ds = nc.Dataset(output_file, 'r')
+    can_be_appended = 'time' in ds.dimensions and ds.dimensions[
+        'time'].isunlimited()
+    ds.close()
+    return can_be_appended
+
+
+def stack_date_pairs(output_file):
+    # date pairs (e.g. "20141201-20141231") already in a MEaSUREs stack
+    if not os.path.exists(output_file):
+        return []
+    ds = open_stack(output_file)
+    date_pairs = []
+    if 'time_start' in ds.variables:
+        for start, end in zip(ds.variables['time_start'][:],
+                              ds.variables['time_end'][:]):
+            date_pairs.append(
+                timestamp_to_date_string(start) + '-' +
+                timestamp_to_date_string(end))
+    ds.close()
+    return date_pairs
+
+
+def stack_times(output_file):
+    # timestamps already in an ATL15 stack
+    if not os.path.exists(output_file):
+        return np.array([])
+    ds = open_stack(output_file)
+    times = np.array(ds.variables['time'][:], dtype='f8')
+    ds.close()
+    return times
+
+
+def insert_epochs(output_file, sort_variable, time_values, grids):
+    # Insert new epochs into a stack in sorted position of sort_variable.
+    # time_values and grids map variable names to the values of the new
+    # epochs (1-D for the time variables, (time, y, x) for the grids).
+    ds = open_stack(output_file, 'a')
+    stored = np.array(ds.variables[sort_variable][:], dtype='f8')
+    n_stored = len(stored)
+    new = np.asarray(time_values[sort_variable], dtype='f8')
+    n_total = n_stored + len(new)
+
+    # source of each epoch of the merged stack (indices >= n_stored are new)
+    order = np.argsort(np.concatenate((stored, new)), kind='stable')
+    moved = np.nonzero(order != np.arange(n_total))[0]
+    first = int(moved[0]) if len(moved) > 0 else n_stored
+    sources = order[first:]
+
+    variables = dict(time_values)
+    variables.update(grids)
+    for name in variables:
+        variable = ds.variables[name]
+        new_values = np.asarray(variables[name])
+        tail = variable[first:n_stored]
+        if np.ndim(new_values) > 1:
+            tail = np.ma.filled(tail, np.nan)
+
+        values = np.zeros((n_total - first, ) + np.shape(new_values)[1:],
+                          dtype=new_values.dtype)
+        from_stored = sources < n_stored
+        values[from_stored] = tail[sources[from_stored] - first]
+        values[~from_stored] = new_values[sources[~from_stored] - n_stored]
+        write_records(variable, first, values)
+
+    ds.close()
 
-def output_data_stack_atl_timedim(IC_object, time_stack, delta_h_stack):
+    return n_total - first
+
+
+def output_data_stack_atl_timedim(IC_object,
+                                  time_stack,
+                                  delta_h_stack,
+                                  profile=None,
+                                  append=None):
+    # With append (default IC.incremental_update) the epochs are added to an
+    # existing stack instead of skipping it
     import datetime
 
-    output_folder = os.path.join(IC_object.data_folder, 'Output',
-                                 IC_object.icesheet_name,
-                                 IC_object.region_name)
+    profile = get_profile(IC_object, profile)
+
+    output_file = stack_path(IC_object)
+    output_folder = os.path.dirname(output_file)
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
-    output_file = os.path.join(output_folder,
-                               IC_object.short_name + "_stack.nc")
-    #if file exists, delete it
+    #if file exists, add the new epochs to it or skip it
+    if append is None:
+        append = IC_object.incremental_update
     if os.path.exists(output_file):
+        if append and stack_can_be_appended(output_file):
+            if len(time_stack) == 0:
+                print("        No new epochs for existing file...")
+                return
+            time_stack = [datetime.datetime.timestamp(t) for t in time_stack]
+            n_written = insert_epochs(output_file, 'time',
+                                      {'time': time_stack},
+                                      {'delta_h': np.array(delta_h_stack)})
+            message = '        Added ' + str(len(time_stack)) + ' epochs (' + str(
+                n_written) + ' written) to ' + output_file
+            IC_object.output_summary += '\n' + message
+            print(message)
+            return
         #print("        Overwriting existing file...") #: " + output_file)
         #os.remove(output_file)
         print("        Skipping existing file...")  #: " + output_file)
         return
 
+    if get_backend(IC_object) == 'zarr':
+        time_stack = [datetime.datetime.timestamp(t) for t in time_stack]
+        write_zarr_stack(
+            output_file, {
+                'x': IC_object.elevation_grid_x,
+                'y': IC_object.elevation_grid_y
+            }, {'time': time_stack}, {'delta_h': np.array(delta_h_stack)},
+            {'title': IC_object.region_name + ' ' + IC_object.short_name},
+            profile)
+
+        message = '        Saved file to ' + output_file
+        IC_object.output_summary += '\n' + message
+        print(message)
+        return
+
     ds = nc.Dataset(output_file, "w", format="NETCDF4")
 
     ds.createDimension('y', len(IC_object.velocity_grid_y))
@@ -32,17 +465,23 @@ def output_data_stack_atl_timedim(IC_object, time_stack, delta_h_stack):
     xvar[:] = IC_object.elevation_grid_x
     yvar[:] = IC_object.elevation_grid_y
 
-    ds.createDimension('time', len(time_stack))
+    # the time dimension is unlimited so new epochs can be added later
+    ds.createDimension('time', None)
     timevar = ds.createVariable('time', 'f4', ("time", ))
     # convert time_stack to a float representation
     time_stack = [datetime.datetime.timestamp(t) for t in time_stack]
     timevar[:] = time_stack
     # create a variable for delta_h that has a time dimension
-    delta_h = ds.createVariable('delta_h', 'f4', ("time", "y", "x"))
+    delta_h = ds.createVariable(
+        'delta_h', output_profiles[profile]['dtype'], ("time", "y", "x"),
+        **netcdf_variable_options(
+            profile, (len(time_stack), len(IC_object.elevation_grid_y),
+                      len(IC_object.elevation_grid_x))))
     delta_h[:, :, :] = delta_h_stack
 
     #create attribute title with IC.region_name
     ds.title = IC_object.region_name + ' ' + IC_object.short_name
+    ds.output_profile = profile
 
     ds.close()
 
@@ -59,7 +498,10 @@ def output_grid_with_geo_reference_timedim(output_file,
                                            y,
                                            grid,
                                            grid_name,
-                                           resolution=50):
+                                           resolution=50,
+                                           profile=None):
+
+    profile = get_profile(profile=profile)
 
     if os.path.isfile(output_file):
         os.remove(output_file)
@@ -145,12 +587,17 @@ def output_grid_with_geo_reference_timedim(output_file,
     # dataset['projection'].attrs['false_northing'] = 0.0
     # dataset['projection'].attrs['units'] = "meters"
 
-    dataset.to_netcdf(output_file)
+    dataset.attrs['output_profile'] = profile
+    dataset.to_netcdf(
+        output_file,
+        encoding={grid_name: xarray_encoding(profile, np.shape(grid))})
     return
 
 
-def add_atl14_to_nc(IC_object, output_file):
+def add_atl14_to_nc(IC_object, output_file, profile=None):
     import toolbox.data_handling as data
+
+    profile = get_profile(IC_object, profile)
     ds = nc.Dataset(output_file, 'a')
     x, y, h, h_sigma = data.get_atl14_data(IC_object)
 
@@ -163,8 +610,12 @@ def add_atl14_to_nc(IC_object, output_file):
     #variables
     atl14.createVariable('x', 'f4', ('x', ))
     atl14.createVariable('y', 'f4', ('y', ))
-    atl14.createVariable('h', 'f4', ('y', 'x'))
-    atl14.createVariable('h_sigma', 'f4', ('y', 'x'))
+    atl14.createVariable('h', 'f4', ('y', 'x'),
+                         **netcdf_variable_options(profile,
+                                                   (len(y), len(x))))
+    atl14.createVariable('h_sigma', 'f4', ('y', 'x'),
+                         **netcdf_variable_options(profile,
+                                                   (len(y), len(x))))
 
     #attributes
     atl14['x'].units = 'meters'
@@ -203,7 +654,10 @@ def output_grid_with_geo_reference_timedim_atl(IC_object,
                                                y,
                                                grid,
                                                grid_name,
-                                               resolution=50):
+                                               resolution=50,
+                                               profile=None):
+
+    profile = get_profile(IC_object, profile)
 
     if os.path.isfile(output_file):
         os.remove(output_file)
@@ -298,7 +752,10 @@ def output_grid_with_geo_reference_timedim_atl(IC_object,
     # dataset['projection'].attrs['false_northing'] = 0.0
     # dataset['projection'].attrs['units'] = "meters"
 
-    dataset.to_netcdf(output_file)
+    dataset.attrs['output_profile'] = profile
+    dataset.to_netcdf(
+        output_file,
+        encoding={grid_name: xarray_encoding(profile, np.shape(grid))})
     dataset.close()
 
     if IC_object.short_name == 'ATL15 Antarctic Elevation':
@@ -307,6 +764,114 @@ def output_grid_with_geo_reference_timedim_atl(IC_object,
     return
 
 
+def create_quilt_file(IC_object,
+                      output_file,
+                      time,
+                      x,
+                      y,
+                      grid_names,
+                      no_data_value=0,
+                      profile=None,
+                      cell_shape=None):
+    # Create an empty quilt file with the same layout and attributes as
+    # output_grid_with_geo_reference_timedim_atl, so the cells can be written
+    # into it one slab at a time. Returns the open dataset. A quilt ending in
+    # .zarr is a Zarr store; with the cell_shape (rows, columns) its chunks
+    # are aligned to the cells, so each cell can be written by a different
+    # process at the same time.
+
+    if os.path.exists(output_file):
+        remove_output(output_file)
+    else:
+        #create the path but not the file
+        path = os.path.dirname(output_file)
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    if no_data_value == 'nan':
+        no_data_value = np.nan
+    profile = get_profile(IC_object, profile)
+
+    if is_zarr(output_file):
+        shape = (len(time), len(y), len(x))
+        grid_chunks = profile_chunks(profile, shape)
+        if grid_chunks is None:
+            grid_chunks = shape
+        if cell_shape is not None:
+            grid_chunks = (grid_chunks[0],
+                           aligned_block(cell_shape[0], grid_chunks[1]),
+                           aligned_block(cell_shape[1], grid_chunks[2]))
+        title = IC_object.icesheet_name + ' ' + IC_object.data_type.title(
+        ) + ' ' + IC_object.nickname + ' ' + 'Stack'
+        return write_zarr_stack(output_file, {
+            'x': x,
+            'y': y
+        }, {'t': time}, {name: shape
+                         for name in grid_names}, {'title': title},
+                                profile,
+                                no_data_value,
+                                grid_chunks,
+                                time_dimension='t')
+
+    ds = nc.Dataset(output_file, "w", format="NETCDF4")
+    ds.createDimension('t', len(time))
+    ds.createDimension('y', len(y))
+    ds.createDimension('x', len(x))
+
+    ds.title = IC_object.icesheet_name + ' ' + IC_object.data_type.title(
+    ) + ' ' + IC_object.nickname + ' ' + 'Stack'
+    ds.output_profile = profile
+
+    tvar = ds.createVariable('t', 'f8', ('t', ))
+    tvar.long_name = 'Time'
+    tvar.standard_name = 'time'
+    tvar.comment = 'datetime timestamp'
+    tvar[:] = time
+
+    xvar = ds.createVariable('x', 'f8', ('x', ))
+    xvar.long_name = 'Cartesian x-coordinate'
+    xvar.standard_name = 'projection_x_coordinate'
+    xvar.units = 'meters'
+    xvar.axis = 'X'
+    xvar.coverage_content_type = 'coordinate'
+    xvar.valid_min = np.min(x)
+    xvar.valid_max = np.max(x)
+    xvar.comment = 'Projected horizontal coordinates of the grid'
+    xvar[:] = x
+
+    yvar = ds.createVariable('y', 'f8', ('y', ))
+    yvar.long_name = 'Cartesian y-coordinate'
+    yvar.standard_name = 'projection_y_coordinate'
+    yvar.units = 'meters'
+    yvar.axis = 'Y'
+    yvar.coverage_content_type = 'coordinate'
+    yvar.valid_min = np.min(y)
+    yvar.valid_max = np.max(y)
+    yvar.comment = 'Projected vertical coordinates of the grid'
+    yvar[:] = y
+
+    projection = ds.createVariable('projection', 'S1')
+    projection.grid_boundary_top_projected_y = np.max(y)
+    projection.grid_boundary_bottom_projected_y = np.min(y)
+    projection.grid_boundary_right_projected_x = np.max(x)
+    projection.grid_boundary_left_projected_x = np.min(x)
+    projection.parent_grid_cell_row_subset_start = int(0.0)
+    projection.parent_grid_cell_row_subset_end = int(float(len(y)))
+    projection.parent_grid_cell_column_subset_start = int(0.0)
+    projection.parent_grid_cell_column_subset_end = int(float(len(x)))
+
+    # the parts of the quilt which are not covered by a cell read as
+    # no_data_value without being written
+    for grid_name in grid_names:
+        ds.createVariable(grid_name,
+                          output_profiles[profile]['dtype'], ('t', 'y', 'x'),
+                          fill_value=no_data_value,
+                          **netcdf_variable_options(
+                              profile, (len(time), len(y), len(x))))
+
+    return ds
+
+
 def output_grid_with_geo_reference_timedim_measures(IC_object,
                                                     output_file,
                                                     time,
@@ -314,7 +879,10 @@ def output_grid_with_geo_reference_timedim_measures(IC_object,
                                                     y,
                                                     grid,
                                                     grid_name,
-                                                    resolution=50):
+                                                    resolution=50,
+                                                    profile=None):
+
+    profile = get_profile(IC_object, profile)
 
     if os.path.isfile(output_file):
         os.remove(output_file)
@@ -410,26 +978,41 @@ def output_grid_with_geo_reference_timedim_measures(IC_object,
     # dataset['projection'].attrs['false_northing'] = 0.0
     # dataset['projection'].attrs['units'] = "meters"
 
-    dataset.to_netcdf(output_file)
+    dataset.attrs['output_profile'] = profile
+    dataset.to_netcdf(
+        output_file,
+        encoding={grid_name: xarray_encoding(profile, np.shape(grid))})
     dataset.close()
 
     return
 
 
 def output_data_stack_measures(IC_object, x, y, vx_grids, vy_grids, v_grids,
-                               ex_grids, ey_grids, e_grids, date_pairs):
+                               ex_grids,
+                               ey_grids,
+                               e_grids,
+                               date_pairs,
+                               profile=None,
+                               append=None):
+    # With append (default IC.incremental_update) the epochs are added to an
+    # existing stack instead of rewriting it
+
+    profile = get_profile(IC_object, profile)
 
     #output_folder =  os.path.join(IC_object.data_folder, 'Quilted Grids', IC_object.icesheet_name, IC_object.region_name)
-    output_folder = os.path.join(IC_object.data_folder, 'Output',
-                                 IC_object.icesheet_name,
-                                 IC_object.region_name)
+    output_file = stack_path(IC_object)
+    output_folder = os.path.dirname(output_file)
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
-    output_file = os.path.join(output_folder,
-                               IC_object.short_name + "_stack.nc")
+
+    # add the new epochs to an existing stack
+    if append is None:
+        append = IC_object.incremental_update
+    append = append and stack_can_be_appended(output_file)
+
     #if output_file exists, delete it
-    if os.path.exists(output_file):
-        os.remove(output_file)
+    if os.path.exists(output_file) and not append:
+        remove_output(output_file)
 
     starts = []
     ends = []
@@ -446,32 +1029,73 @@ def output_data_stack_measures(IC_object, x, y, vx_grids, vy_grids, v_grids,
     start_stack = [dt.datetime.timestamp(t) for t in starts]
     end_stack = [dt.datetime.timestamp(t) for t in ends]
 
-    # sort start_stack and then sort end_stack in the same way
+    # sort start_stack and then sort end_stack in the same way. The stacks
+    # from measures.create_velocity_stack are already sorted, so the grids
+    # are only copied into a new order when they are not.
     start_stack = np.array(start_stack)
     end_stack = np.array(end_stack)
     date_pairs = np.array(date_pairs)
 
-    sort_index = np.argsort(start_stack)
+    if np.any(np.diff(start_stack) < 0):
+        sort_index = np.argsort(start_stack, kind='stable')
 
-    start_stack = start_stack[sort_index]
-    end_stack = end_stack[sort_index]
-    vx_grids = vx_grids[sort_index]
-    vy_grids = vy_grids[sort_index]
-    v_grids = v_grids[sort_index]
-    ex_grids = ex_grids[sort_index]
-    ey_grids = ey_grids[sort_index]
-    e_grids = e_grids[sort_index]
-    date_pairs = date_pairs[sort_index]
+        start_stack = start_stack[sort_index]
+        end_stack = end_stack[sort_index]
+        vx_grids = vx_grids[sort_index]
+        vy_grids = vy_grids[sort_index]
+        v_grids = v_grids[sort_index]
+        ex_grids = ex_grids[sort_index]
+        ey_grids = ey_grids[sort_index]
+        e_grids = e_grids[sort_index]
+        date_pairs = date_pairs[sort_index]
 
     # code to convert back to datetime
     #start_stack = [dt.datetime.fromtimestamp(t) for t in start_stack]
     #end_stack = [dt.datetime.fromtimestamp(t) for t in end_stack]
 
+    if append:
+        n_written = insert_epochs(
+            output_file, 'time_start', {
+                'time_start': start_stack,
+                'time_end': end_stack
+            }, {
+                'VX': vx_grids,
+                'VY': vy_grids,
+                'V': v_grids,
+                'EX': ex_grids,
+                'EY': ey_grids,
+                'E': e_grids
+            })
+        message = '        Added ' + str(len(date_pairs)) + ' epochs (' + str(
+            n_written) + ' written) to ' + output_file
+        IC_object.output_summary += '\n' + message
+        if IC_object.print_sub_outputs:
+            print(message)
+        return
+
+    if get_backend(IC_object) == 'zarr':
+        write_zarr_stack(output_file, {
+            'x': x,
+            'y': y
+        }, {
+            'time_start': start_stack,
+            'time_end': end_stack
+        }, {
+            'VX': vx_grids,
+            'VY': vy_grids,
+            'V': v_grids,
+            'EX': ex_grids,
+            'EY': ey_grids,
+            'E': e_grids
+        }, {}, profile)
+        return
+
     data = nc.Dataset(output_file, "w", format="NETCDF4")
 
     data.createDimension('y', len(y))
     data.createDimension('x', len(x))
-    data.createDimension('time', len(date_pairs))
+    # the time dimension is unlimited so new epochs can be added later
+    data.createDimension('time', None)
 
     xvar = data.createVariable('x', 'f4', ("x", ))
     yvar = data.createVariable('y', 'f4', ("y", ))
@@ -483,12 +1107,16 @@ def output_data_stack_measures(IC_object, x, y, vx_grids, vy_grids, v_grids,
     xvar[:] = x  #IC_object.velocity_grid_x
     yvar[:] = y  #IC_object.velocity_grid_y
 
-    vx = data.createVariable('VX', 'f4', ("time", "y", "x"))
-    vy = data.createVariable('VY', 'f4', ("time", "y", "x"))
-    v = data.createVariable('V', 'f4', ("time", "y", "x"))
-    ex = data.createVariable('EX', 'f4', ("time", "y", "x"))
-    ey = data.createVariable('EY', 'f4', ("time", "y", "x"))
-    e = data.createVariable('E', 'f4', ("time", "y", "x"))
+    data.output_profile = profile
+    dtype = output_profiles[profile]['dtype']
+    options = netcdf_variable_options(profile,
+                                      (len(date_pairs), len(y), len(x)))
+    vx = data.createVariable('VX', dtype, ("time", "y", "x"), **options)
+    vy = data.createVariable('VY', dtype, ("time", "y", "x"), **options)
+    v = data.createVariable('V', dtype, ("time", "y", "x"), **options)
+    ex = data.createVariable('EX', dtype, ("time", "y", "x"), **options)
+    ey = data.createVariable('EY', dtype, ("time", "y", "x"), **options)
+    e = data.createVariable('E', dtype, ("time", "y", "x"), **options)
 
     vx[:, :, :] = vx_grids
     vy[:, :, :] = vy_grids